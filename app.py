@@ -1,17 +1,25 @@
-from flask import Flask, request, render_template, send_from_directory, session, url_for, redirect
+from flask import Flask, request, render_template, send_from_directory, session, url_for, redirect, jsonify, Response
 import os
+import uuid
 import papermill as pm
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 import pipeline
 from utils.app_utils import find_file_by_stem
+from utils.job_queue import get_job_queue, current_job_id, FINISHED, FAILED
+from utils.transform_utils import OUTPUT_EXTENSIONS, read_frame, write_frame
+from utils.instrumentation import metrics
+from utils.llm_cache import llm_cache
+from utils.code_cache import code_cache
 
 UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER") or 'uploads'
 RESULT_FOLDER = os.getenv("RESULT_FOLDER") or 'results'
 STATIC_FOLDER = os.getenv("STATIC_FOLDER") or 'static'
 INDEX_FILE = os.getenv("INDEX_FILE") or 'index.html'
-RESULT_FILE = os.getenv('RESULT_FILE') or 'generated_dataset.csv'
+RESULT_FILE = os.getenv('RESULT_FILE') or f"generated_dataset{OUTPUT_EXTENSIONS[pipeline.OUTPUT_FORMAT]}"
 SAMPLE_DATA_FOLDER = os.getenv('SAMPLE_DATA_FOLDER') or 'sample_data'
 METADATA_FOLDER = os.getenv('METADATA_FOLDER') or 'metadata'
+USE_SAVED_SUMMARY = (os.getenv('USE_SAVED_SUMMARY') or 'false').lower() == 'true'
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULT_FOLDER, exist_ok=True)
@@ -25,10 +33,22 @@ app.secret_key = os.getenv('SECRET_KEY') or 'forager'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['RESULT_FOLDER'] = RESULT_FOLDER
 
-def save_file_as(name):
+def upload_folder(new=False):
+    """This session's upload folder; `new` starts a fresh one (a new bundle). Jobs of other sessions never see it."""
+    if new or not session.get('upload_id'):
+        session['upload_id'] = uuid.uuid4().hex
+    path = os.path.join(UPLOAD_FOLDER, session['upload_id'])
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def job_folder(job_id):
+    """Every job writes its results (summary, dataset, run report) to a folder of its own."""
+    return os.path.join(RESULT_FOLDER, job_id)
+
+def save_file_as(name, folder):
     file = request.files.get(name)
     if file and file.filename:
-        path = os.path.join(UPLOAD_FOLDER, f'{name}{os.path.splitext(file.filename)[1]}')
+        path = os.path.join(folder, f'{name}{os.path.splitext(file.filename)[1]}')
         file.save(path)
         return path
     return None
@@ -44,8 +64,9 @@ def step1():
 @app.route('/step1', methods=['POST'])
 def handle_step1():
     """Save the task description and data documentation with those names."""
-    task_path = save_file_as('task_description')
-    doc_path = save_file_as('data_documentation')
+    folder = upload_folder(new=True)
+    task_path = save_file_as('task_description', folder)
+    doc_path = save_file_as('data_documentation', folder)
     # session dict stored between multiple requests
     session['task_description'] = task_path
     session['data_documentation'] = doc_path
@@ -70,7 +91,7 @@ def handle_step2():
             break
         section_name = request.form[name_key] # SECTION NAME
         # create the section folder
-        folder_path = os.path.join(UPLOAD_FOLDER, section_name)
+        folder_path = os.path.join(upload_folder(), section_name)
         os.makedirs(folder_path, exist_ok=True)
 
         section = {'folder_path': folder_path, 'metadata': None, 'data': []}
@@ -105,7 +126,7 @@ def handle_step2():
 
 @app.route('/review')
 def step3():
-    print("Uploaded files:", os.listdir(app.config['UPLOAD_FOLDER']), flush=True)
+    print("Uploaded files:", os.listdir(upload_folder()), flush=True)
 
     raw_sections = session.get('data_sections', {})
     section_list = list(raw_sections.values())
@@ -115,6 +136,40 @@ def step3():
                            sections=section_list)
 
 
+def load_saved_part_1_result(saved_files, output_dir):
+    """Skip Part 1/2 and reuse the summary already in results/metadata (USE_SAVED_SUMMARY=true, for testing)."""
+    import pandas as pd
+
+    summary_df = pd.read_csv(os.path.join(output_dir, METADATA_FOLDER, 'summary.csv'))
+    return {
+        'success': True,
+        'summary_csv': os.path.join(output_dir, METADATA_FOLDER, 'summary.csv'),
+        'question_map_csv': os.path.join(output_dir, METADATA_FOLDER, 'question_map.csv'),
+        'selected_sections': list([]),
+        'field_summary': summary_df.head(10).to_dict(orient='records')}
+
+def run_field_selection_job(saved_files):
+    """Part 1/2, writing into the job's own folder."""
+    if USE_SAVED_SUMMARY:
+        return load_saved_part_1_result(saved_files, RESULT_FOLDER)
+    return pipeline.run_part_1_2_module_field_selection(saved_files, job_folder(current_job_id.get()))
+
+def run_transform_job(saved_files, uploads):
+    """ Part 3 into the job's own folder, then clear this session's uploads (and only those).
+    Uploads are kept if some files could not be processed, so they can be fixed and the step run again. """
+    import shutil
+
+    result = pipeline.run_part_3_transform_data(saved_files, job_folder(current_job_id.get()))
+    if result.get('success') and not result.get('file_errors'):
+        shutil.rmtree(uploads, ignore_errors=True)
+    return result
+
+def job_submitted(job_id):
+    """POST handlers return right away: JSON clients get the job id, browsers go to the progress page."""
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
+    return redirect(url_for('job_progress', job_id=job_id))
+
 @app.route('/upload', methods=['POST'])
 def submit_part_1():
     saved_files = {
@@ -123,30 +178,84 @@ def submit_part_1():
         'data_sections': session.get('data_sections')
     }
     print(f"Saved files: {saved_files}", flush=True)
-    # FOR NOW, TO TEST:
-    # result = pipeline.run_part_1_2_module_field_selection(saved_files, RESULT_FOLDER)
-    import pandas as pd
-
-    summary_df = pd.read_csv(os.path.join(RESULT_FOLDER, METADATA_FOLDER, 'summary.csv'))
-    result = {
-        'success': True,
-        'summary_csv': os.path.join(RESULT_FOLDER, METADATA_FOLDER, 'summary.csv'),
-        'question_map_csv': os.path.join(RESULT_FOLDER, METADATA_FOLDER, 'question_map.csv'),
-        'selected_sections': list([]),
-        'field_summary': summary_df.head(10).to_dict(orient='records')}
+    job_id = get_job_queue().submit('part_1', run_field_selection_job, saved_files)
+    return job_submitted(job_id)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify({k: v for k, v in job.items() if k not in ('result', 'report')})
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job['status'] == FAILED:
+        return jsonify({'status': job['status'], 'error': job['error']}), 500
+    if job['status'] != FINISHED:
+        return jsonify({'status': job['status'], 'progress': job['progress']}), 409
+    return jsonify(job['result'])
+
+@app.route('/jobs/<job_id>/report')
+def job_report(job_id):
+    """Stage timings, LLM calls and token counts of a finished (or failed) job."""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.get('report') is None:
+        return jsonify({'status': job['status'], 'progress': job['progress']}), 409
+    return jsonify(job['report'])
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Process-wide stage timings, LLM usage and cache statistics in the Prometheus text format."""
+    cache_stats = llm_cache.stats()
+    gauges = {
+        'pipeline_llm_cache_hits': cache_stats['hits'],
+        'pipeline_llm_cache_misses': cache_stats['misses'],
+        'pipeline_llm_cache_evictions': cache_stats['evictions'],
+        'pipeline_llm_cache_bytes': cache_stats['bytes'],
+        'pipeline_code_cache_hits': code_cache.hits,
+        'pipeline_code_cache_misses': code_cache.misses,
+        'pipeline_code_cache_failures': code_cache.failures,
+    }
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
-    if result.get('success'):
+@app.route('/jobs/<job_id>/progress')
+def job_progress(job_id):
+    if get_job_queue().get(job_id) is None:
+        session['error_message'] = 'Unknown job.'
+        return redirect(url_for('upload_failed'))
+    return render_template('job_progress.html', job_id=job_id)
+
+@app.route('/jobs/<job_id>/done')
+def job_done(job_id):
+    """Route the browser to the next step once a job has finished (or failed)."""
+    job = get_job_queue().get(job_id)
+    if job is None or job['status'] not in (FINISHED, FAILED):
+        return redirect(url_for('job_progress', job_id=job_id))
+    result = job.get('result') or {}
+    if job['status'] == FAILED or not result.get('success'):
+        session['error_message'] = result.get('message') or job.get('error')
+        return redirect(url_for('upload_failed'))
+    if job['kind'] == 'part_1':
         session['part_1_result'] = result
+        session['part_1_job_id'] = job_id
         return redirect(url_for('view_selected_fields'))
-    else:
-        session['error_message'] = result.get('message')
-        return redirect(url_for('upload_failed'))
-    
+    return redirect(url_for('download_ready', job_id=job_id))
+
 @app.route('/view-selected-fields')
 def view_selected_fields():
     result = session.get('part_1_result')
+    summary_url = None
+    if result.get('summary_csv') and not USE_SAVED_SUMMARY:
+        summary_path = os.path.relpath(result['summary_csv'], job_folder(session['part_1_job_id']))
+        summary_url = url_for('download', job_id=session['part_1_job_id'], filename=summary_path)
     return render_template('selected_fields.html', field_summary=result.get('field_summary', []),
-        summary_csv=result.get('summary_csv'),
+        summary_url=summary_url,
         selected_sections=result.get('selected_sections')
     )
 
@@ -165,30 +274,45 @@ def transform_data():
         'question_map_csv': session.get('part_1_result').get('question_map_csv')
     }
     print("Saved Files @ Transform step:", saved_files)
-    result = pipeline.run_part_3_transform_data(saved_files, RESULT_FOLDER)
-
-    import shutil
-
-    shutil.rmtree(app.config['UPLOAD_FOLDER'], ignore_errors=True)
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)  # recreate it fresh
-
-    if result.get('success'):
-        return redirect(url_for('download_ready'))
-    else:
-        session['error_message'] = result.get('message')
-        return redirect(url_for('upload_failed'))
-
-@app.route('/download-ready')
-def download_ready():
-    return render_template('download.html', filename=RESULT_FILE)
+    job_id = get_job_queue().submit('part_3', run_transform_job, saved_files, upload_folder())
+    return job_submitted(job_id)
+
+@app.route('/download-ready/<job_id>')
+def download_ready(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None or job['status'] != FINISHED:
+        return redirect(url_for('job_progress', job_id=job_id))
+    result = job.get('result') or {}
+    return render_template('download.html', job_id=job_id, filename=result.get('filename') or RESULT_FILE,
+                           file_errors=result.get('file_errors') or {})
 
 @app.route('/upload-failed')
 def upload_failed():
     return render_template('fail.html', message=session.get('error_message'))
 
-@app.route('/download/<filename>')
-def download(filename):
-    return send_from_directory(RESULT_FOLDER, filename, as_attachment=True)
+@app.route('/download/<job_id>/<path:filename>')
+def download(job_id, filename):
+    """ Serve a file from a job's result folder (CSV, Parquet or Feather dataset, summary, run report).
+    For columnar files, ?columns=a,b returns only those columns. """
+    if get_job_queue().get(job_id) is None:
+        return "File not found", 404
+    columns = request.args.get('columns')
+    if columns and filename.endswith(('.parquet', '.feather')):
+        import tempfile
+
+        path = safe_join(job_folder(job_id), filename)
+        if path is None or not os.path.exists(path):
+            return "File not found", 404
+        stem, ext = os.path.splitext(os.path.basename(path))
+        try:
+            df = read_frame(path, columns=columns.split(','))
+        except (KeyError, ValueError) as e:
+            return f"Unknown column requested: {e}", 400
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            subset_path = write_frame(df, os.path.join(tmp_dir, stem), ext.lstrip('.'))
+            buffer = BytesIO(open(subset_path, 'rb').read())
+        return send_file(buffer, as_attachment=True, download_name=f"{stem}_subset{ext}")
+    return send_from_directory(job_folder(job_id), filename, as_attachment=True)
 
 @app.route('/load-sample')
 def load_sample_data():
@@ -200,8 +324,9 @@ def load_sample_data():
     task_ext = os.path.splitext(task_src)[1]
     doc_ext = os.path.splitext(doc_src)[1]
 
-    task_dst = os.path.join(UPLOAD_FOLDER, f'task_description{task_ext}')
-    doc_dst = os.path.join(UPLOAD_FOLDER, f'data_documentation{doc_ext}')
+    folder = upload_folder(new=True)
+    task_dst = os.path.join(folder, f'task_description{task_ext}')
+    doc_dst = os.path.join(folder, f'data_documentation{doc_ext}')
     
     shutil.copy(task_src, task_dst)
     shutil.copy(doc_src, doc_dst)
@@ -215,7 +340,7 @@ def load_sample_data():
     sections = [dir_name for dir_name in os.listdir(f'{SAMPLE_DATA_FOLDER}') if not dir_name.startswith('task_description') and not dir_name.startswith('data_documentation') and not dir_name.startswith('.')]
     for section_name in sections:
         section_path = os.path.join(SAMPLE_DATA_FOLDER, section_name)
-        dest_path = os.path.join(UPLOAD_FOLDER, section_name)
+        dest_path = os.path.join(folder, section_name)
         os.makedirs(dest_path, exist_ok=True)
 
         section = {'folder_path': dest_path, 'metadata': None, 'data': []}
@@ -0,0 +1,78 @@
+# Benchmark: cascade of pairwise outer merges (old Part 3) vs. the single multi-way join planner.
+#
+# Usage (from the repo root):
+#   python -m benchmarks.bench_merge --entities 200000 --columns 5 --files 2 4 8 16 32
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.transform_utils import merge_entity_frames
+
+ENTITY_KEY = 'player_id'
+
+
+def make_frames(num_files, num_entities, num_columns, overlap, seed):
+  """One per-entity frame per file; each covers a random `overlap` share of the entities."""
+  rng = np.random.default_rng(seed)
+  keys = np.array([f"user_{i}" for i in range(num_entities)])
+  frames = []
+  for f in range(num_files):
+    subset = np.sort(rng.choice(num_entities, int(num_entities * overlap), replace=False))
+    frame = pd.DataFrame({f"f{f}_c{c}": rng.random(len(subset)) for c in range(num_columns)})
+    frame.insert(0, ENTITY_KEY, keys[subset])
+    frames.append(frame)
+  return frames
+
+
+def cascade_merge(frames):
+  result = None
+  for frame in frames:
+    result = frame if result is None else result.merge(frame, on=ENTITY_KEY, how='outer')
+  return result
+
+
+def check_small_int_fill():
+  """Small integer columns that get gaps in the join come out as float32, not float64."""
+  left = pd.DataFrame({ENTITY_KEY: ['a', 'b'], 'level': np.array([1, 2], dtype=np.int8)})
+  right = pd.DataFrame({ENTITY_KEY: ['b', 'c'], 'score': [0.5, 1.5]})
+  merged = merge_entity_frames([left, right], ENTITY_KEY)
+  assert merged['level'].dtype == np.float32, merged['level'].dtype
+  assert merged['level'].isna().tolist() == [False, False, True]
+
+
+def time_it(fn, repeat):
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Cascade vs. multi-way merge benchmark')
+  parser.add_argument('--entities', type=int, default=100_000)
+  parser.add_argument('--columns', type=int, default=5, help='value columns per file')
+  parser.add_argument('--overlap', type=float, default=0.8, help='share of entities present in each file')
+  parser.add_argument('--files', type=int, nargs='+', default=[2, 4, 8, 16, 32])
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  check_small_int_fill()
+  print(f"{'files':>6} {'cascade (s)':>12} {'multi-way (s)':>14} {'speedup':>8}")
+  for num_files in args.files:
+    frames = make_frames(num_files, args.entities, args.columns, args.overlap, args.seed)
+    expected = cascade_merge(frames).sort_values(ENTITY_KEY).reset_index(drop=True)
+    actual = merge_entity_frames(frames, ENTITY_KEY)
+    pd.testing.assert_frame_equal(expected, actual.reset_index(drop=True), check_like=True)
+
+    cascade_seconds = time_it(lambda: cascade_merge(frames), args.repeat)
+    planner_seconds = time_it(lambda: merge_entity_frames(frames, ENTITY_KEY), args.repeat)
+    print(f"{num_files:>6} {cascade_seconds:>12.3f} {planner_seconds:>14.3f} {cascade_seconds / planner_seconds:>7.1f}x")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,129 @@
+# Deterministic offline stand-in for the chat models, for benchmarks (no API keys, no network).
+# Answers are derived from the prompt text only: column mappings are read off the metadata pages, every mapped column
+# gets a selection verdict, renames match identical names, and aggregation code is a plain groupby. The same prompt
+# always gets the same answer, and each call can be given a simulated latency.
+import asyncio
+import hashlib
+import json
+import re
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+from models.return_models import (BatchedColumnSelectionMapping, ColumnMapping, ColumnRenameMapping, ColumnSelectionMapping,
+                                  ColumnSelectionReasoning, FunctionalCode)
+
+METADATA_LINE = re.compile(r'^[ \t]*-?[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*:[ \t]*(\S.*)$', re.MULTILINE)
+QUOTED_MAPPING = re.compile(r"""(['"])([^'"\n]+?) – (.*?)\1""")
+SECTION_NAME = re.compile(r"""section_name=(['"])(.*?)\1|focusing on is: (\S+?)\. """)
+DOCUMENTED_FILE = re.compile(r'^\s*\d+\.\s+([A-Za-z0-9_]+?)(?:\.\w+)?\s*$', re.MULTILINE)
+AGGREGATION_CODE = """keys = list(df.select_dtypes(exclude='number').columns[:1])
+agg_df = df.groupby(keys, as_index=False).sum(numeric_only=True) if keys else df"""
+
+
+def _digest(text):
+  return int(hashlib.sha256(text.encode()).hexdigest()[:8], 16)
+
+
+def _prompt_text(messages):
+  # pages and messages are often embedded via their repr, so escaped newlines are turned back into real ones
+  return '\n'.join(str(message.content) for message in messages).replace('\\n', '\n')
+
+
+def _index_items(label, text):
+  match = re.search(label + r': Index\(\[(.*?)\]', text, re.DOTALL)
+  return re.findall(r"'([^']*)'", match.group(1)) if match else []
+
+
+def _section_name(text):
+  match = SECTION_NAME.search(text)
+  return (match.group(2) or match.group(3)) if match else None
+
+
+class FakeChatModel(BaseChatModel):
+  """ Chat model that answers from the prompt alone. `latency` seconds (plus up to `jitter` times that, fixed per
+  prompt) are spent per call; `select_ratio` is the share of columns the field selection marks as selected. """
+
+  model_name: str = 'fake-offline'
+  latency: float = 0.0
+  jitter: float = 0.0
+  select_ratio: float = 1.0
+
+  @property
+  def _llm_type(self):
+    return 'fake-offline'
+
+  def with_structured_output(self, schema, **kwargs):
+    # the schema travels to _generate as a bound call argument; the answer is JSON parsed back into it
+    return self.bind(output_schema=schema.__name__) | RunnableLambda(lambda message: schema.model_validate_json(message.content))
+
+  ######## ------ ANSWERS ------- #########
+
+  def _mappings(self, text):
+    quoted = [f"{code.strip()} – {description.strip()}" for _, code, description in QUOTED_MAPPING.findall(text)]
+    if quoted:  # translation of an earlier mapping: echo it
+      return quoted
+    return [f"{code} – {description.strip()}" for code, description in METADATA_LINE.findall(text)]
+
+  def _selection(self, section_name, entries):
+    reasonings = []
+    for entry in entries:
+      code, _, question = entry.partition(' – ')
+      selected = (_digest(code) % 1000) < self.select_ratio * 1000
+      reasonings.append(ColumnSelectionReasoning(section_name=section_name, column_code=code, column_question=question or code,
+                                                 is_selected=selected, selection_reasoning='Offline benchmark verdict.'))
+    return ColumnSelectionMapping(section_name=section_name, column_selection_mapping=reasonings)
+
+  def _structured_answer(self, schema_name, text):
+    if schema_name == 'ColumnMapping':
+      return ColumnMapping(section_name=_section_name(text), mappings=self._mappings(text))
+    if schema_name == 'ColumnSelectionMapping':
+      return self._selection(_section_name(text), self._mappings(text))
+    if schema_name == 'BatchedColumnSelectionMapping':
+      blocks = re.split(r'^SECTION: (.+)$', text, flags=re.MULTILINE)[1:]
+      return BatchedColumnSelectionMapping(sections=[self._selection(name.strip(), self._mappings(block))
+                                                     for name, block in zip(blocks[::2], blocks[1::2])])
+    if schema_name == 'ColumnRenameMapping':
+      references = {column.lower(): column for column in _index_items('Reference columns', text)}
+      current = _index_items('Current columns', text)
+      return ColumnRenameMapping(mappings={column: references[column.lower()] for column in current
+                                           if column.lower() in references and references[column.lower()] != column})
+    if schema_name == 'FunctionalCode':
+      return FunctionalCode(prefix='Sum numeric columns per entity.', imports='import pandas as pd', code=AGGREGATION_CODE)
+    raise ValueError(f"FakeChatModel has no answer for schema {schema_name}")
+
+  def _text_answer(self, text):
+    if 'DATASET DESCRIPTIONS:' in text:  # Part 1: pick every documented dataset, as a markdown table
+      descriptions = text.split('DATASET DESCRIPTIONS:', 1)[1]
+      names = list(dict.fromkeys(re.findall(r'\b([A-Za-z][A-Za-z0-9_]*): ', descriptions)))
+      rows = [f"| {name} | Documented dataset | Offline benchmark pick |" for name in names]
+      return '\n'.join(['| File Name | Description | Reason |', '| ---------------------- | --- | --- |', *rows])
+    # Part 1: dataset name -> description dictionary from the documentation
+    return '\n'.join(f"{name}: Documented dataset" for name in dict.fromkeys(DOCUMENTED_FILE.findall(text)))
+
+  ######## ------ CHAT MODEL INTERFACE ------- #########
+
+  def _answer(self, messages, output_schema=None):
+    text = _prompt_text(messages)
+    if output_schema is None:
+      content = self._text_answer(text)
+    else:
+      content = json.dumps(self._structured_answer(output_schema, text).model_dump())
+    # rough token counts (4 characters per token), so run reports show plausible usage
+    usage = {'input_tokens': len(text) // 4, 'output_tokens': len(content) // 4, 'total_tokens': (len(text) + len(content)) // 4}
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+  def _delay(self, messages):
+    return self.latency * (1 + self.jitter * (_digest(_prompt_text(messages)) % 1000) / 1000)
+
+  def _generate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, output_schema=None, **kwargs):
+    time.sleep(self._delay(messages))
+    return self._answer(messages, output_schema)
+
+  async def _agenerate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, output_schema=None, **kwargs):
+    await asyncio.sleep(self._delay(messages))
+    return self._answer(messages, output_schema)
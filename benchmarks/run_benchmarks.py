@@ -0,0 +1,212 @@
+# End-to-end benchmark: Part 1/2 and Part 3 on generated bundles of increasing size, with the offline chat model
+# (benchmarks/fake_llm.py) instead of OpenAI/Gemini. Every size runs in a fresh process with empty caches, and the
+# wall time, peak RSS and per-stage breakdown (from the run reports) are written to one JSON file per invocation,
+# so results can be compared across commits.
+#
+# Usage (from the repo root):
+#   python -m benchmarks.run_benchmarks --entities 1000 10000 100000 --rows-per-entity 10 --latency 0.2
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WORK_DIR = os.path.join(REPO_ROOT, 'cache', 'benchmarks')
+DEFAULT_RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+
+def git_revision():
+  try:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT,
+                                capture_output=True, text=True).stdout.strip())
+    return commit or None, dirty
+  except OSError:
+    return None, None
+
+
+def peak_rss_mb(who):
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  peak = resource.getrusage(who).ru_maxrss
+  return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+######## ------ BUNDLES ------- #########
+
+def bundle_files(bundle_dir):
+  """The file_paths dict the web app builds for an uploaded bundle."""
+  data_sections = {}
+  for section in sorted(os.listdir(bundle_dir)):
+    folder_path = os.path.join(bundle_dir, section)
+    if not os.path.isdir(folder_path):
+      continue
+    files = sorted(os.listdir(folder_path))
+    data_sections[section] = {
+      'folder_path': folder_path,
+      'metadata': next((os.path.join(folder_path, f) for f in files if f.endswith('_metadata.pdf')), None),
+      'data': [os.path.join(folder_path, f) for f in files if f.endswith('.csv')],
+    }
+  return {
+    'task_description': os.path.join(bundle_dir, 'task_description.pdf'),
+    'data_documentation': os.path.join(bundle_dir, 'data_documentation.pdf'),
+    'data_sections': data_sections,
+  }
+
+
+def ensure_bundle(work_dir, entities, args):
+  """Generate the bundle for this size once; later runs (and commits) reuse it."""
+  from generate_mock_data import generate
+
+  name = f"bundle_e{entities}_r{args.rows_per_entity}_s{args.shards}_w{args.width}_seed{args.seed}"
+  bundle_dir = os.path.join(work_dir, name)
+  done_marker = os.path.join(bundle_dir, '.complete')
+  if not os.path.exists(done_marker):
+    written = generate(bundle_dir, entities, args.rows_per_entity, args.shards, args.width, seed=args.seed)
+    with open(done_marker, 'w') as f:
+      json.dump({'rows': sum(written.values()), 'files': len(written)}, f)
+  with open(done_marker) as f:
+    return bundle_dir, json.load(f)
+
+
+######## ------ ONE RUN (CHILD PROCESS) ------- #########
+
+def check_result(path, entity_key, entities):
+  """ What the generator guarantees of a correct result: one row per player, keyed by the entity key.
+  Returns the problems found (empty if the result is correct). """
+  from utils.transform_utils import read_frame
+
+  result = read_frame(path)
+  if result.columns[0] != entity_key:
+    return [f"result is keyed by '{result.columns[0]}', not '{entity_key}'"]
+  problems = []
+  if len(result) != entities:
+    problems.append(f"{len(result):,} rows for {entities:,} players")
+  duplicated = int(result[entity_key].duplicated().sum())
+  if duplicated:
+    problems.append(f"{duplicated:,} duplicated '{entity_key}' values")
+  return problems
+
+
+def run_parts(bundle_dir, result_path, entities, latency, jitter, select_ratio):
+  """ Runs in the child, with the run directory as cwd (so caches and outputs start empty). """
+  import pipeline
+  from benchmarks.fake_llm import FakeChatModel
+  from utils.instrumentation import llm_usage_callback
+
+  model = FakeChatModel(latency=latency, jitter=jitter, select_ratio=select_ratio, callbacks=[llm_usage_callback])
+  pipeline.set_llm(model, model)
+  file_paths = bundle_files(bundle_dir)
+  output_dir = os.path.abspath('results')
+  os.makedirs(os.path.join(output_dir, 'metadata'), exist_ok=True)
+
+  parts = {}
+
+  def timed(name, fn, *fn_args):
+    start = time.perf_counter()
+    result = fn(*fn_args)
+    wall_seconds = time.perf_counter() - start
+    with open(result['run_report']) as f:
+      report = json.load(f)
+    parts[name] = {
+      'success': bool(result.get('success')),
+      'wall_seconds': round(wall_seconds, 4),
+      'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),  # process peak so far, so Part 3 includes Part 1/2
+      'stages': report['stages'],
+      'llm': {key: report['llm'][key] for key in ('calls', 'prompt_tokens', 'completion_tokens')},
+      'caches': report.get('caches'),
+    }
+    return result
+
+  part_1_2 = timed('part_1_2', pipeline.run_part_1_2_module_field_selection, file_paths, output_dir)
+  part_3 = timed('part_3', pipeline.run_part_3_transform_data, dict(file_paths, summary_csv=part_1_2['summary_csv']), output_dir)
+  problems = [f"{name} did not succeed" for name, part in parts.items() if not part['success']]
+  if part_3.get('filename'):
+    problems += check_result(os.path.join(output_dir, part_3['filename']), pipeline.ENTITY_KEY, entities)
+  with open(result_path, 'w') as f:
+    json.dump({'parts': parts, 'peak_worker_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN), 'problems': problems}, f)
+
+
+def run_case(bundle_dir, run_dir, entities, args):
+  """ Run both parts in a fresh interpreter; its stdout/stderr go to run.log in the run directory.
+  A run whose result fails the correctness check counts as failed, and its timings are not recorded. """
+  os.makedirs(run_dir, exist_ok=True)
+  result_path = os.path.join(run_dir, 'result.json')
+  command = [sys.executable, '-m', 'benchmarks.run_benchmarks', '--child', bundle_dir, result_path, str(entities),
+             '--latency', str(args.latency), '--jitter', str(args.jitter), '--select-ratio', str(args.select_ratio)]
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+  env.setdefault('OPENAI_API_KEY', 'offline-benchmark')  # never used: every model call goes to the fake model
+  start = time.perf_counter()
+  with open(os.path.join(run_dir, 'run.log'), 'w') as log:
+    process = subprocess.run(command, cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+  wall_seconds = time.perf_counter() - start
+  if process.returncode != 0:
+    return {'success': False, 'error': f"exit code {process.returncode}, see {os.path.join(run_dir, 'run.log')}",
+            'wall_seconds': round(wall_seconds, 4)}
+  with open(result_path) as f:
+    result = json.load(f)
+  if result['problems']:
+    return {'success': False, 'error': f"wrong result: {'; '.join(result['problems'])}", 'wall_seconds': round(wall_seconds, 4)}
+  return dict(result, success=True, wall_seconds=round(wall_seconds, 4))
+
+
+######## ------ DRIVER ------- #########
+
+def main():
+  parser = argparse.ArgumentParser(description='End-to-end pipeline benchmark with an offline chat model')
+  parser.add_argument('--entities', type=int, nargs='+', default=[1000, 10000, 100000], help='bundle sizes (players)')
+  parser.add_argument('--rows-per-entity', type=int, default=5)
+  parser.add_argument('--shards', type=int, default=2)
+  parser.add_argument('--width', type=int, default=4, help='extra stat_* columns per table')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per model call')
+  parser.add_argument('--jitter', type=float, default=0.0, help='extra latency, up to this share of --latency')
+  parser.add_argument('--select-ratio', type=float, default=1.0, help='share of columns the fake selection keeps')
+  parser.add_argument('--work-dir', default=DEFAULT_WORK_DIR, help='generated bundles and per-run outputs')
+  parser.add_argument('--output', default=None, help='results JSON (default: benchmarks/results/<commit>.json)')
+  parser.add_argument('--child', nargs=3, metavar=('BUNDLE', 'RESULT', 'ENTITIES'), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    run_parts(args.child[0], args.child[1], int(args.child[2]), args.latency, args.jitter, args.select_ratio)
+    return
+
+  commit, dirty = git_revision()
+  output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"{(commit or 'unknown')[:12]}{'-dirty' if dirty else ''}.json")
+  results = {
+    'commit': commit,
+    'dirty': dirty,
+    'started_at': time.time(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'config': {key: value for key, value in vars(args).items() if key not in ('child', 'output')},
+    'runs': [],
+  }
+
+  print(f"{'entities':>10} {'rows':>12} {'part 1/2 (s)':>13} {'part 3 (s)':>11} {'peak RSS (MB)':>14} {'LLM calls':>10}")
+  for entities in args.entities:
+    bundle_dir, bundle = ensure_bundle(args.work_dir, entities, args)
+    run_dir = os.path.join(args.work_dir, 'runs', f"{os.path.basename(bundle_dir)}_{int(time.time())}")
+    run = dict(run_case(bundle_dir, run_dir, entities, args), entities=entities, rows=bundle['rows'], files=bundle['files'])
+    results['runs'].append(run)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+      json.dump(results, f, indent=2)  # rewritten after every size, so a crash keeps the finished ones
+
+    if not run['success']:
+      print(f"{entities:>10} {bundle['rows']:>12,} failed: {run['error']}")
+      continue
+    parts = run['parts']
+    print(f"{entities:>10} {bundle['rows']:>12,} {parts['part_1_2']['wall_seconds']:>13.2f} {parts['part_3']['wall_seconds']:>11.2f} "
+          f"{parts['part_3']['peak_rss_mb']:>14.1f} {sum(p['llm']['calls'] for p in parts.values()):>10}")
+  print(f"Results written to {output}")
+  if not all(run['success'] for run in results['runs']):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,11 +1,38 @@
-import pandas as pd
-import numpy as np
+# Synthetic game-analytics upload bundle (task description, data documentation, per-section metadata + data shards).
+#
+# The defaults reproduce the small demo bundle (10 players, one shard per section). For benchmarking, scale it up:
+#   python generate_mock_data.py --entities 1000000 --rows-per-entity 10 --shards 8 --width 20 --formats csv parquet
+# Tables are written in chunks of entities, so the generated size is not limited by memory.
+import argparse
 import os
+
+import numpy as np
+import pandas as pd
 from fpdf import FPDF
 
-# Set up output directory
-base_dir = "data/game_data_upload"
-os.makedirs(base_dir, exist_ok=True)
+BASE_DIR = "data/game_data_upload"
+REGIONS = ['NA', 'EU', 'AS', 'SA']
+CHUNK_ENTITIES = 100_000  # entities generated (and appended to each shard) at a time
+
+# entity key of each source; with key mismatches off, every source uses the canonical one
+CANONICAL_KEY = "player_id"
+SOURCE_KEYS = {
+    "player_stats": "player_id",
+    "game_interactions": "user_id",
+    "forum_discussions": "uid",
+    "sentiment_analysis": "player_handle",
+}
+# per-entity sources write one row per player; the others are long format (rows_per_entity rows per player)
+PER_ENTITY_SOURCES = {"player_stats"}
+# unit of the duration columns (the session time and the extra stat_* columns) in each source
+SOURCE_TIME_UNITS = {
+    "player_stats": "minutes",
+    "game_interactions": "seconds",
+    "forum_discussions": "minutes",
+    "sentiment_analysis": "seconds",
+}
+SECONDS_PER_UNIT = {"seconds": 1, "minutes": 60}
+
 
 # --------- Helper to create PDFs ---------
 def create_pdf(path, text):
@@ -17,7 +44,57 @@ def create_pdf(path, text):
         pdf.multi_cell(0, 10, line)
     pdf.output(path)
 
-# --------- Task Description ---------
+
+# --------- Table schemas ---------
+def source_key(source, key_mismatches=True):
+    return SOURCE_KEYS[source] if key_mismatches else CANONICAL_KEY
+
+
+def source_unit(source, unit_mismatches=True):
+    return SOURCE_TIME_UNITS[source] if unit_mismatches else "minutes"
+
+
+def extra_columns(source, width, unit_mismatches=True):
+    """`width` duration columns shared by every entity source, named with the source's time unit."""
+    unit = source_unit(source, unit_mismatches)
+    return [f"stat_{j}_{unit}" for j in range(width)]
+
+
+def section_schemas(width=0, key_mismatches=True, unit_mismatches=True, rows_per_entity=1):
+    """ {section: [(column, description)]}, in column order. Long-format sections get a `day` column
+    when there is more than one row per entity. """
+    def key(source, description):
+        return (source_key(source, key_mismatches), description)
+
+    def extras(source):
+        return [(col, f"Tracked duration in {source_unit(source, unit_mismatches)}") for col in extra_columns(source, width, unit_mismatches)]
+
+    def day(source):
+        return [("day", "Day index of the record")] if source not in PER_ENTITY_SOURCES and rows_per_entity > 1 else []
+
+    session_unit = source_unit("player_stats", unit_mismatches)
+    interaction_unit = source_unit("game_interactions", unit_mismatches)
+    return {
+        "player_stats": [key("player_stats", "Unique user identifier"),
+                         ("session_length", f"Time in {session_unit}"),
+                         ("level", "Current game level"),
+                         ("region", "Region code"), *extras("player_stats")],
+        "game_interactions": [key("game_interactions", "User identifier (note different name)"), *day("game_interactions"),
+                              ("num_clicks", "Count of user interactions"),
+                              ("items_collected", "Number of in-game items"),
+                              ("time_spent", f"Time spent in {interaction_unit}"), *extras("game_interactions")],
+        "forum_discussions": [key("forum_discussions", "Unique user handle"), *day("forum_discussions"),
+                              ("post_count", "Number of forum posts"),
+                              ("avg_sentiment", "Scaled -1 to 1"), *extras("forum_discussions")],
+        "market_forecasts": [("region_code", "Game region"),
+                             ("forecast_score", "Marketing engagement forecast")],
+        "sentiment_analysis": [key("sentiment_analysis", "User name"), *day("sentiment_analysis"),
+                               ("mood_score", "Aggregated mood score from forums and reviews"),
+                               ("anger_index", "Relative anger (0-100)"), *extras("sentiment_analysis")],
+    }
+
+
+# --------- Documents ---------
 task_description_text = (
     "TASK: Analyze cross-source game analytics data to understand user engagement drivers.\n"
     "We want to:\n"
@@ -26,151 +103,160 @@ task_description_text = (
     "- Correlate forum activity with in-game performance.\n"
     "- Link market forecasts with gameplay patterns.\n"
 )
-create_pdf(os.path.join(base_dir, "task_description.pdf"), task_description_text)
-
-# --------- Data Documentation ---------
-documentation_text = (
-    "DATA DOCUMENTATION\n"
-    "==================\n\n"
-    "1. player_stats.csv\n"
-    "- player_id: Unique user identifier\n"
-    "- session_length: Time in minutes\n"
-    "- level: Current game level\n"
-    "- region: Region code\n\n"
-    "2. game_interactions.csv\n"
-    "- user_id: User identifier (note different name)\n"
-    "- num_clicks: Count of user interactions\n"
-    "- items_collected: Number of in-game items\n"
-    "- time_spent: Time spent in seconds\n\n"
-    "3. forum_discussions.csv\n"
-    "- uid: Unique user handle\n"
-    "- post_count: Number of forum posts\n"
-    "- avg_sentiment: Scaled -1 to 1\n\n"
-    "4. market_forecasts.csv\n"
-    "- region_code: Game region\n"
-    "- forecast_score: Marketing engagement forecast\n\n"
-    "5. sentiment_analysis.csv\n"
-    "- player_handle: User name\n"
-    "- mood_score: Aggregated mood score from forums and reviews\n"
-    "- anger_index: Relative anger (0-100)\n"
-)
-create_pdf(os.path.join(base_dir, "data_documentation.pdf"), documentation_text)
-
-# --------- Section-specific metadata ---------
-section_metadata = {
-    "player_stats": "player_id (int), session_length (minutes), level (int), region (string)",
-    "game_interactions": "user_id (string), num_clicks (int), items_collected (int), time_spent (seconds)",
-    "forum_discussions": "uid (string), post_count (int), avg_sentiment (-1 to 1 float)",
-    "market_forecasts": "region_code (string), forecast_score (float 0-1)",
-    "sentiment_analysis": "player_handle (string), mood_score (float), anger_index (0-100 int)"
-}
 
-for section, text in section_metadata.items():
+
+def documentation_text(schemas):
+    lines = ["DATA DOCUMENTATION", "==================", ""]
+    for i, (section, columns) in enumerate(schemas.items(), start=1):
+        lines.append(f"{i}. {section}.csv")
+        lines.extend(f"- {col}: {description}" for col, description in columns)
+        lines.append("")
+    return '\n'.join(lines)
+
+
+def metadata_text(section, columns):
+    # one "Section 1" heading per file, so the local section scan maps it without a model call
+    return f"SECTION 1: METADATA FOR {section.upper()}\n\n" + '\n'.join(f"{col}: {description}" for col, description in columns)
+
+
+def write_documents(base_dir, schemas):
+    create_pdf(os.path.join(base_dir, "task_description.pdf"), task_description_text)
+    create_pdf(os.path.join(base_dir, "data_documentation.pdf"), documentation_text(schemas))
+    for section, columns in schemas.items():
+        folder = os.path.join(base_dir, section)
+        os.makedirs(folder, exist_ok=True)
+        create_pdf(os.path.join(folder, f"{section}_metadata.pdf"), metadata_text(section, columns))
+
+
+# --------- Data tables ---------
+def generate_rows(section, entity_ids, rng, rows_per_entity=1, width=0, key_mismatches=True, unit_mismatches=True):
+    """One chunk of `section` for the given entity numbers, as a DataFrame (columns in schema order)."""
+    if section not in PER_ENTITY_SOURCES:
+        days = np.tile(np.arange(rows_per_entity), len(entity_ids))
+        entity_ids = np.repeat(entity_ids, rows_per_entity)
+    n = len(entity_ids)
+    data = {source_key(section, key_mismatches): np.char.add("user_", entity_ids.astype(str))}
+    if section not in PER_ENTITY_SOURCES and rows_per_entity > 1:
+        data["day"] = days
+
+    if section == "player_stats":
+        data["session_length"] = rng.integers(5, 180, n) * 60 // SECONDS_PER_UNIT[source_unit(section, unit_mismatches)]
+        data["level"] = rng.integers(1, 50, n)
+        data["region"] = rng.choice(REGIONS, n)
+    elif section == "game_interactions":
+        data["num_clicks"] = rng.integers(10, 500, n)
+        data["items_collected"] = rng.integers(0, 100, n)
+        data["time_spent"] = rng.integers(100, 10000, n) // SECONDS_PER_UNIT[source_unit(section, unit_mismatches)]
+    elif section == "forum_discussions":
+        data["post_count"] = rng.integers(0, 50, n)
+        data["avg_sentiment"] = np.round(rng.uniform(-1, 1, n), 2)
+    elif section == "sentiment_analysis":
+        data["mood_score"] = np.round(rng.uniform(-1, 1, n), 2)
+        data["anger_index"] = rng.integers(0, 100, n)
+
+    # the same underlying durations (in seconds), expressed in each source's unit
+    seconds_per_unit = SECONDS_PER_UNIT[source_unit(section, unit_mismatches)]
+    for col in extra_columns(section, width, unit_mismatches):
+        data[col] = np.round(rng.gamma(2.0, 300.0, n) / seconds_per_unit, 2)
+    return pd.DataFrame(data)
+
+
+class ShardWriter:
+    """Appends chunks to one data file; Parquet chunks become row groups of a single file."""
+
+    def __init__(self, path, file_format):
+        self.path = path
+        self.file_format = file_format
+        self.rows = 0
+        self._parquet_writer = None
+
+    def write(self, df):
+        if self.file_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+        self.rows += len(df)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def write_section(base_dir, section, num_entities, rows_per_entity=1, shards=1, width=0, key_mismatches=True,
+                  unit_mismatches=True, formats=('csv',), seed=0, chunk_entities=CHUNK_ENTITIES):
+    """ Write `shards` data files per format for one section; entities are split into contiguous ranges, one per shard.
+    Every chunk has its own seeded generator, so the output depends only on the arguments. Returns {path: rows}. """
     folder = os.path.join(base_dir, section)
     os.makedirs(folder, exist_ok=True)
-    create_pdf(os.path.join(folder, f"{section}_metadata.pdf"), f"METADATA FOR {section.upper()}\n\n{text}")
-
-# --------- Generate CSV data tables ---------
-n = 10
-regions = ['NA', 'EU', 'AS', 'SA']
-
-# player_stats.csv
-player_stats = pd.DataFrame({
-    "player_id": [f"user_{i}" for i in range(n)],
-    "session_length": np.random.randint(5, 180, n),
-    "level": np.random.randint(1, 50, n),
-    "region": np.random.choice(regions, n)
-})
-player_stats.to_csv(os.path.join(base_dir, "player_stats", "player_stats_0.csv"), index=False)
-
-# game_interactions.csv
-game_interactions = pd.DataFrame({
-    "user_id": [f"user_{i}" for i in range(n)],
-    "num_clicks": np.random.randint(10, 500, n),
-    "items_collected": np.random.randint(0, 100, n),
-    "time_spent": np.random.randint(100, 10000, n)
-})
-game_interactions.to_csv(os.path.join(base_dir, "game_interactions", "game_interactions_0.csv"), index=False)
-
-# forum_discussions.csv
-forum_discussions = pd.DataFrame({
-    "uid": [f"user_{i}" for i in range(n)],
-    "post_count": np.random.randint(0, 50, n),
-    "avg_sentiment": np.round(np.random.uniform(-1, 1, n), 2)
-})
-forum_discussions.to_csv(os.path.join(base_dir, "forum_discussions", "forum_discussions_0.csv"), index=False)
-
-# market_forecasts.csv
-market_forecasts = pd.DataFrame({
-    "region_code": regions,
-    "forecast_score": np.round(np.random.uniform(0, 1, len(regions)), 2)
-})
-market_forecasts.to_csv(os.path.join(base_dir, "market_forecasts", "market_forecasts_0.csv"), index=False)
-
-# sentiment_analysis.csv
-sentiment_analysis = pd.DataFrame({
-    "player_handle": [f"user_{i}" for i in range(n)],
-    "mood_score": np.round(np.random.uniform(-1, 1, n), 2),
-    "anger_index": np.random.randint(0, 100, n)
-})
-sentiment_analysis.to_csv(os.path.join(base_dir, "sentiment_analysis", "sentiment_analysis_0.csv"), index=False)
-
-# import pandas as pd
-# import numpy as np
-# import os
-# import json
-
-# # Set up directory structure
-# base_dir = "data/test_uploads"
-# os.makedirs(base_dir, exist_ok=True)
-
-# # Create sample task description
-# with open(os.path.join(base_dir, "task_description.txt"), "w") as f:
-#     f.write("Merge and unify household and community-level data to prepare for a poverty analysis task.")
-
-# # Create sample data documentation
-# with open(os.path.join(base_dir, "data_documentation.txt"), "w") as f:
-#     f.write("This dataset includes household and community information from a survey in Region X.\n"
-#             "Each section includes metadata and data files. Column names follow the sXXqYY format.\n"
-#             "You should use metadata files to match column codes with question text.")
-
-# # Generate metadata and data for two sections: household and community
-# sections = {
-#     "GSEC1": {
-#         "metadata": {
-#             "s01q01": "How many people live in the household?",
-#             "s01q02": "What is the household's main source of income?",
-#             "s01q03": "Is the household head employed?"
-#         },
-#         "data": pd.DataFrame({
-#             "s01q01": np.random.randint(1, 10, 5),
-#             "s01q02": np.random.choice(["farming", "business", "employment"], 5),
-#             "s01q03": np.random.choice([True, False], 5)
-#         })
-#     },
-#     "GSEC2": {
-#         "metadata": {
-#             "s02q01": "What is the primary language spoken in the village?",
-#             "s02q02": "Is there a health clinic in the village?",
-#             "s02q03": "What type of roads connect the village?"
-#         },
-#         "data": pd.DataFrame({
-#             "s02q01": np.random.choice(["Luganda", "Swahili", "English"], 5),
-#             "s02q02": np.random.choice([True, False], 5),
-#             "s02q03": np.random.choice(["paved", "dirt", "gravel"], 5)
-#         })
-#     }
-# }
-
-# # Save metadata and data
-# for section, content in sections.items():
-#     folder = os.path.join(base_dir, section)
-#     os.makedirs(folder, exist_ok=True)
-
-#     # Metadata
-#     with open(os.path.join(folder, f"{section}_metadata.json"), "w") as f:
-#         json.dump(content["metadata"], f, indent=2)
-
-#     # Data
-#     for i in range(2):  # Save two copies of each dataset
-#         content["data"].to_csv(os.path.join(folder, f"{section}_data_{i}.csv"), index=False)
\ No newline at end of file
+    section_index = list(section_schemas()).index(section)
+
+    if section == "market_forecasts":  # one row per region, not per entity
+        rng = np.random.default_rng([seed, section_index])
+        df = pd.DataFrame({"region_code": REGIONS, "forecast_score": np.round(rng.uniform(0, 1, len(REGIONS)), 2)})
+        written = {}
+        for file_format in formats:
+            writer = ShardWriter(os.path.join(folder, f"{section}_0.{file_format}"), file_format)
+            writer.write(df)
+            writer.close()
+            written[writer.path] = writer.rows
+        return written
+
+    bounds = np.linspace(0, num_entities, shards + 1).astype(np.int64)
+    written = {}
+    for shard in range(shards):
+        writers = [ShardWriter(os.path.join(folder, f"{section}_{shard}.{file_format}"), file_format) for file_format in formats]
+        for chunk, start in enumerate(range(bounds[shard], bounds[shard + 1], chunk_entities)):
+            entity_ids = np.arange(start, min(start + chunk_entities, bounds[shard + 1]))
+            rng = np.random.default_rng([seed, section_index, shard, chunk])
+            df = generate_rows(section, entity_ids, rng, rows_per_entity, width, key_mismatches, unit_mismatches)
+            for writer in writers:
+                writer.write(df)
+        for writer in writers:
+            writer.close()
+            written[writer.path] = writer.rows
+    return written
+
+
+def generate(base_dir=BASE_DIR, num_entities=10, rows_per_entity=1, shards=1, width=0, key_mismatches=True,
+             unit_mismatches=True, formats=('csv',), seed=0, chunk_entities=CHUNK_ENTITIES):
+    """Write the whole bundle under `base_dir`. Returns {data file path: rows}."""
+    os.makedirs(base_dir, exist_ok=True)
+    schemas = section_schemas(width, key_mismatches, unit_mismatches, rows_per_entity)
+    write_documents(base_dir, schemas)
+    written = {}
+    for section in schemas:
+        section_written = write_section(base_dir, section, num_entities, rows_per_entity, shards, width, key_mismatches,
+                                        unit_mismatches, formats, seed, chunk_entities)
+        print(f"Wrote {section}: {len(section_written)} files, {sum(section_written.values()):,} rows")
+        written.update(section_written)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic game-analytics upload bundle')
+    parser.add_argument('--output', default=BASE_DIR, help='bundle folder')
+    parser.add_argument('--entities', type=int, default=10, help='number of players')
+    parser.add_argument('--rows-per-entity', type=int, default=1, help='rows per player in the long-format tables')
+    parser.add_argument('--shards', type=int, default=1, help='data files per section')
+    parser.add_argument('--width', type=int, default=0, help='extra stat_* columns per player table')
+    parser.add_argument('--key-mismatches', action=argparse.BooleanOptionalAction, default=True,
+                        help='give every source its own key name (player_id / user_id / uid / player_handle)')
+    parser.add_argument('--unit-mismatches', action=argparse.BooleanOptionalAction, default=True,
+                        help='report durations in minutes in some sources and in seconds in others')
+    parser.add_argument('--formats', nargs='+', choices=['csv', 'parquet'], default=['csv'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-entities', type=int, default=CHUNK_ENTITIES, help='players generated per write')
+    args = parser.parse_args()
+
+    written = generate(args.output, args.entities, args.rows_per_entity, args.shards, args.width, args.key_mismatches,
+                       args.unit_mismatches, args.formats, args.seed, args.chunk_entities)
+    print(f"Wrote {len(written)} data files, {sum(written.values()):,} rows in total, to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -344,6 +344,10 @@ aggregation_instructions = """These are the suggested aggregated columns for tra
 
 Columns you will ALWAYS need are:
 - player_id
+"""
 
-The dataset to transform is found at {data_file_path}.
+# WHERE THE AGGREGATION CODE FINDS ITS INPUT
+# The filtered dataset is injected into the execution namespace, so the generated code never reads it from disk.
+aggregation_input_instructions = """The dataset to transform is ALREADY LOADED as a pandas DataFrame in a variable named `{df_name}`.
+Use `{df_name}` directly. Do NOT read the dataset from any file (no pd.read_csv / pd.read_feather / open) and do not reassign `{df_name}` from disk.
 """
@@ -1,6 +1,6 @@
 # This file contains prompt templates to use Langchain for GenAI generations.
 
-from models.return_models import ColumnMapping, ColumnSelectionMapping, ColumnSelectionReasoning
+from models.return_models import ColumnMapping, ColumnSelectionMapping, ColumnSelectionReasoning, BatchedColumnSelectionMapping
 from langchain_core.prompts import ChatPromptTemplate
 
 ######## ------ PART 2: RELEVANT FIELD SELECTION ------- #########
@@ -59,6 +59,26 @@ field_selection_prompt_template = ChatPromptTemplate.from_messages(
     ]
 ).partial(model_json_schema=ColumnSelectionMapping.model_json_schema())
 
+# SELECTION, SEVERAL SECTIONS PER REQUEST (instructions and schema are sent once for all of them)
+batched_field_selection_prompt_template = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are an expert field selection algorithm. "
+            "Given your instructions, please indicate whether or not you would include each field and WHY. "
+            "Be lenient and accept more than you would want to. "
+            "If you do not know if a field is useful, "
+            "do not select it, but explain your confusion. "
+            "You are given the mappings of SEVERAL sections. Answer every section separately: "
+            "return one entry per section, with section_name exactly as given, and cover every field of that section. "
+            "Output your answer as JSON that  "
+            "matches the given schema: \`\`\`json\n{model_json_schema}\n\`\`\`. "
+            "Make sure to wrap the answer in \`\`\`json and \`\`\` tags",
+        ),
+        ("human", "{text}"),
+    ]
+).partial(model_json_schema=BatchedColumnSelectionMapping.model_json_schema())
+
 
 ######## ------ PART 3: DATASET TRANSFORMATION (AGGREGATION) ------- #########
 
@@ -74,6 +74,15 @@ class ColumnSelectionMapping(BaseModel):
     section_name: Optional[str] = Field(default=None, description="The name of the section")
     column_selection_mapping: Optional[List[ColumnSelectionReasoning]]
 
+class BatchedColumnSelectionMapping(BaseModel):
+    """One ColumnSelectionMapping per section, for a request that packs several sections together.
+    ex:
+    sections: [ColumnSelectionMapping(section_name=GSEC1A, ...), ColumnSelectionMapping(section_name=GSEC2, ...)]
+    """
+    sections: Optional[List[ColumnSelectionMapping]] = Field(
+        default=None, description="One entry per section given, with section_name exactly as given"
+    )
+
 
 
 ######## ------ PART 3: DATASET TRANSFORMATION (AGGREGATION) ------- #########
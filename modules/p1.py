@@ -1,5 +1,7 @@
 # This file contains all functions for PART 1: RELEVANT MODULE SELECTION
-async def find_relevant_datasets(spec_file_path, dataset_details_path):
+from utils.instrumentation import llm_usage_callback, span
+
+async def find_relevant_datasets(spec_file_path, dataset_details_path, llm=None):
     """
     Function to identify relevant dataset files based on specifications using LLM parsing.
     Also summarizes the specifications.
@@ -7,6 +9,7 @@ async def find_relevant_datasets(spec_file_path, dataset_details_path):
     Args:
         spec_file_path (str): Path to the PDF containing specifications
         dataset_details_path (str): Path to the PDF containing dataset details
+        llm (BaseChatModel, optional): Chat model to use instead of gpt-4o
 
     Returns:
         tuple: (list of relevant dataset names, specification summary)
@@ -45,7 +48,7 @@ async def find_relevant_datasets(spec_file_path, dataset_details_path):
     async for page in dataset_loader.alazy_load():
         dataset_pages.append(page)
 
-    llm = ChatOpenAI(model="gpt-4o")
+    llm = llm or ChatOpenAI(model="gpt-4o", callbacks=[llm_usage_callback])
     dataset_descriptions = ChatPromptTemplate.from_template(
         """Look through this dataset document for any section that talks about dataset
         files or data information. Make a dictionary with all the dataset names and then
@@ -125,8 +128,9 @@ def extract_dataset_names_from_markdown(lines):
     return dataset_names
 
 
-async def analyze_datasets(spec_file, dataset_file):
-      relevant_files, all_datasets, dataset_names = await find_relevant_datasets(spec_file, dataset_file)
+async def analyze_datasets(spec_file, dataset_file, llm=None):
+      with span('part_1.find_relevant_datasets'):
+          relevant_files, all_datasets, dataset_names = await find_relevant_datasets(spec_file, dataset_file, llm)
 
       print("\n=== RELEVANT DATASET FILES ===")
       for file in dataset_names:
@@ -11,27 +11,86 @@ Original file is located at
 
 import pandas as pd
 import os
-from utils.pipeline_utils import load_pdf, extract_all_sections, load_xls, sheet_to_text, map_section_to_page_number, parquet_viewer, run_code_and_capture_df
+from utils.pipeline_utils import load_pdf, extract_all_sections, load_xls, sheet_to_text, map_section_to_page_number, parquet_viewer, run_code_and_capture_df, estimate_tokens, pack_by_token_budget, read_task_description
 import google.generativeai as genai
 import nest_asyncio
 import asyncio
 
-from langchain_templates import info_extraction_prompt_template, translation_prompt_template, field_selection_prompt_template, aggregation_code_gen_template, column_rename_mapping_template
+from langchain_templates import info_extraction_prompt_template, translation_prompt_template, field_selection_prompt_template, batched_field_selection_prompt_template, aggregation_code_gen_template, column_rename_mapping_template
 from models.models import Category
-from models.return_models import ColumnMapping, ColumnSelectionMapping, FunctionalCode, ColumnRenameMapping
-from instructions import column_mapping_instructions, field_selection_instructions, aggregation_instructions
+from models.return_models import ColumnMapping, ColumnSelectionMapping, ColumnSelectionReasoning, BatchedColumnSelectionMapping, FunctionalCode, ColumnRenameMapping
+from instructions import column_mapping_instructions, field_selection_instructions, aggregation_instructions, aggregation_input_instructions
 
 from langchain.chat_models import init_chat_model
 
 from modules.p1 import analyze_datasets, find_relevant_datasets
+from utils.llm_cache import cached_structured_output, llm_cache, get_model_name
+from utils.transform_utils import (rename_columns, merge_entity_frames, aggregate_by_key, rule_based_aggregate,
+                                   write_frame, optimize_dtypes, widen_dtypes, frame_memory)
+from utils.code_cache import code_cache, schema_signature
+from utils.job_queue import report_progress
+from utils.part3_manifest import part_3_manifest
+from utils.cache_utils import stable_hash
+from utils.instrumentation import llm_usage_callback, recorded_run, span
+from utils.column_prefilter import ColumnPrefilter, split_mapping
+from utils.schema_matcher import SCHEMA_MATCHER_ENABLED, rename_profiles, schema_matcher
+from utils.key_discovery import KEY_DISCOVERY_ENABLED, discover_join_keys
+from utils.column_profiler import describe_column, profiles_for_files
+from utils.spill_join import PART_3_SPILL, SpillJoin
+from utils.part3_workers import PART_3_WORKERS, FilePreparer
 
 UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER") or 'uploads'
 SUMMARY_PATH = 'summary.csv'
 STATIC_FOLDER = os.getenv("STATIC_FOLDER") or 'static'
 OUTPUT_METADATA_PATH = 'metadata'
-llm = init_chat_model("gpt-4o-mini", model_provider="openai")
+FIELD_SELECTION_CONCURRENCY = int(os.getenv("FIELD_SELECTION_CONCURRENCY") or 8)
+FIELD_SELECTION_BATCH_TOKENS = int(os.getenv("FIELD_SELECTION_BATCH_TOKENS") or 0)  # prompt budget for packing sections into one selection call; 0 = one call per section
+COLUMN_PREFILTER_MARGIN = float(os.getenv("COLUMN_PREFILTER_MARGIN") or 0)  # skip columns scoring below this share of their section's best (e.g. 0.1); 0 = off
+COLUMN_PREFILTER_MIN_KEEP = int(os.getenv("COLUMN_PREFILTER_MIN_KEEP") or 3)  # best-scoring columns per section that always reach the LLM
+PART_3_CHUNKSIZE = int(os.getenv("PART_3_CHUNKSIZE") or 0)  # rows per read_csv chunk in Part 3; 0 reads in one go
+RULE_BASED_AGGREGATION = (os.getenv("RULE_BASED_AGGREGATION") or 'true').lower() == 'true'  # skip the coding LLM for common table shapes
+RULE_BASED_NUMERIC_AGG = os.getenv("RULE_BASED_NUMERIC_AGG") or 'sum'
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT") or 'csv'  # 'csv' or 'parquet' for the final dataset
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION") or 'zstd'
+INTERMEDIATE_FORMAT = 'feather' if OUTPUT_FORMAT == 'parquet' else 'csv'  # filtered per-file tables in results/metadata
+WRITE_INTERMEDIATE_FILES = (os.getenv("WRITE_INTERMEDIATE_FILES") or 'false').lower() == 'true'
+COMPACT_DTYPES = (os.getenv("COMPACT_DTYPES") or 'true').lower() == 'true'  # downcast / categorize Part 3 frames after reading
+AGGREGATION_INPUT_NAME = 'df'  # name of the filtered DataFrame inside the generated aggregation code
+ENTITY_KEY = 'player_id'
+MERGE_KEYS = ['player_handle', 'uid', 'user_id', 'player_id'] # eventually will be summary_df['merge_key'].unique()
+# ✅ Normalize all ID columns to 'player_id' -> this can be LLMized too
+ALIAS_KEYS = {
+  'player_code': 'player_id',
+  'user_id': 'player_id',
+  'uid': 'player_id',
+  'player_handle': 'player_id'
+}
+LLM_MODEL = os.getenv("LLM_MODEL") or "gpt-4o-mini"
+_llm = None  # created on first use, so importing this module needs no API key
+_part_1_llm = None  # None: Part 1 builds its own gpt-4o client
+
+def get_llm():
+  global _llm
+  if _llm is None:
+    _llm = init_chat_model(LLM_MODEL, model_provider="openai", callbacks=[llm_usage_callback])
+  return _llm
+
+def set_llm(model, part_1_model=None):
+  """ Use `model` for Parts 2 and 3 (and `part_1_model` for Part 1), e.g. the offline stand-in in benchmarks/. """
+  global _llm, _part_1_llm
+  _llm, _part_1_llm = model, part_1_model
 
 def run_part_1_2_module_field_selection(file_paths, output_dir):
+  """ Part 1/2, with a run report (stage timings, LLM calls and tokens) written next to the other metadata. """
+  report_path = os.path.join(output_dir, OUTPUT_METADATA_PATH, 'run_report_part_1_2.json')
+  with recorded_run('part_1_2', report_path) as run:
+    result = _run_part_1_2_module_field_selection(file_paths, output_dir)
+    run.extra['caches'] = {'llm_cache': llm_cache.stats()}
+    # columns the lexical pre-filter deselected without asking the LLM, so its recall cost stays visible
+    run.extra['column_prefilter'] = {'margin': COLUMN_PREFILTER_MARGIN, 'skipped_columns': result.get('prefilter_skipped_columns', 0)}
+  return dict(result, run_report=report_path)
+
+def _run_part_1_2_module_field_selection(file_paths, output_dir):
   """ Check inputs  """
   for path in file_paths:
         print(f"Processing {path}...")
@@ -52,8 +111,9 @@ def run_part_1_2_module_field_selection(file_paths, output_dir):
   selected_sections = []
 
   print(f"Analyzing datasets in {dataset_file} to determine relevant ones....")
+  report_progress("Selecting relevant modules", 0.05)
   print(f"Using {spec_file} to guide 'relevancy'....")
-  relevant_files, all_datasets, dataset_names = asyncio.run(analyze_datasets(spec_file, dataset_file))
+  relevant_files, all_datasets, dataset_names = asyncio.run(analyze_datasets(spec_file, dataset_file, _part_1_llm))
   print("The selected sections we proceed with are", dataset_names)
 
   selected_sections = dataset_names
@@ -74,16 +134,15 @@ def run_part_1_2_module_field_selection(file_paths, output_dir):
   section_pdf_page_maps = {}
   list_reasons = []
 
-  mapping_llm = llm.with_structured_output(schema=ColumnMapping)
-  selection_llm = llm.with_structured_output(schema=ColumnSelectionMapping)
+  # structured calls go through the on-disk cache, so re-uploads of the same bundle skip the model
+  mapping_llm = cached_structured_output(get_llm(), ColumnMapping)
+  selection_llm = cached_structured_output(get_llm(), ColumnSelectionMapping)
+  batched_selection_llm = cached_structured_output(get_llm(), BatchedColumnSelectionMapping)
 
-  # this block of code (eventually will be put in a function) 1) extracts the column code-question mapping
-  # and 2) selects relevant fields with reasoning
+  # this block of code 1) extracts the column code-question mapping and 2) selects relevant fields with reasoning.
+  # The page maps are built first, then every (category, section) pair is scheduled concurrently.
+  section_jobs = []
   for category in data_sections.keys():  # ex. agriculture vs household
-    print("Selecting relevant fields from category", category)
-    folder_path = data_sections[category]['folder_path']
-    # category_prefix = data_sections[category].prefix
-    category_prefix = category
     metadata_path = data_sections[category]['metadata']
 
     # DO ONCE FOR EACH DATA TABLE (SECTION)
@@ -91,39 +150,46 @@ def run_part_1_2_module_field_selection(file_paths, output_dir):
       section_pdf_page_map = section_pdf_page_maps[category]
     else:  # otherwise create from scratch
       # list_of_sections = extract_all_sections(folder_path, category_prefix)
-      section_pdf_page_map = map_section_to_page_number(metadata_path)
+      with span('part_2.section_map', category=category):
+        section_pdf_page_map = map_section_to_page_number(metadata_path)
       print("Determined a mapping of section to metadata page with info on it...", section_pdf_page_map)
       section_pdf_page_maps[category] = section_pdf_page_map
 
-    section_fields_dict = {}
-    section_question_mappings = {}
     for section in section_pdf_page_map: # for each section (eventually this list will depend on phase 1)
-      full_section_name = category_prefix + section.upper()
-      # if full_section_name not in selected_sections:  # only select for selected sections
-      #   continue
-      print("Working on", full_section_name, "...")
-      section_questionnaire_pages = [page.page_content for page in load_pdf(metadata_path, section_pdf_page_map[section])]
-      section_text = f"The section that we are focusing on is: {section}. "
-
-      # determine column mapping
-      prompt = info_extraction_prompt_template.invoke({"text": '\n\n'.join([section_text, column_mapping_instructions, * section_questionnaire_pages])})
-      mapping = mapping_llm.invoke(prompt) # column mapping in the language
-      prompt = translation_prompt_template.invoke({"text": mapping})
-      mapping = mapping_llm.invoke(prompt) # column mapping in English SHOULD THIS BE TRANSLATION LLM (BUG?)
-      section_question_mappings[mapping.section_name] = mapping
-
-      # now, select relevant fields
-      prompt = field_selection_prompt_template.invoke({"text": '\n\n'.join([field_selection_instructions, str(mapping)])})
-      print("prompt", prompt)
-      fields_with_reasoning = selection_llm.invoke(prompt)
-      print("Selected fields, with reasoning:", fields_with_reasoning, '\n')
-      section_fields_dict[mapping.section_name] = fields_with_reasoning
-      list_reasons.extend(fields_with_reasoning.column_selection_mapping)
-
-    fields_dict[category] = section_fields_dict
-    question_map[category] = section_question_mappings
-
-    print("Our dict of sections containing fields + selection reasoning: ", section_fields_dict)
+      section_jobs.append((category, section, metadata_path, section_pdf_page_map[section]))
+
+  report_progress(f"Selecting fields in {len(section_jobs)} sections", 0.2)
+  print(f"Selecting relevant fields from {len(section_jobs)} sections across {len(data_sections)} categories "
+        f"(concurrency {FIELD_SELECTION_CONCURRENCY})")
+  # model-free pre-filter: columns that share (almost) nothing with the task never reach the selection LLM
+  column_filter = None
+  if COLUMN_PREFILTER_MARGIN > 0:
+    task_text = '\n'.join([read_task_description(spec_file), field_selection_instructions])
+    column_filter = ColumnPrefilter(task_text, COLUMN_PREFILTER_MARGIN, COLUMN_PREFILTER_MIN_KEEP)
+  # every data file is streamed once into per-column profiles (cached by file hash); the prompts get their statistics
+  with span('part_2.profile_columns'):
+    column_profiles = profiles_for_files([path for category in data_sections for path in data_sections[category].get('data', [])])
+  section_results = asyncio.run(select_fields_for_sections(section_jobs, mapping_llm, selection_llm, FIELD_SELECTION_CONCURRENCY,
+                                                          batched_selection_llm, FIELD_SELECTION_BATCH_TOKENS, column_filter,
+                                                          column_profiles))
+  if column_filter is not None:
+    print(f"Pre-filter skipped {column_filter.skipped_columns} of {column_filter.seen_columns} columns before the selection LLM")
+
+  # results come back in the same order as section_jobs; a failed section does not sink the others
+  failed_sections = []
+  for (category, section, _, _), section_result in zip(section_jobs, section_results):
+    if isinstance(section_result, Exception):
+      print(f"⚠️ Field selection failed for {category + section.upper()}: {section_result!r}")
+      failed_sections.append(category + section.upper())
+      continue
+    mapping, fields_with_reasoning = section_result
+    question_map.setdefault(category, {})[mapping.section_name] = mapping
+    fields_dict.setdefault(category, {})[mapping.section_name] = fields_with_reasoning
+    list_reasons.extend(fields_with_reasoning.column_selection_mapping or [])
+
+  print("Our dict of sections containing fields + selection reasoning: ", fields_dict)
+
+  print("LLM cache stats:", llm_cache.stats())
 
   ######## POST-PROCESSING INTO DFs ########
   OUTPUT_METADATA_PATH = 'metadata'
@@ -135,11 +201,9 @@ def run_part_1_2_module_field_selection(file_paths, output_dir):
   #   list_reasons.extend(section_fields_dict[section].column_selection_mapping)
   summary_df = pd.DataFrame.from_records(vars(o) for o in list_reasons)
   
-  # save to result and static folders
+  # save to the run's result folder (the app serves it from there, per job)
   summary_csv_path = os.path.join(output_dir, OUTPUT_METADATA_PATH, SUMMARY_PATH)
   summary_df.to_csv(summary_csv_path)
-  summary_static_path = os.path.join('static', 'summary.csv')
-  summary_df.to_csv(summary_static_path)
 
   # question maps
   question_map_parsed_dict = {}
@@ -167,14 +231,204 @@ def run_part_1_2_module_field_selection(file_paths, output_dir):
         'summary_csv': summary_csv_path,
         'question_map_csv': cur_question_map_path,
         'selected_sections': selected_sections,
+        'failed_sections': failed_sections,
+        'prefilter_skipped_columns': column_filter.skipped_columns if column_filter is not None else 0,
         'field_summary': summary_df.head(10).to_dict(orient='records')
     }
 
+async def map_section_fields(category, section, metadata_path, page_indices, mapping_llm):
+  """ Build the column code -> question mapping of one section (in the source language, then translated). """
+  full_section_name = category + section.upper()
+  print("Working on", full_section_name, "...")
+  section_questionnaire_pages = [page.page_content for page in await asyncio.to_thread(load_pdf, metadata_path, page_indices)]
+  section_text = f"The section that we are focusing on is: {section}. "
+
+  # determine column mapping
+  prompt = info_extraction_prompt_template.invoke({"text": '\n\n'.join([section_text, column_mapping_instructions, * section_questionnaire_pages])})
+  with span('part_2.column_mapping', section=full_section_name):
+    mapping = await mapping_llm.ainvoke(prompt) # column mapping in the language
+  prompt = translation_prompt_template.invoke({"text": mapping})
+  with span('part_2.translation', section=full_section_name):
+    mapping = await mapping_llm.ainvoke(prompt) # column mapping in English SHOULD THIS BE TRANSLATION LLM (BUG?)
+  return mapping
+
+
+def prefilter_mapping(mapping, column_filter, column_profiles=None):
+  """ Split a section mapping into the columns the LLM still has to judge and ColumnSelectionReasonings for
+  the columns ruled out locally: empty in the data files (per the column profiles) or by the lexical pre-filter. """
+  if not mapping.mappings:
+    return mapping, []
+  kept, rejected = [], []
+  for entry in mapping.mappings:
+    code, question = split_mapping(entry)
+    profile = (column_profiles or {}).get(code)
+    if profile is not None and profile['dtype'] == 'empty':
+      rejected.append(ColumnSelectionReasoning(
+        section_name=mapping.section_name, column_code=code, column_question=question, is_selected=False,
+        selection_reasoning=f"Column is empty in the data files ({profile['rows']:,} rows, all missing)."))
+    else:
+      kept.append(entry)
+  if column_filter is None:
+    return mapping.model_copy(update={'mappings': kept}), rejected
+  kept, skipped = column_filter.split(kept)
+  for entry, score in skipped:
+    code, question = split_mapping(entry)
+    rejected.append(ColumnSelectionReasoning(
+      section_name=mapping.section_name, column_code=code, column_question=question, is_selected=False,
+      selection_reasoning=f"Skipped by the lexical pre-filter: (almost) no overlap with the task description (score {score:.2f})."))
+  return mapping.model_copy(update={'mappings': kept}), rejected
+
+
+def column_statistics(mapping, column_profiles):
+  """ Compact per-column statistics from the column profiles, for the columns of `mapping` found in the data. """
+  lines = [describe_column(code, column_profiles[code]) for code, _ in map(split_mapping, mapping.mappings or [])
+           if code in (column_profiles or {})]
+  return "Column statistics from the data files:\n" + '\n'.join(lines) if lines else ''
+
+
+def section_selection_text(mapping, column_profiles=None):
+  return '\n'.join(filter(None, [str(mapping), column_statistics(mapping, column_profiles)]))
+
+
+async def select_remaining_fields(full_section_name, mapping, rejected, selection_llm, column_profiles=None):
+  # now, select relevant fields (only the LLM call is skipped when the pre-filter ruled out every column)
+  if rejected and not mapping.mappings:
+    print(f"Pre-filter ruled out all {len(rejected)} columns of {full_section_name}; no selection call needed.")
+    fields_with_reasoning = ColumnSelectionMapping(section_name=mapping.section_name, column_selection_mapping=[])
+  else:
+    prompt = field_selection_prompt_template.invoke({"text": '\n\n'.join([field_selection_instructions, section_selection_text(mapping, column_profiles)])})
+    with span('part_2.field_selection', section=full_section_name):
+      fields_with_reasoning = await selection_llm.ainvoke(prompt)
+    print(f"Selected fields for {full_section_name}, with reasoning:", fields_with_reasoning, '\n')
+  fields_with_reasoning.column_selection_mapping = (fields_with_reasoning.column_selection_mapping or []) + rejected
+  return fields_with_reasoning
+
+
+async def select_fields_from_mapping(full_section_name, mapping, selection_llm, column_filter=None, column_profiles=None):
+  mapping_for_llm, rejected = prefilter_mapping(mapping, column_filter, column_profiles)
+  return await select_remaining_fields(full_section_name, mapping_for_llm, rejected, selection_llm, column_profiles)
+
+
+async def select_section_fields(category, section, metadata_path, page_indices, mapping_llm, selection_llm, column_filter=None,
+                                column_profiles=None):
+  """ Run the mapping -> translation -> selection chain for one section. """
+  mapping = await map_section_fields(category, section, metadata_path, page_indices, mapping_llm)
+  fields_with_reasoning = await select_fields_from_mapping(category + section.upper(), mapping, selection_llm, column_filter, column_profiles)
+  return mapping, fields_with_reasoning
+
+
+async def select_fields_for_section_batch(batch, batched_selection_llm, column_profiles=None):
+  """ One field-selection request for several (full_section_name, mapping) pairs.
+  Returns {full_section_name: ColumnSelectionMapping} for the sections the model answered. """
+  section_texts = [f"SECTION: {full_section_name}\n{section_selection_text(mapping, column_profiles)}" for full_section_name, mapping in batch]
+  prompt = batched_field_selection_prompt_template.invoke({"text": '\n\n'.join([field_selection_instructions, *section_texts])})
+  with span('part_2.batched_field_selection', sections=len(batch)):
+    batched = await batched_selection_llm.ainvoke(prompt)
+  answers = {selection.section_name: selection for selection in (batched.sections or [])
+             if selection.section_name and selection.column_selection_mapping}
+  print(f"Selected fields for {len(answers)}/{len(batch)} sections in one request:", list(answers))
+  return answers
+
+
+async def select_fields_for_sections(section_jobs, mapping_llm, selection_llm, concurrency, batched_selection_llm=None, batch_tokens=0,
+                                     column_filter=None, column_profiles=None):
+  """ Run select_section_fields for every (category, section, metadata_path, pages) job with at most
+  `concurrency` requests in flight. Results are ordered like section_jobs; failures are returned as exceptions.
+  With `batch_tokens`, all mappings are built first and the selection step packs as many sections per request
+  as fit in that many (estimated) prompt tokens; sections the model leaves out get a request of their own.
+  With `column_filter`, columns it rules out are marked as not selected and never sent to the model.
+  `column_profiles` ({column code: profile}) adds data statistics to the prompts and rules out empty columns. """
+  semaphore = asyncio.Semaphore(max(1, concurrency))
+  sections_done = 0
+
+  async def run_one(job):
+    nonlocal sections_done
+    async with semaphore:
+      try:
+        return await select_section_fields(*job, mapping_llm, selection_llm, column_filter, column_profiles)
+      finally:
+        sections_done += 1
+        report_progress(f"Selected fields in {sections_done}/{len(section_jobs)} sections", 0.2 + 0.7 * sections_done / len(section_jobs))
+
+  if not batch_tokens or batched_selection_llm is None:
+    return await asyncio.gather(*[run_one(job) for job in section_jobs], return_exceptions=True)
+
+  async def map_one(job):
+    nonlocal sections_done
+    async with semaphore:
+      try:
+        return await map_section_fields(*job, mapping_llm)
+      finally:
+        sections_done += 1
+        report_progress(f"Mapped fields in {sections_done}/{len(section_jobs)} sections", 0.2 + 0.4 * sections_done / len(section_jobs))
+
+  mappings = await asyncio.gather(*[map_one(job) for job in section_jobs], return_exceptions=True)
+  names = [category + section.upper() for category, section, _, _ in section_jobs]
+  prefiltered = {name: prefilter_mapping(mapping, column_filter, column_profiles) for name, mapping in zip(names, mappings) if not isinstance(mapping, Exception)}
+  mapped = [(name, mapping) for name, (mapping, rejected) in prefiltered.items() if mapping.mappings or not rejected]
+
+  # the instructions and schema are paid once per request, the section mappings once per section
+  overhead = estimate_tokens(batched_field_selection_prompt_template.invoke({"text": field_selection_instructions}).to_string())
+  batches = pack_by_token_budget(mapped, [estimate_tokens(f"SECTION: {name}\n{section_selection_text(mapping, column_profiles)}")
+                                          for name, mapping in mapped], batch_tokens, overhead)
+  print(f"Packed {len(mapped)} sections into {len(batches)} field-selection requests (budget {batch_tokens} tokens)")
+  batches_done = 0
+
+  async def select_batch(batch):
+    nonlocal batches_done
+    async with semaphore:
+      try:
+        return await select_fields_for_section_batch(batch, batched_selection_llm, column_profiles)
+      finally:
+        batches_done += 1
+        report_progress(f"Selected fields in {batches_done}/{len(batches)} requests", 0.6 + 0.3 * batches_done / len(batches))
+
+  answers = {}
+  for batch_answers in await asyncio.gather(*[select_batch(batch) for batch in batches], return_exceptions=True):
+    if isinstance(batch_answers, Exception):
+      print(f"⚠️ Batched field selection failed: {batch_answers!r}")
+    else:
+      answers.update(batch_answers)
+
+  async def select_one(name, mapping):
+    if isinstance(mapping, Exception):
+      raise mapping
+    mapping_for_llm, rejected = prefiltered[name]
+    if name in answers:
+      fields_with_reasoning = answers[name]
+      fields_with_reasoning.column_selection_mapping = (fields_with_reasoning.column_selection_mapping or []) + rejected
+      return mapping, fields_with_reasoning
+    # sections the batch did not answer (or whose batch failed) fall back to their own request
+    async with semaphore:
+      return mapping, await select_remaining_fields(name, mapping_for_llm, rejected, selection_llm, column_profiles)
+
+  return await asyncio.gather(*[select_one(name, mapping) for name, mapping in zip(names, mappings)], return_exceptions=True)
+
+
 def run_part_3_transform_data(file_paths, output_dir):
+    """ Part 3, with a run report (per-file stage timings, LLM calls and tokens) written next to the other metadata. """
+    report_path = os.path.join(output_dir, OUTPUT_METADATA_PATH, 'run_report_part_3.json')
+    with recorded_run('part_3', report_path) as run:
+        result = _run_part_3_transform_data(file_paths, output_dir)
+        run.extra['caches'] = {
+            'llm_cache': llm_cache.stats(),
+            'code_cache': {'hits': code_cache.hits, 'misses': code_cache.misses, 'failures': code_cache.failures},
+            'part_3_manifest': {'hits': part_3_manifest.hits, 'misses': part_3_manifest.misses},
+            'schema_matcher': schema_matcher.stats(),
+        }
+    return dict(result, run_report=report_path)
+
+
+def _run_part_3_transform_data(file_paths, output_dir):
     import pandas as pd
     import os
 
-    renaming_llm = llm.with_structured_output(schema=ColumnRenameMapping)
+    os.makedirs(os.path.join(output_dir, OUTPUT_METADATA_PATH), exist_ok=True)
+    renaming_llm = get_llm().with_structured_output(schema=ColumnRenameMapping)
+
+    def ask_renaming_llm(current_columns, reference_columns):
+        prompt = info_extraction_prompt_template.invoke({"text": '\n\n'.join([f"Current columns: {pd.Index(current_columns)}", f"Reference columns: {pd.Index(reference_columns)}"])})
+        return renaming_llm.invoke(prompt).mappings # column mapping in the language
 
     summary_csv_path = file_paths['summary_csv']
     # selected_sections = file_paths['selected_sections']
@@ -185,107 +439,218 @@ def run_part_3_transform_data(file_paths, output_dir):
     columns_to_keep = list(summary_df[summary_df['is_selected'] == True]['column_code'])
     columns_to_keep_corrected = columns_to_keep.copy()
 
-    merge_keys = ['player_handle', 'uid', 'user_id', 'player_id'] # eventually will be summary_df['merge_key'].unique()
+    data_sections = file_paths['data_sections']
+    csv_paths = [os.path.join(data_sections[category]['folder_path'], f) for category in data_sections
+                 for f in sorted(os.listdir(data_sections[category]['folder_path'])) if f.endswith(".csv")]
+
+    # join keys: discovered from value overlap across the files, falling back to the hardcoded defaults;
+    # aliases are per file, since a column name can be the key in one file and something else in another
+    entity_key, merge_keys = ENTITY_KEY, MERGE_KEYS
+    file_alias_keys = {path: ALIAS_KEYS for path in csv_paths}
+    if KEY_DISCOVERY_ENABLED:
+        report_progress("Discovering join keys", 0.0)
+        with span('part_3.key_discovery', files=len(csv_paths)):
+            discovered = discover_join_keys(csv_paths, preferred_key=ENTITY_KEY)
+        if discovered is not None:
+            entity_key, merge_keys = discovered['entity_key'], discovered['merge_keys']
+            file_alias_keys = {path: discovered['aliases'].get(path, {}) for path in csv_paths}
+            print(f"Discovered join key '{entity_key}' linking {len(discovered['files'])} files: {discovered['files']}")
+        else:
+            print(f"⚠️ No column links two data files; using the default join key '{ENTITY_KEY}'")
+
     columns_to_keep_corrected += [k for k in merge_keys if k not in columns_to_keep_corrected]
 
     print("List of (fuzzy) column codes to keep:", columns_to_keep_corrected)
 
-    result = None
-    data_sections = file_paths['data_sections']
+    # per-entity frames are collected here and joined once at the end (see merge_entity_frames); with PART_3_SPILL they
+    # are partitioned to disk as they come, and only their column names (and profiles) stay in memory
+    entity_frames = []
+    entity_profiles = []  # per frame, {column: profile of its values as read}, so the schema matcher compares like with like
+    spill_join = SpillJoin(entity_key) if PART_3_SPILL else None
+    entity_frame_names = []
+
+    num_data_files = len(csv_paths)
+    files_seen = 0
+
+    # unchanged files (same content, same config) are replayed from the manifest; only their renaming is redone
+    config_hash = stable_hash(columns_to_keep_corrected, entity_key, RULE_BASED_AGGREGATION, RULE_BASED_NUMERIC_AGG,
+                              aggregation_instructions, aggregation_input_instructions, get_model_name(get_llm()),
+                              SCHEMA_MATCHER_ENABLED and schema_matcher.settings(), COMPACT_DTYPES)
+    file_errors = {}
+
+    # reading, key normalization, dtypes and (where renames allow) aggregation of each file run ahead in worker
+    # processes; renaming, LLM aggregation and the merge below stay in file order
+    file_config_hashes = {path: stable_hash(config_hash, aliases) for path, aliases in file_alias_keys.items()}
+    file_preparer = FilePreparer([path for path in csv_paths if not part_3_manifest.expects_hit(path, file_config_hashes[path])], PART_3_WORKERS,
+                                 file_settings={path: {'alias_keys': aliases} for path, aliases in file_alias_keys.items()},
+                                 columns_to_keep=columns_to_keep_corrected, entity_key=entity_key,
+                                 chunksize=PART_3_CHUNKSIZE, compact_dtypes=COMPACT_DTYPES, rule_based=RULE_BASED_AGGREGATION,
+                                 numeric_agg=RULE_BASED_NUMERIC_AGG, profile_columns=SCHEMA_MATCHER_ENABLED,
+                                 intermediate_folder=os.path.join(output_dir, OUTPUT_METADATA_PATH) if WRITE_INTERMEDIATE_FILES else None,
+                                 intermediate_format=INTERMEDIATE_FORMAT)
+
+    def rename_step(prepared, data_file, reference_columns):
+        """The {old: new} mapping of a file's columns against the frames collected before it (None for the first file)."""
+        if not entity_frames:
+            return None
+        with span('part_3.rename', file=data_file):
+            if SCHEMA_MATCHER_ENABLED:
+                # clear matches / non-matches are decided locally; only ambiguous columns reach the LLM
+                return schema_matcher.match(prepared, entity_frames, entity_key, ask_renaming_llm, entity_profiles)
+            return ask_renaming_llm(prepared.columns, reference_columns)
+
+    try:
+        for category in data_sections:
+            folder_path = data_sections[category]['folder_path']
+            for data_file in sorted(os.listdir(folder_path)):
+                if not data_file.endswith(".csv"):
+                    continue
 
-    for category in data_sections:
-        folder_path = data_sections[category]['folder_path']
-        for data_file in os.listdir(folder_path):
-            if not data_file.endswith(".csv"):
-                continue
-
-            print(f"Considering: {data_file}")
-            data_file_path = os.path.join(folder_path, data_file)
-            df = pd.read_csv(data_file_path)
-
-            # ✅ Normalize all ID columns to 'player_id' -> this can be LLMized too
-            alias_keys = {
-                'player_code': 'player_id',
-                'user_id': 'player_id',
-                'uid': 'player_id',
-                'player_handle': 'player_id'
-            }
-            for old, new in alias_keys.items():
-                if old in df.columns:
-                    df.rename(columns={old: new}, inplace=True)
-                if result is not None and old in result.columns:
-                    result.rename(columns={old: new}, inplace=True)
-
-            # Ensure we keep the desired columns plus the merge key
-            current_columns = list(set(columns_to_keep_corrected + ['player_id']).intersection(df.columns))
-            filtered_df = df[current_columns]
-            filtered_data_file_path = os.path.join(output_dir, OUTPUT_METADATA_PATH, data_file)
-            filtered_df.to_csv(filtered_data_file_path, index=False)
-
-            # same thing with other columns; rename them
-            if result is not None:
-              prompt = info_extraction_prompt_template.invoke({"text": '\n\n'.join([f"Current columns: {filtered_df.columns}", f"Reference columns: {result.columns}"])})
-              mapping = renaming_llm.invoke(prompt) # column mapping in the language
-              print("Mapping to rename columns:", mapping)
-              mapping = mapping.mappings
-              if mapping is not None:
-                for old, new in mapping.items():
-                  if old in filtered_df.columns:
-                      filtered_df.rename(columns={old: new}, inplace=True)
-                  if result is not None and old in result.columns:
-                      result.rename(columns={old: new}, inplace=True)
-
-            # Aggregate/pivot the data if needed
-            filtered_aggregated_df = aggregate_data(filtered_df, filtered_data_file_path)
-            print("filtered_aggregated_df", type(filtered_aggregated_df), filtered_aggregated_df.head(10))
-
-            # ✅ Merge logic using 'player_id'
-            if result is None:
-                result = filtered_aggregated_df
-            else:
-                if 'player_id' not in result.columns or 'player_id' not in filtered_aggregated_df.columns:
-                    print(f"⚠️ 'player_id' missing in one of the datasets. Skipping {data_file}.")
+                print(f"Considering: {data_file}")
+                report_progress(f"Transforming {data_file}", 0.8 * files_seen / max(1, num_data_files))
+                files_seen += 1
+                data_file_path = os.path.join(folder_path, data_file)
+                file_config_hash = file_config_hashes[data_file_path]
+
+                reference_columns = list(dict.fromkeys(col for frame in entity_frames for col in frame.columns))
+                content_hash = part_3_manifest.content_hash(data_file_path)
+                entry = part_3_manifest.lookup(content_hash, file_config_hash)
+                if entry is not None:
+                    # the stored mapping holds while the frames before this file have the same columns; otherwise rename again
+                    cached = part_3_manifest.load(entry)
+                    profiles = dict(cached['column_profiles'] or {})
+                    mapping = entry['mappings']
+                    if entry['filtered_columns'] and entry['reference_columns'] != reference_columns:
+                        mapping = rename_step(part_3_manifest.stand_in(entry, profiles), data_file, reference_columns)
+                    reused, cached_df = part_3_manifest.reuse(entry, cached['frame'], mapping)
+                    if reused:
+                        print(f"♻️ {data_file} is unchanged since the last run; reusing its cached result.")
+                        file_preparer.discard(data_file_path)
+                        rename_columns(entity_frames, mapping)
+                        rename_profiles([profiles] + entity_profiles, mapping)
+                        if cached_df is not None:
+                            entity_frames.append(cached_df if spill_join is None else spill_join.spill(cached_df))
+                            entity_profiles.append(profiles)
+                            entity_frame_names.append(os.path.splitext(data_file)[0])
+                        continue
+
+                # Read only the desired columns plus the merge key (aliases already normalized to entity_key)
+                try:
+                    with span('part_3.prepare', file=data_file):
+                        prepared = file_preparer.get(data_file_path)
+                except Exception as e:
+                    print(f"⚠️ Could not process {data_file}: {e!r}. Skipping.")
+                    file_errors[data_file] = str(e) or type(e).__name__
                     continue
-                print(f"Merging on key: player_id")
-                result = result.merge(filtered_aggregated_df, on='player_id', how='outer')
+                filtered_df = prepared.frame  # already aggregated if prepared.table_shape is set
+                filtered_columns = list(prepared.columns)
+                if prepared.columns.empty:
+                    print(f"⚠️ None of the selected columns are in {data_file}. Skipping.")
+                    part_3_manifest.record(data_file_path, content_hash, file_config_hash, reference_columns, filtered_columns, None)
+                    continue
+
+                # same thing with other columns; rename them
+                mapping = rename_step(prepared, data_file, reference_columns)
+                profiles = dict(prepared.column_profiles or {})
+                if mapping is not None:
+                    print("Mapping to rename columns:", mapping)
+                    rename_columns([filtered_df] + entity_frames, mapping)
+                    rename_profiles([profiles] + entity_profiles, mapping)
+
+                # Aggregate/pivot the data if needed: common table shapes locally, everything else via generated code
+                filtered_aggregated_df, table_shape, code = None, prepared.table_shape, None
+                with span('part_3.aggregate', file=data_file):
+                    if table_shape is not None:
+                        filtered_aggregated_df = filtered_df
+                    elif RULE_BASED_AGGREGATION:
+                        filtered_aggregated_df, table_shape = rule_based_aggregate(filtered_df, entity_key, RULE_BASED_NUMERIC_AGG)
+                    if filtered_aggregated_df is not None:
+                        print(f"Aggregated {data_file} locally as a '{table_shape}' table")
+                    else:
+                        # statistics come from the cached column profile of the file (under the columns' current names)
+                        renamed = {**file_alias_keys[data_file_path], **(mapping or {})}
+                        column_profiles = {renamed.get(col, col): profile for col, profile in profiles_for_files([data_file_path]).items()}
+                        filtered_aggregated_df, code = aggregate_data(filtered_df, data_file_path, column_profiles)
+                if COMPACT_DTYPES:
+                    # one row per entity now, so exact float32 values can be stored as such for the merge
+                    filtered_aggregated_df = optimize_dtypes(filtered_aggregated_df, entity_key, floats=True)
+                print("filtered_aggregated_df", type(filtered_aggregated_df), filtered_aggregated_df.head(10))
+
+                # ✅ Merge logic using 'player_id'
+                if entity_key not in filtered_aggregated_df.columns:
+                    print(f"⚠️ '{entity_key}' missing in {data_file}. Skipping it for the merge.")
+                    part_3_manifest.record(data_file_path, content_hash, file_config_hash, reference_columns, filtered_columns, mapping,
+                                           column_profiles=prepared.column_profiles)
+                    continue
+                # stored before later files' renames touch it; those renames are replayed from their own entries
+                part_3_manifest.record(data_file_path, content_hash, file_config_hash, reference_columns, filtered_columns, mapping,
+                                       filtered_aggregated_df, table_shape, code.model_dump() if code is not None else None,
+                                       prepared.column_profiles)
+                if spill_join is not None:
+                    with span('part_3.spill', file=data_file):
+                        filtered_aggregated_df = spill_join.spill(filtered_aggregated_df)
+                entity_frames.append(filtered_aggregated_df)
+                entity_profiles.append(profiles)
+                entity_frame_names.append(os.path.splitext(data_file)[0])
+    finally:
+        # workers may still be preparing files ahead; a failure above must not leave them running
+        file_preparer.close()
+    if part_3_manifest.enabled:
+        print(f"Part 3 manifest: {part_3_manifest.hits} files reused, {part_3_manifest.misses} processed")
+
+    if spill_join is not None:
+        try:
+            if entity_frames:
+                print(f"Merging {len(entity_frames)} datasets on key: {entity_key} in {spill_join.num_partitions} partitions "
+                      f"({spill_join.bytes_spilled / 2**20:.1f} MB spilled to disk)")
+                report_progress(f"Merging {len(entity_frames)} datasets", 0.85)
+                with span('part_3.spill_join', files=len(entity_frames), partitions=spill_join.num_partitions):
+                    result_path = spill_join.write_joined(entity_frames, entity_frame_names, merge_keys,
+                                                          os.path.join(output_dir, 'generated_dataset'), OUTPUT_FORMAT, PARQUET_COMPRESSION)
+                if result_path is not None:
+                    print(f"Filtered, aggregated, + merged dataset written to {result_path}")
+                    return {'success': True, 'filename': os.path.basename(result_path), 'file_errors': file_errors}
+                print(f"⚠️ The result is not grouped on '{entity_key}'; joining in memory instead.")
+                entity_frames = [frame.load_all(spill_join.num_partitions) for frame in entity_frames]
+        finally:
+            spill_join.close()
+
+    # single multi-way join on the entity key, instead of one outer merge (and full copy) per file
+    print(f"Merging {len(entity_frames)} datasets on key: {entity_key} ({frame_memory(entity_frames) / 2**20:.1f} MB in memory)")
+    report_progress(f"Merging {len(entity_frames)} datasets", 0.85)
+    with span('part_3.merge', files=len(entity_frames)):
+        result = merge_entity_frames(entity_frames, entity_key, entity_frame_names)
 
     # Merging done, time to aggregate
 
     # basic aggregation for merge_key + numeric columns
     if result is not None:
-        group_key = next((k for k in merge_keys if k in result.columns), None)
+        # numeric columns summed per merge key, keys moved to the front
+        result, group_key = aggregate_by_key(result, merge_keys)
         if group_key:
-            columns_to_agg = [
-                col for col in result.select_dtypes(include='number').columns
-                if col != group_key
-            ]
-            result = result.groupby(group_key)[columns_to_agg].sum().reset_index()
             print("Aggregated on:", group_key)
         else:
             print("⚠️ No valid group key found for aggregation.")
 
         result = result.dropna(axis=1, how='all').drop_duplicates()
 
-        # move key to front if exists
-        for key in merge_keys:
-            if key in result.columns:
-                col = result.pop(key)
-                result.insert(0, key, col)
-
         print("Filtered, aggregated, + merged dataset:")
         print(result.head(10))
 
-        result_path = os.path.join(output_dir, 'generated_dataset.csv')
-        result.to_csv(result_path, index=False)
-        return {'success': True, 'filename': 'generated_dataset.csv'}
+        with span('part_3.write', format=OUTPUT_FORMAT):
+            result_path = write_frame(result, os.path.join(output_dir, 'generated_dataset'), OUTPUT_FORMAT, PARQUET_COMPRESSION)
+        return {'success': True, 'filename': os.path.basename(result_path), 'file_errors': file_errors}
 
     else:
         print("no similarities found :(")
-        return {'success': False, 'message': 'No similarities found. Dataset was not generated.'}
+        return {'success': False, 'message': 'No similarities found. Dataset was not generated.', 'file_errors': file_errors}
 
 
-def aggregate_data(dataset, data_file_path):
-  """ Take in a dataset and return a new dataset with the same columns, but aggregated, or the same if no aggregation is needed. """
+def aggregate_data(dataset, data_file_path=None, column_profiles=None):
+  """ Take in a dataset and return a new dataset with the same columns, but aggregated, or the same if no aggregation is needed.
+  The generated code receives `dataset` in memory (as AGGREGATION_INPUT_NAME); data_file_path is only used in messages.
+  `column_profiles` ({column: profile}) adds per-column statistics to the code generation prompt.
+  Returns (dataset, code), code being the FunctionalCode that produced it or None. """
 
   # reverse if we already renamed columns
   # reverse_map = {v: k for k, v in col_rename_map.items()}
@@ -297,29 +662,61 @@ def aggregate_data(dataset, data_file_path):
   from pydantic import BaseModel, Field
 
   # # run the code
-  coding_llm = llm.with_structured_output(schema=FunctionalCode)
+  coding_llm = get_llm().with_structured_output(schema=FunctionalCode)
 
   columns_kept = list(dataset.columns)
+  # generated code expects default dtypes (no categoricals, no int8 overflow), whatever the pipeline stores
+  code_input = widen_dtypes(dataset)
   columns_kept_instruction = 'These are the ONLY columns in our dataset: ' + ', '.join(columns_kept)
+  column_stats = [describe_column(col, column_profiles[col]) for col in columns_kept if col in (column_profiles or {})]
+  if column_stats:
+    columns_kept_instruction += '\n\nColumn statistics from the data file:\n' + '\n'.join(column_stats)
 
   # columns_kept = 'These are the columns in our dataset: ' + ', '.join(
   #     [f'({key}, {item})' for (key, item) in col_rename_map.items() if key in columns_to_keep_corrected and key in result.columns]
   # )
   print("Current dataset columns: ", columns_kept)
 
-  # CREATE THE AGGREGATION INSTRUCTIONS AS WELL (SPECS)
-  aggregation_instructions_complete = aggregation_instructions.format(data_file_path=data_file_path)
-  prompt = aggregation_code_gen_template.invoke({"text": '\n\n'.join([aggregation_instructions_complete, columns_kept_instruction])})
-  # print(prompt)
-  code = coding_llm.invoke(prompt) # column mapping in the language
-  full_code_string = code.imports.strip().replace('\n ', '\n') + '\n\n' + code.code.strip().replace('\n ', '\n')
-  print("Full Code Output: \n", full_code_string)
-  aggregated_dataset = run_code_and_capture_df(full_code_string, "agg_df")
-  print("Aggregated dataset:", aggregated_dataset)
-  aggregated_dataset = aggregated_dataset['dataframe']
+  def generate_code():
+    # CREATE THE AGGREGATION INSTRUCTIONS AS WELL (SPECS)
+    aggregation_instructions_complete = aggregation_instructions + '\n' + aggregation_input_instructions.format(df_name=AGGREGATION_INPUT_NAME)
+    prompt = aggregation_code_gen_template.invoke({"text": '\n\n'.join([aggregation_instructions_complete, columns_kept_instruction])})
+    # print(prompt)
+    with span('part_3.generate_code'):
+      return coding_llm.invoke(prompt) # column mapping in the language
+
+  def run_code(code):
+    full_code_string = (code.imports or '').strip().replace('\n ', '\n') + '\n\n' + (code.code or '').strip().replace('\n ', '\n')
+    print("Full Code Output: \n", full_code_string)
+    with span('part_3.run_code'):
+      output = run_code_and_capture_df(full_code_string, "agg_df", inputs={AGGREGATION_INPUT_NAME: code_input})
+    print("Aggregated dataset:", output)
+    df = output.get('dataframe')
+    return df if isinstance(df, pd.DataFrame) else None
+
+  # shards with the same schema (and the same instructions) reuse code that already worked
+  signature = schema_signature(code_input, aggregation_instructions + aggregation_input_instructions)
+  code = code_cache.get(signature)
+  aggregated_dataset = None
+  if code is not None:
+    print(f"Reusing cached aggregation code for schema {signature[:12]}")
+    aggregated_dataset = run_code(code)
+    code_cache.record_outcome(aggregated_dataset is not None)
+    if aggregated_dataset is None:
+      print("⚠️ Cached aggregation code failed on this file; generating new code.")
+  if aggregated_dataset is None:
+    code = generate_code()
+    aggregated_dataset = run_code(code)
+  if aggregated_dataset is None:
+    # keep the rows as they are and let the final groupby aggregate
+    print(f"⚠️ Aggregation code did not produce agg_df for {data_file_path}. Using the filtered data as is.")
+    return dataset, None
+
+  # only code that actually produced an agg_df is cached
+  code_cache.put(signature, code)
   print("Output from running the code:", aggregated_dataset.head(10))
 
-  return aggregated_dataset
+  return aggregated_dataset, code
 
   # """# Part 4: Data Cleaning
 
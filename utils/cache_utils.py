@@ -0,0 +1,75 @@
+# This file contains helpers shared by the on-disk caches (hashing, folders, atomic writes).
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+CACHE_FOLDER = os.getenv("CACHE_FOLDER") or 'cache'
+HASH_CHUNK_SIZE = 1024 * 1024
+FILE_HASH_MEMO_SIZE = 4096  # (path, size, mtime) -> digest entries kept by cached_file_hash
+
+_file_hashes = OrderedDict()
+_file_hashes_lock = threading.Lock()
+
+
+def stable_hash(*parts):
+  """Hash any number of strings (or JSON-serializable objects) into a hex digest."""
+  digest = hashlib.sha256()
+  for part in parts:
+    if not isinstance(part, str):
+      part = json.dumps(part, sort_keys=True, default=str)
+    digest.update(part.encode('utf-8'))
+    digest.update(b'\x00')  # separator so ('ab', 'c') != ('a', 'bc')
+  return digest.hexdigest()
+
+
+def file_hash(file_path):
+  """Hash the content of a file, streaming it so large files are never fully loaded."""
+  digest = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def cached_file_hash(file_path):
+  """file_hash, remembered in this process while the file's size and mtime are unchanged."""
+  stat = os.stat(file_path)
+  key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+  with _file_hashes_lock:
+    digest = _file_hashes.get(key)
+    if digest is not None:
+      _file_hashes.move_to_end(key)
+      return digest
+  digest = file_hash(file_path)
+  with _file_hashes_lock:
+    _file_hashes[key] = digest
+    while len(_file_hashes) > FILE_HASH_MEMO_SIZE:
+      _file_hashes.popitem(last=False)
+  return digest
+
+
+def cache_path(*parts):
+  """Return a path inside CACHE_FOLDER, creating the parent folder if needed."""
+  path = os.path.join(CACHE_FOLDER, *parts)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  return path
+
+
+def write_json_atomic(path, obj):
+  """Write JSON to a temp file and rename it, so readers never see a half-written file."""
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # concurrent jobs may write the same entry
+  with open(tmp_path, 'w') as f:
+    json.dump(obj, f, default=str)
+  os.replace(tmp_path, path)
+
+
+def read_json(path, default=None):
+  """Read a JSON file, returning `default` if it is missing or corrupt."""
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return default
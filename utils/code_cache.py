@@ -0,0 +1,60 @@
+# This file contains a cache of generated aggregation code, keyed by a signature of the table schema.
+# Shards with the same columns/dtypes (player_stats_0.csv, player_stats_1.csv, ...) reuse code that
+# already produced an `agg_df`, instead of asking the coding model again.
+import os
+
+from models.return_models import FunctionalCode
+from utils.cache_utils import CACHE_FOLDER, read_json, stable_hash, write_json_atomic
+
+CODE_CACHE_FOLDER = os.getenv("CODE_CACHE_FOLDER") or os.path.join(CACHE_FOLDER, 'agg_code')
+CODE_CACHE_ENABLED = (os.getenv("CODE_CACHE_ENABLED") or 'true').lower() == 'true'
+
+
+def schema_signature(dataset, instructions):
+  """Signature of (column names, dtypes, aggregation instructions) for a dataset about to be aggregated."""
+  schema = [(str(col), str(dtype)) for col, dtype in dataset.dtypes.items()]
+  return stable_hash(schema, instructions)
+
+
+class CodeCache:
+  """Validated FunctionalCode per schema signature, in memory and on disk."""
+
+  def __init__(self, folder=CODE_CACHE_FOLDER, enabled=CODE_CACHE_ENABLED):
+    self.folder = folder
+    self.enabled = enabled
+    self._codes = {}
+    self.hits = 0  # cached code that ran and produced an agg_df again
+    self.misses = 0
+    self.failures = 0  # cached code that no longer worked on the file it was reused for
+
+  def _path(self, signature):
+    return os.path.join(self.folder, f"{signature}.json")
+
+  def get(self, signature):
+    """Return the cached code for this signature, or None. Report how it went with record_outcome()."""
+    if not self.enabled:
+      return None
+    if signature not in self._codes:
+      cached = read_json(self._path(signature))
+      if cached is None:
+        self.misses += 1
+        return None
+      self._codes[signature] = FunctionalCode.model_validate(cached)
+    return self._codes[signature]
+
+  def record_outcome(self, worked):
+    """Count cached code returned by get() as a hit only once it has produced an agg_df."""
+    if worked:
+      self.hits += 1
+    else:
+      self.failures += 1
+
+  def put(self, signature, code):
+    """Store code that produced an agg_df."""
+    if not self.enabled:
+      return
+    self._codes[signature] = code
+    write_json_atomic(self._path(signature), code.model_dump())
+
+
+code_cache = CodeCache()
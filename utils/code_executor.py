@@ -0,0 +1,131 @@
+# This file contains the executor for GenAI-written aggregation code.
+# In 'process' mode each snippet runs in its own worker process with a CPU-time budget, an address-space cap and a
+# wall-clock timeout that starts when the snippet does, and its stdout is captured per task. A snippet that overruns
+# is killed without touching the snippets of other jobs. 'inline' mode keeps the old behaviour of exec-ing in the
+# calling process.
+import contextlib
+import io
+import multiprocessing
+import os
+import resource
+import signal
+import threading
+
+CODE_EXECUTION_MODE = os.getenv("CODE_EXECUTION_MODE") or 'process'  # 'process' or 'inline'
+CODE_EXECUTION_WORKERS = int(os.getenv("CODE_EXECUTION_WORKERS") or min(4, os.cpu_count() or 1))  # snippets running at once
+CODE_EXECUTION_TIMEOUT = float(os.getenv("CODE_EXECUTION_TIMEOUT") or 300)  # wall-clock seconds per snippet
+CODE_EXECUTION_CPU_SECONDS = int(os.getenv("CODE_EXECUTION_CPU_SECONDS") or 300)  # CPU seconds per snippet
+CODE_EXECUTION_MAX_MEMORY_BYTES = int(os.getenv("CODE_EXECUTION_MAX_MEMORY_BYTES") or 4 * 1024 ** 3)
+# the fork server imports the app once and forks every worker from it, so a process per snippet starts quickly
+CODE_EXECUTION_START_METHOD = os.getenv("CODE_EXECUTION_START_METHOD") or 'forkserver'
+KILL_GRACE_SECONDS = 10  # extra time the parent waits before killing a worker stuck in C code
+START_TIMEOUT_SECONDS = 120  # time a worker may take to start and receive its inputs
+
+
+def exec_and_capture(code_str, df_name="df", inputs=None):
+  """ Exec `code_str` in a fresh namespace and return its stdout plus the variable `df_name`.
+  `inputs` ({name: object}) are injected into the namespace, e.g. an already-loaded DataFrame. """
+  local_vars = {}
+  output_buffer = io.StringIO()
+
+  try:
+    with contextlib.redirect_stdout(output_buffer):
+      exec(code_str, dict(inputs or {}), local_vars)
+    output = output_buffer.getvalue()
+    df = local_vars.get(df_name, None)
+    return {"output": output, "dataframe": df}
+  except Exception as e:
+    return {"error": str(e) or type(e).__name__, "output": output_buffer.getvalue()}
+
+
+######## ------ WORKER SIDE ------- #########
+
+def _init_worker(max_memory_bytes):
+  # RLIMIT_AS is the closest enforceable proxy for RSS on Linux (RLIMIT_RSS is ignored by the kernel)
+  if max_memory_bytes:
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+
+
+def _raise_timeout(signum, frame):
+  raise TimeoutError("code execution exceeded its wall-clock timeout")
+
+
+def _run_task(code_str, df_name, cpu_seconds, timeout, inputs=None):
+  # RLIMIT_CPU counts the whole life of the process, so budget relative to what it already used
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  used_seconds = int(usage.ru_utime + usage.ru_stime)
+  _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+  resource.setrlimit(resource.RLIMIT_CPU, (used_seconds + cpu_seconds + 1, hard))
+
+  # soft wall-clock limit: interrupts Python-level loops; the parent kills workers stuck in C code
+  signal.signal(signal.SIGALRM, _raise_timeout)
+  signal.setitimer(signal.ITIMER_REAL, timeout)
+  try:
+    return exec_and_capture(code_str, df_name, inputs)
+  finally:
+    signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _worker_main(conn, max_memory_bytes, code_str, df_name, cpu_seconds, timeout, inputs):
+  # tells the parent the snippet is starting, so the wall-clock timeout does not count the time spent waiting for
+  # a free slot or starting the process, then sends the result
+  _init_worker(max_memory_bytes)
+  conn.send('started')
+  try:
+    result = _run_task(code_str, df_name, cpu_seconds, timeout, inputs)
+  except BaseException as e:  # e.g. the timeout firing after exec_and_capture returned
+    result = {"error": str(e) or type(e).__name__, "output": ""}
+  conn.send(result)
+  conn.close()
+
+
+######## ------ PARENT SIDE ------- #########
+
+class CodeExecutor:
+  """ Runs code snippets under CPU, memory and time limits, each in a worker process of its own, with at most
+  `max_workers` running at once. """
+
+  def __init__(self, max_workers=CODE_EXECUTION_WORKERS, timeout=CODE_EXECUTION_TIMEOUT,
+               cpu_seconds=CODE_EXECUTION_CPU_SECONDS, max_memory_bytes=CODE_EXECUTION_MAX_MEMORY_BYTES):
+    self.max_workers = max_workers
+    self.timeout = timeout
+    self.cpu_seconds = cpu_seconds
+    self.max_memory_bytes = max_memory_bytes
+    self._slots = threading.BoundedSemaphore(max(1, max_workers))
+    self._context = multiprocessing.get_context(CODE_EXECUTION_START_METHOD)
+
+  def run(self, code_str, df_name="df", inputs=None):
+    with self._slots:
+      receiver, sender = self._context.Pipe(duplex=False)
+      # inputs are pickled to the worker, which is still far cheaper than a disk round trip through CSV
+      process = self._context.Process(
+        target=_worker_main, daemon=True,
+        args=(sender, self.max_memory_bytes, code_str, df_name, self.cpu_seconds, self.timeout, inputs))
+      process.start()
+      sender.close()
+      try:
+        if not receiver.poll(START_TIMEOUT_SECONDS):
+          return {"error": f"code execution worker did not start within {START_TIMEOUT_SECONDS}s", "output": ""}
+        receiver.recv()
+        # the timeout starts with the snippet; the grace covers workers stuck in C code, where SIGALRM cannot land
+        if not receiver.poll(self.timeout + KILL_GRACE_SECONDS):
+          return {"error": f"code execution did not finish within {self.timeout}s and was killed", "output": ""}
+        return receiver.recv()
+      except EOFError:
+        # the worker died, most likely SIGXCPU (CPU budget) or the OOM killer
+        return {"error": "code execution worker died (CPU or memory limit exceeded)", "output": ""}
+      finally:
+        receiver.close()
+        if process.is_alive():
+          process.kill()
+        process.join()
+
+
+code_executor = CodeExecutor()
+
+
+def run_code(code_str, df_name="df", mode=None, inputs=None):
+  """Run generated code either in the worker pool ('process') or in this process ('inline')."""
+  if (mode or CODE_EXECUTION_MODE) == 'inline':
+    return exec_and_capture(code_str, df_name, inputs)
+  return code_executor.run(code_str, df_name, inputs)
@@ -0,0 +1,78 @@
+# This file contains a local, model-free pre-filter for Part 2 field selection.
+# Columns ("code – question" strings from a section mapping) are scored against the task description and the
+# selection instructions with IDF-weighted term overlap; columns that share (almost) nothing with the task are
+# marked as not selected without sending them to the LLM.
+import math
+import re
+
+TOKEN_PATTERN = re.compile(r'[a-z]+|\d+')
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have how if in into is it its of on or per such that the their them then
+there these this those to was were what when where which who will with within without you your do does did not
+no yes any all each other than e g eg ie etc only also may can should would could must more most less very
+""".split())
+
+
+def tokenize(text):
+  """Lowercase word tokens, with snake_case / camelCase split and a light plural/suffix strip."""
+  text = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(text)).lower().replace('_', ' ')
+  tokens = []
+  for token in TOKEN_PATTERN.findall(text):
+    if token in STOPWORDS or len(token) < 2:
+      continue
+    for suffix in ('ies', 'ing', 'ed', 's'):
+      if len(token) > len(suffix) + 3 and token.endswith(suffix):
+        token = token[:-len(suffix)] + ('y' if suffix == 'ies' else '')
+        break
+    tokens.append(token)
+  return tokens
+
+
+def split_mapping(entry):
+  """'code – question' -> (code, question), like the question map post-processing does."""
+  parts = entry.split('–')
+  if len(parts) == 2:
+    return parts[0].strip(), parts[1].strip()
+  return entry.strip(), entry.strip()
+
+
+class ColumnPrefilter:
+  """ Scores columns against a task text. The task text is split into lines that act as the IDF corpus, so terms
+  that show up everywhere in the instructions ('player', 'data') count for less than specific ones ('churn'). """
+
+  def __init__(self, task_text, margin=0.1, min_keep=3):
+    self.margin = margin
+    self.min_keep = min_keep
+    self.seen_columns = 0
+    self.skipped_columns = 0
+    lines = [set(tokenize(line)) for line in task_text.splitlines() if line.strip()]
+    document_frequency = {}
+    for terms in lines:
+      for term in terms:
+        document_frequency[term] = document_frequency.get(term, 0) + 1
+    num_lines = max(1, len(lines))
+    # BM25-style idf, floored at a small positive weight so frequent task terms still count
+    self.idf = {term: max(0.05, math.log((num_lines - df + 0.5) / (df + 0.5) + 1)) for term, df in document_frequency.items()}
+
+  def score(self, entry):
+    return sum(self.idf.get(term, 0.0) for term in set(tokenize(entry)))
+
+  def split(self, entries):
+    """ Return (kept, skipped) entries. A column is skipped when it scores below `margin` times the best
+    column of its section; the `min_keep` best columns are always kept, unless nothing in the section overlaps
+    with the task at all. margin=0 (or an empty task text) keeps everything. """
+    if not entries or self.margin <= 0 or not self.idf:
+      return list(entries), []
+    scores = [self.score(entry) for entry in entries]
+    best = max(scores)
+    ranked = sorted(range(len(entries)), key=lambda i: -scores[i])
+    always_keep = set(ranked[:self.min_keep]) if best > 0 else set()
+    kept, skipped = [], []
+    for i, entry in enumerate(entries):
+      if i in always_keep or (best > 0 and scores[i] >= self.margin * best):
+        kept.append(entry)
+      else:
+        skipped.append((entry, scores[i]))
+    self.seen_columns += len(entries)
+    self.skipped_columns += len(skipped)
+    return kept, skipped
@@ -0,0 +1,177 @@
+# This file contains a single-pass column profiler for CSV data files.
+# Each file is streamed once in chunks (so it can be larger than memory) and every column is summarized:
+# inferred dtype, null rate, min/max, approximate distinct count, top values, a uniform sample and a MinHash
+# of its values. Profiles are cached by file content hash and shared by Part 2 prompts, key discovery and Part 3.
+import os
+from itertools import zip_longest
+
+import numpy as np
+import pandas as pd
+
+from utils.cache_utils import CACHE_FOLDER, cached_file_hash, read_json, write_json_atomic
+from utils.sketches import HyperLogLog, MinHash, hash_values
+
+PROFILE_CHUNKSIZE = int(os.getenv("PROFILE_CHUNKSIZE") or 200000)
+PROFILE_FOLDER = os.path.join(CACHE_FOLDER, 'column_profiles')
+PROFILE_VERSION = 1  # bump when the profile format changes, so old cache entries are ignored
+TOP_K = 10
+TOP_K_CAPACITY = 200  # counters kept per column while streaming; more than TOP_K so the top values are stable
+SAMPLE_SIZE = 20
+
+
+class _ColumnAccumulator:
+  """Running statistics of one column, updated chunk by chunk."""
+
+  def __init__(self, seed):
+    self.rows = 0
+    self.nulls = 0
+    self.numbers = 0
+    self.booleans = 0
+    self.fractional = False
+    self.min = None
+    self.max = None
+    self.hll = HyperLogLog()
+    self.minhash = MinHash()
+    self.counts = pd.Series(dtype='float64')
+    self.sample_keys = np.array([], dtype=np.float64)
+    self.sample_values = np.array([], dtype=object)
+    self.rng = np.random.default_rng(seed)
+
+  def update(self, column):
+    self.rows += len(column)
+    values = column.dropna()
+    self.nulls += len(column) - len(values)
+    if values.empty:
+      return
+
+    numbers = pd.to_numeric(values, errors='coerce').dropna()
+    self.numbers += len(numbers)
+    if len(numbers):
+      self.fractional |= bool(((numbers % 1) != 0).any())
+      self.min = float(numbers.min()) if self.min is None else min(self.min, float(numbers.min()))
+      self.max = float(numbers.max()) if self.max is None else max(self.max, float(numbers.max()))
+    if len(numbers) < len(values):
+      self.booleans += int(values.str.lower().isin(['true', 'false']).sum())
+
+    hashes = hash_values(values)
+    self.hll.add_hashes(hashes)
+    self.minhash.add_hashes(hashes)
+
+    # approximate heavy hitters: merge this chunk's counts and keep the largest counters only
+    self.counts = values.value_counts().astype('float64').add(self.counts, fill_value=0).nlargest(TOP_K_CAPACITY)
+
+    # uniform sample: keep the values with the smallest random priorities seen so far
+    keys = self.rng.random(len(values))
+    if len(self.sample_keys) >= SAMPLE_SIZE:
+      candidates = np.flatnonzero(keys < self.sample_keys.max())
+    else:
+      candidates = np.arange(len(values))
+    keys = np.concatenate([self.sample_keys, keys[candidates]])
+    pool = np.concatenate([self.sample_values, values.to_numpy(dtype=object)[candidates]])
+    keep = np.argsort(keys)[:SAMPLE_SIZE]
+    self.sample_keys, self.sample_values = keys[keep], pool[keep]
+
+  def dtype(self):
+    present = self.rows - self.nulls
+    if present == 0:
+      return 'empty'
+    if self.numbers == present:
+      return 'float' if self.fractional else 'integer'
+    if self.booleans == present:
+      return 'boolean'
+    return 'string'
+
+  def result(self):
+    # below k distinct values the MinHash holds the whole set, so the count is exact
+    distinct = len(self.minhash.mins) if len(self.minhash.mins) < self.minhash.k else round(self.hll.count())
+    return {
+      'dtype': self.dtype(),
+      'rows': self.rows,
+      'nulls': self.nulls,
+      'null_rate': self.nulls / self.rows if self.rows else 1.0,
+      'min': self.min,
+      'max': self.max,
+      'distinct': distinct,
+      'fractional': self.fractional,
+      'top_values': [[value, int(count)] for value, count in self.counts.head(TOP_K).items()],
+      'sample': [str(value) for value in self.sample_values],
+      'minhash': self.minhash.to_dict(),
+    }
+
+
+def profile_csv(path, chunksize=PROFILE_CHUNKSIZE):
+  """ {column: profile} for one CSV, streamed once in chunks of `chunksize` rows and cached by content hash.
+  Values are read as strings (only empty cells are missing), so types are inferred from the values themselves. """
+  digest = cached_file_hash(path)  # hashed once per file version, not on every lookup
+  cache_file = os.path.join(PROFILE_FOLDER, f"{digest}.json")
+  cached = read_json(cache_file)
+  if cached is not None and cached.get('version') == PROFILE_VERSION:
+    return cached['columns']
+
+  seed = int(digest[:8], 16)
+  accumulators = {}
+  for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[''], chunksize=chunksize):
+    for col in chunk.columns:
+      accumulators.setdefault(col, _ColumnAccumulator(seed)).update(chunk[col])
+  columns = {col: accumulator.result() for col, accumulator in accumulators.items()}
+  write_json_atomic(cache_file, {'version': PROFILE_VERSION, 'path': os.path.abspath(path), 'columns': columns})
+  return columns
+
+
+def merge_profiles(profile, other):
+  """ The profile of a column found in two files, as if they were one file: counts add up, a column is empty only if
+  it is empty in both, and the distinct count comes from the union of the MinHash sketches. """
+  minhash, other_minhash = MinHash.from_dict(profile['minhash']), MinHash.from_dict(other['minhash'])
+  jaccard = minhash.jaccard(other_minhash)
+  union = MinHash(minhash.k, minhash.mins).merge(other_minhash)
+  distinct = len(union.mins) if len(union.mins) < union.k else round((profile['distinct'] + other['distinct']) / (1 + jaccard))
+  dtypes = {profile['dtype'], other['dtype']} - {'empty'}
+  dtype = dtypes.pop() if len(dtypes) == 1 else ('float' if dtypes == {'integer', 'float'} else 'string' if dtypes else 'empty')
+  rows, nulls = profile['rows'] + other['rows'], profile['nulls'] + other['nulls']
+  counts = {}
+  for value, count in profile['top_values'] + other['top_values']:
+    counts[value] = counts.get(value, 0) + count
+  bounds = [p for p in (profile, other) if p['min'] is not None]
+  return {
+    'dtype': dtype,
+    'rows': rows,
+    'nulls': nulls,
+    'null_rate': nulls / rows if rows else 1.0,
+    'min': min((p['min'] for p in bounds), default=None),
+    'max': max((p['max'] for p in bounds), default=None),
+    'distinct': distinct,
+    'fractional': profile['fractional'] or other['fractional'],
+    'top_values': sorted(([value, count] for value, count in counts.items()), key=lambda item: -item[1])[:TOP_K],
+    'sample': [value for pair in zip_longest(profile['sample'], other['sample']) for value in pair if value is not None][:SAMPLE_SIZE],
+    'minhash': union.to_dict(),
+  }
+
+
+def profiles_for_files(paths):
+  """ {column: profile} over several files; a column found in several files (shards of a table, or sections that
+  share it) gets one profile merged over all of them. Non-CSV files are ignored. """
+  profiles = {}
+  for path in paths:
+    if not str(path).endswith('.csv') or not os.path.exists(path):
+      continue
+    for col, profile in profile_csv(path).items():
+      profiles[col] = merge_profiles(profiles[col], profile) if col in profiles else profile
+  return profiles
+
+
+def describe_column(column, profile):
+  """One compact line for prompts, e.g. 'level: integer, 2% missing, ~48 distinct, range 1–50, e.g. 3, 17'."""
+  parts = [profile['dtype']]
+  if profile['null_rate']:
+    parts.append(f"{profile['null_rate']:.0%} missing")
+  parts.append(f"~{profile['distinct']:,} distinct")
+  if profile['dtype'] in ('integer', 'float') and profile['min'] is not None:
+    parts.append(f"range {profile['min']:g}–{profile['max']:g}")
+  # frequent values say more than a sample, unless every value is (about) unique
+  if profile['top_values'] and profile['top_values'][0][1] > 1:
+    examples = [str(value)[:30] for value, _ in profile['top_values'][:3]]
+  else:
+    examples = [value[:30] for value in profile['sample'][:3]]
+  if examples:
+    parts.append("e.g. " + ", ".join(examples))
+  return f"{column}: " + ", ".join(parts)
@@ -0,0 +1,241 @@
+# This file contains lightweight run instrumentation: timed spans per pipeline stage, and a LangChain callback
+# that records latency, token counts and the model for every LLM call. Each run (a job, or one pipeline call)
+# collects its own report; process-wide totals are kept for the Prometheus-style /metrics endpoint.
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from utils.cache_utils import write_json_atomic
+
+MAX_RECORDED_EVENTS = 10000  # spans / LLM calls kept per run report (totals are always complete)
+
+current_run = contextvars.ContextVar('current_run', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _summarize(durations):
+  return {'count': len(durations), 'total_seconds': round(sum(durations), 4), 'max_seconds': round(max(durations), 4)}
+
+
+class RunRecorder:
+  """Spans and LLM calls of one run, turned into a JSON-serializable report."""
+
+  def __init__(self, name):
+    self.name = name
+    self.started_at = time.time()
+    self._start = time.perf_counter()
+    self.finished_at = None
+    self.report_path = None
+    self.spans = []
+    self.llm_calls = []
+    self.extra = {}
+    self._stage_durations = {}
+    self._llm_totals = {}
+    self._lock = threading.Lock()
+
+  def _offset(self, start):
+    return round(start - self._start, 4)
+
+  def add_span(self, name, start, duration, attrs):
+    with self._lock:
+      self._stage_durations.setdefault(name, []).append(duration)
+      if len(self.spans) < MAX_RECORDED_EVENTS:
+        self.spans.append({'name': name, 'start': self._offset(start), 'seconds': round(duration, 4), **attrs})
+
+  def add_llm_call(self, model, span, start, duration, prompt_tokens, completion_tokens, error=None):
+    with self._lock:
+      totals = self._llm_totals.setdefault(model, {'calls': 0, 'errors': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'seconds': 0.0})
+      totals['calls'] += 1
+      totals['errors'] += error is not None
+      totals['prompt_tokens'] += prompt_tokens
+      totals['completion_tokens'] += completion_tokens
+      totals['seconds'] += duration
+      if len(self.llm_calls) < MAX_RECORDED_EVENTS:
+        self.llm_calls.append({'model': model, 'span': span, 'start': self._offset(start), 'seconds': round(duration, 4),
+                               'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'error': error})
+
+  def finish(self):
+    self.finished_at = time.time()
+
+  def report(self):
+    with self._lock:
+      by_model = {model: dict(totals, seconds=round(totals['seconds'], 4)) for model, totals in self._llm_totals.items()}
+      return {
+        'name': self.name,
+        'started_at': self.started_at,
+        'finished_at': self.finished_at,
+        'seconds': round((self.finished_at or time.time()) - self.started_at, 4),
+        'stages': {name: _summarize(durations) for name, durations in self._stage_durations.items()},
+        'llm': {
+          'calls': sum(t['calls'] for t in by_model.values()),
+          'prompt_tokens': sum(t['prompt_tokens'] for t in by_model.values()),
+          'completion_tokens': sum(t['completion_tokens'] for t in by_model.values()),
+          'by_model': by_model,
+        },
+        'spans': list(self.spans),
+        'llm_calls': list(self.llm_calls),
+        **self.extra,
+      }
+
+
+######## ------ PROCESS-WIDE METRICS ------- #########
+
+def _label_value(value):
+  # the exposition format needs backslashes, double quotes and line feeds escaped in label values
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+  """Cumulative counters since process start, rendered in the Prometheus text format."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._stages = {}  # stage -> [count, seconds]
+    self._llm = {}  # model -> [calls, errors, prompt_tokens, completion_tokens, seconds]
+
+  def observe_stage(self, name, seconds):
+    with self._lock:
+      stage = self._stages.setdefault(name, [0, 0.0])
+      stage[0] += 1
+      stage[1] += seconds
+
+  def observe_llm(self, model, seconds, prompt_tokens, completion_tokens, error):
+    with self._lock:
+      llm = self._llm.setdefault(model, [0, 0, 0, 0, 0.0])
+      llm[0] += 1
+      llm[1] += error
+      llm[2] += prompt_tokens
+      llm[3] += completion_tokens
+      llm[4] += seconds
+
+  def render(self, gauges=None):
+    """`gauges` ({name: value}) are appended as extra gauges, e.g. cache statistics."""
+    lines = [
+      '# HELP pipeline_stage_seconds Time spent in each pipeline stage.',
+      '# TYPE pipeline_stage_seconds summary',
+    ]
+    with self._lock:
+      stages = dict(self._stages)
+      llms = dict(self._llm)
+    for name, (count, seconds) in sorted(stages.items()):
+      lines.append(f'pipeline_stage_seconds_count{{stage="{_label_value(name)}"}} {count}')
+      lines.append(f'pipeline_stage_seconds_sum{{stage="{_label_value(name)}"}} {seconds:.6f}')
+    metrics = [
+      ('pipeline_llm_calls_total', 'counter', 'LLM calls.', 0),
+      ('pipeline_llm_errors_total', 'counter', 'LLM calls that raised.', 1),
+      ('pipeline_llm_prompt_tokens_total', 'counter', 'Prompt tokens sent to the model.', 2),
+      ('pipeline_llm_completion_tokens_total', 'counter', 'Completion tokens returned by the model.', 3),
+      ('pipeline_llm_seconds_total', 'counter', 'Time spent waiting on the model.', 4),
+    ]
+    for metric, kind, help_text, i in metrics:
+      lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {kind}']
+      for model, values in sorted(llms.items()):
+        value = f'{values[i]:.6f}' if isinstance(values[i], float) else values[i]
+        lines.append(f'{metric}{{model="{_label_value(model)}"}} {value}')
+    for name, value in (gauges or {}).items():
+      lines += [f'# TYPE {name} gauge', f'{name} {float(value)}']
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+######## ------ SPANS AND RUNS ------- #########
+
+@contextmanager
+def span(name, **attrs):
+  """Time a stage. Recorded on the current run (if any) and in the process-wide metrics."""
+  token = current_span.set(name)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    duration = time.perf_counter() - start
+    current_span.reset(token)
+    metrics.observe_stage(name, duration)
+    run = current_run.get()
+    if run is not None:
+      run.add_span(name, start, duration, attrs)
+
+
+@contextmanager
+def recorded_run(name, report_path=None):
+  """ Collect spans and LLM calls for the code in this block. Nested inside another run (e.g. a job),
+  the outer run is reused. With `report_path`, the report is written there when the block exits. """
+  run = current_run.get()
+  token = None
+  if run is None:
+    run = RunRecorder(name)
+    token = current_run.set(run)
+  try:
+    yield run
+  finally:
+    if token is not None:
+      current_run.reset(token)
+      run.finish()
+    if report_path:
+      write_json_atomic(report_path, run.report())
+      run.report_path = report_path
+
+
+######## ------ LLM CALLBACK ------- #########
+
+def _token_usage(response):
+  # newer chat models put usage on the message; older ones only in llm_output['token_usage']
+  prompt_tokens = completion_tokens = 0
+  for generations in response.generations:
+    for generation in generations:
+      usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None) or {}
+      prompt_tokens += usage.get('input_tokens', 0)
+      completion_tokens += usage.get('output_tokens', 0)
+  if not (prompt_tokens or completion_tokens):
+    usage = (response.llm_output or {}).get('token_usage') or {}
+    prompt_tokens = usage.get('prompt_tokens', 0)
+    completion_tokens = usage.get('completion_tokens', 0)
+  return prompt_tokens, completion_tokens
+
+
+class LLMUsageCallback(BaseCallbackHandler):
+  """Attach to a chat model (callbacks=[llm_usage_callback]) to record each call's latency, tokens and model."""
+
+  run_inline = True  # keep the caller's context (current run / span) in async code
+
+  def __init__(self):
+    self._pending = {}
+    self._lock = threading.Lock()
+
+  def _start(self, run_id, serialized, metadata):
+    model = (metadata or {}).get('ls_model_name') or ((serialized or {}).get('kwargs') or {}).get('model_name')
+    with self._lock:
+      self._pending[run_id] = (time.perf_counter(), model, current_run.get(), current_span.get())
+
+  def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+    self._start(run_id, serialized, metadata)
+
+  def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+    self._start(run_id, serialized, metadata)
+
+  def _end(self, run_id, prompt_tokens, completion_tokens, model=None, error=None):
+    with self._lock:
+      pending = self._pending.pop(run_id, None)
+    if pending is None:
+      return
+    start, start_model, run, span_name = pending
+    duration = time.perf_counter() - start
+    model = start_model or model or 'unknown'
+    metrics.observe_llm(model, duration, prompt_tokens, completion_tokens, error is not None)
+    if run is not None:
+      run.add_llm_call(model, span_name, start, duration, prompt_tokens, completion_tokens, error)
+
+  def on_llm_end(self, response, *, run_id, **kwargs):
+    prompt_tokens, completion_tokens = _token_usage(response)
+    self._end(run_id, prompt_tokens, completion_tokens, (response.llm_output or {}).get('model_name'))
+
+  def on_llm_error(self, error, *, run_id, **kwargs):
+    self._end(run_id, 0, 0, error=f"{type(error).__name__}: {error}")
+
+
+llm_usage_callback = LLMUsageCallback()
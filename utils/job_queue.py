@@ -0,0 +1,109 @@
+# This file contains a small background job subsystem for long pipeline runs.
+# Jobs run on a local worker pool, their records (status, progress, result, error) are persisted as JSON
+# so they survive page reloads and restarts, and the running code can report progress via report_progress().
+import contextvars
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.cache_utils import read_json, write_json_atomic
+from utils.instrumentation import recorded_run
+
+JOBS_FOLDER = os.getenv("JOBS_FOLDER") or 'jobs'
+JOB_WORKERS = int(os.getenv("JOB_WORKERS") or 4)
+
+QUEUED, RUNNING, FINISHED, FAILED = 'queued', 'running', 'finished', 'failed'
+
+current_job_id = contextvars.ContextVar('current_job_id', default=None)
+
+
+class JobQueue:
+  """Run functions in background threads and keep a persistent record of each run."""
+
+  def __init__(self, folder=JOBS_FOLDER, max_workers=JOB_WORKERS):
+    self.folder = folder
+    self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+    self._lock = threading.Lock()
+    os.makedirs(self.folder, exist_ok=True)
+    self._mark_interrupted()
+
+  def _path(self, job_id):
+    return os.path.join(self.folder, f"{job_id}.json")
+
+  def _mark_interrupted(self):
+    # jobs that were queued or running when the previous process exited will never finish
+    for file_name in os.listdir(self.folder):
+      if file_name.endswith('.json'):
+        job = read_json(os.path.join(self.folder, file_name))
+        if job and job.get('status') in (QUEUED, RUNNING):
+          self.update(job['id'], status=FAILED, error='Interrupted by a server restart', finished_at=time.time())
+
+  def get(self, job_id):
+    # ids come from URLs; only accept the hex ids we generate
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+      return None
+    return read_json(self._path(job_id))
+
+  def update(self, job_id, **fields):
+    with self._lock:
+      job = read_json(self._path(job_id)) or {}
+      job.update(fields, updated_at=time.time())
+      write_json_atomic(self._path(job_id), job)
+      return job
+
+  def submit(self, kind, fn, *args, **kwargs):
+    """Queue fn(*args, **kwargs) and return the new job's id right away."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    write_json_atomic(self._path(job_id), {
+      'id': job_id, 'kind': kind, 'status': QUEUED, 'progress': 0.0, 'message': 'Queued',
+      'created_at': now, 'updated_at': now, 'started_at': None, 'finished_at': None,
+      'result': None, 'error': None,
+    })
+    self._executor.submit(self._run, job_id, kind, fn, args, kwargs)
+    return job_id
+
+  def _run(self, job_id, kind, fn, args, kwargs):
+    self.update(job_id, status=RUNNING, message='Running', started_at=time.time())
+    token = current_job_id.set(job_id)
+    # what is recorded if fn raises something other than an Exception (e.g. SystemExit), which still propagates
+    fields = dict(status=FAILED, message='Failed', error='Interrupted before it finished')
+    run = None
+    try:
+      # the run report (stage timings, LLM calls) is kept with the job, for failed runs too
+      with recorded_run(kind) as run:
+        try:
+          result = fn(*args, **kwargs)
+          fields = dict(status=FINISHED, progress=1.0, message='Done', result=result)
+        except Exception as e:
+          print(f"Job {job_id} failed:\n{traceback.format_exc()}", flush=True)
+          fields = dict(status=FAILED, message='Failed', error=f"{type(e).__name__}: {e}")
+    finally:
+      current_job_id.reset(token)
+      self.update(job_id, **fields, report=run.report() if run is not None else None, finished_at=time.time())
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+  global _job_queue
+  with _job_queue_lock:
+    if _job_queue is None:
+      _job_queue = JobQueue()
+    return _job_queue
+
+
+def report_progress(message, fraction=None):
+  """Record progress on the job running in this context (no-op when called outside a job)."""
+  job_id = current_job_id.get()
+  if job_id is None:
+    return
+  fields = {'message': message}
+  if fraction is not None:
+    fields['progress'] = max(0.0, min(1.0, fraction))
+  get_job_queue().update(job_id, **fields)
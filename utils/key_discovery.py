@@ -0,0 +1,132 @@
+# This file contains join-key discovery for Part 3: instead of a hardcoded list of merge keys and aliases,
+# every data file is profiled once (utils/column_profiler.py: streamed in chunks, HyperLogLog + MinHash sketches,
+# cached by file content hash) and columns whose value sets overlap across files are clustered. Shards of a section
+# (files in one folder) with the same column are one member of a cluster. The cluster with a unique column in some
+# file, key-like names and the most sections is the entity key; in each file, the cluster's column becomes an alias.
+import os
+import re
+
+from utils.column_profiler import profile_csv
+from utils.sketches import MinHash, containment
+
+KEY_DISCOVERY_ENABLED = (os.getenv("KEY_DISCOVERY_ENABLED") or 'true').lower() == 'true'
+KEY_MIN_CONTAINMENT = float(os.getenv("KEY_MIN_CONTAINMENT") or 0.5)  # share of the smaller value set found in the other column
+KEY_UNIQUE_RATIO = float(os.getenv("KEY_UNIQUE_RATIO") or 0.95)  # distinct / rows for a column to be unique in its file (counts are approximate)
+KEY_MIN_CARDINALITY_RATIO = float(os.getenv("KEY_MIN_CARDINALITY_RATIO") or 0.01)  # smaller / larger distinct count of a linked pair
+KEY_NAME_PATTERN = re.compile(r'(^|_)(id|ids|uid|pid|hhid|key|code|handle)($|_)|id$', re.IGNORECASE)
+
+
+######## ------ PROFILING ------- #########
+
+def profile_file(path):
+  """Per-column non-null count, distinct count, fractional flag and MinHash, from the shared column profiles."""
+  return {col: {'rows': profile['rows'] - profile['nulls'], 'distinct': profile['distinct'],
+                'fractional': profile['fractional'], 'minhash': MinHash.from_dict(profile['minhash'])}
+          for col, profile in profile_csv(path).items()}
+
+
+def is_unique(stats, unique_ratio=KEY_UNIQUE_RATIO):
+  return stats['distinct'] >= unique_ratio * stats['rows']
+
+
+def is_key_candidate(column, stats, unique_ratio=KEY_UNIQUE_RATIO):
+  """ Key-like names may repeat (long tables); other columns only qualify if they are unique in their file, since on
+  small files bounded values (levels, counts) have nearly as many distinct values as rows. """
+  if stats['fractional'] or stats['distinct'] < 2:
+    return False
+  return bool(KEY_NAME_PATTERN.search(str(column))) or is_unique(stats, unique_ratio)
+
+
+######## ------ CLUSTERING ------- #########
+
+def links(stats_a, stats_b, min_containment=KEY_MIN_CONTAINMENT, min_cardinality_ratio=KEY_MIN_CARDINALITY_RATIO):
+  """ Whether two columns look like the same entity: most of the smaller value set is in the larger one, and the
+  smaller one is not just a short code list (item codes 100-199 are trivially contained in a 0-600k person id). """
+  smaller, larger = sorted([stats_a['distinct'], stats_b['distinct']])
+  if larger == 0 or smaller / larger < min_cardinality_ratio:
+    return False
+  return containment(stats_a['minhash'], stats_a['distinct'], stats_b['minhash'], stats_b['distinct']) >= min_containment
+
+
+def one_column_per_file(cluster):
+  """ Linking is transitive, so a cluster can hold two columns of one file (a key and a column that overlaps it).
+  Keep the column of each file whose values are best contained in the other files' columns of the cluster. """
+  def best_containment(node):
+    path, _, stats = node
+    return max((containment(stats['minhash'], stats['distinct'], other['minhash'], other['distinct'])
+                for other_path, _, other in cluster if other_path != path), default=0.0)
+
+  kept = {}
+  for node in cluster:
+    path, col, _ = node
+    score = (best_containment(node), bool(KEY_NAME_PATTERN.search(str(col))))
+    if path not in kept or score > kept[path][0]:
+      kept[path] = (score, node)
+  return [node for _, node in kept.values()]
+
+
+def discover_join_keys(paths, preferred_key=None, min_containment=KEY_MIN_CONTAINMENT):
+  """ Find the entity key shared by the data files.
+  Returns {'entity_key', 'aliases' ({path: {column: entity_key}}), 'merge_keys', 'files' ({path: key column})}
+  or None if no column set links at least two files. Each file contributes at most one key column, and its aliases
+  only rename that column. If `preferred_key` is a column of the files, its cluster is used and it names the key. """
+  nodes = []  # (path, column, stats)
+  for path in paths:
+    for col, stats in profile_file(path).items():
+      if is_key_candidate(col, stats):
+        nodes.append((path, col, stats))
+
+  # union-find over candidate columns; sketches are compared, the files are never scanned pairwise
+  parent = list(range(len(nodes)))
+
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+
+  for i in range(len(nodes)):
+    for j in range(i + 1, len(nodes)):
+      (path_i, col_i, stats_i), (path_j, col_j, stats_j) = nodes[i], nodes[j]
+      if path_i == path_j or find(i) == find(j):
+        continue
+      # shards of a section hold disjoint entities, so they are linked by their shared column name instead
+      if (os.path.dirname(path_i) == os.path.dirname(path_j) and col_i == col_j) or links(stats_i, stats_j, min_containment):
+        parent[find(i)] = find(j)
+
+  clusters = {}
+  for i, node in enumerate(nodes):
+    clusters.setdefault(find(i), []).append(node)
+
+  def sections(cluster, named_like_key=False):
+    return {os.path.dirname(path) for path, col, _ in cluster if not named_like_key or KEY_NAME_PATTERN.search(str(col))}
+
+  def rank(cluster):
+    # key-like names, then unique columns, then the most sections (not shards) linked, then the most entities
+    return (len(sections(cluster, named_like_key=True)),
+            sum(is_unique(stats) for _, _, stats in cluster),
+            len(sections(cluster)),
+            max(stats['distinct'] for _, _, stats in cluster))
+
+  # an entity key identifies the rows of at least one file
+  linked = [cluster for cluster in map(one_column_per_file, clusters.values())
+            if len(cluster) > 1 and any(is_unique(stats) for _, _, stats in cluster)]
+  preferred = [cluster for cluster in linked if any(col == preferred_key for _, col, _ in cluster)]
+  if not (preferred or linked):
+    return None
+  best = max(preferred or linked, key=rank)
+
+  names = [col for _, col, _ in best]
+  if preferred:
+    entity_key = preferred_key
+  else:
+    unique_names = {col for _, col, stats in best if is_unique(stats)}
+    entity_key = max(dict.fromkeys(names), key=lambda col: (names.count(col), col in unique_names,
+                                                             bool(KEY_NAME_PATTERN.search(str(col))), -len(col)))
+  return {
+    'entity_key': entity_key,
+    'aliases': {path: {col: entity_key} if col != entity_key else {} for path, col, _ in best},
+    # every file's key column is read under the entity key's name
+    'merge_keys': [entity_key],
+    'files': {path: col for path, col, _ in best},
+  }
@@ -0,0 +1,174 @@
+# This file contains a persistent, content-addressed cache for structured GenAI requests.
+# Entries are keyed by (rendered prompt, return schema, model name), so re-running the same
+# bundle returns the same answers without a model round trip.
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from utils.cache_utils import CACHE_FOLDER, stable_hash
+
+LLM_CACHE_FOLDER = os.getenv("LLM_CACHE_FOLDER") or os.path.join(CACHE_FOLDER, 'llm')
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES") or 256 * 1024 * 1024)
+LLM_CACHE_ENABLED = (os.getenv("LLM_CACHE_ENABLED") or 'true').lower() == 'true'
+
+
+def get_model_name(llm):
+  """Best-effort model identifier for a LangChain chat model."""
+  return getattr(llm, 'model_name', None) or getattr(llm, 'model', None) or type(llm).__name__
+
+
+def render_prompt(prompt):
+  """Turn a prompt value / message list / string into the exact text sent to the model."""
+  if hasattr(prompt, 'to_string'):
+    return prompt.to_string()
+  return str(prompt)
+
+
+class LLMCache:
+  """On-disk cache of structured responses with size-based LRU eviction and hit/miss counters."""
+
+  def __init__(self, folder=LLM_CACHE_FOLDER, max_bytes=LLM_CACHE_MAX_BYTES, enabled=LLM_CACHE_ENABLED):
+    self.folder = folder
+    self.max_bytes = max_bytes
+    self.enabled = enabled
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+    self._entries = None  # key -> size in bytes, least recently used first
+    self._total_bytes = 0
+
+  def _load_index(self):
+    # lazily scan the folder once; mtime is the last-used time (refreshed on every hit)
+    if self._entries is not None:
+      return
+    os.makedirs(self.folder, exist_ok=True)
+    files = []
+    for entry in os.scandir(self.folder):
+      if entry.name.endswith('.json'):
+        stat = entry.stat()
+        files.append((stat.st_mtime, entry.name[:-len('.json')], stat.st_size))
+    self._entries = OrderedDict((key, size) for _, key, size in sorted(files))
+    self._total_bytes = sum(self._entries.values())
+
+  def _path(self, key):
+    return os.path.join(self.folder, f"{key}.json")
+
+  def make_key(self, prompt, schema, model_name):
+    schema_json = json.dumps(schema.model_json_schema(), sort_keys=True)
+    return stable_hash(render_prompt(prompt), schema.__name__, schema_json, model_name)
+
+  def get(self, key, schema):
+    """Return the cached response parsed into `schema`, or None on a miss (or when bypassed)."""
+    if not self.enabled:
+      return None
+    with self._lock:
+      self._load_index()
+      if key not in self._entries:
+        self.misses += 1
+        return None
+    # the file is read without the lock, so concurrent lookups do not wait on each other's IO
+    try:
+      with open(self._path(key)) as f:
+        response = schema.model_validate(json.load(f)['response'])
+      os.utime(self._path(key))
+    except (OSError, ValueError, KeyError):
+      # unreadable, stale or just evicted entry: drop it and treat as a miss
+      with self._lock:
+        self._remove(key)
+        self.misses += 1
+      return None
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+      self.hits += 1
+    return response
+
+  def put(self, key, response, model_name=None):
+    if not self.enabled or response is None:
+      return
+    payload = json.dumps({
+      'schema': type(response).__name__,
+      'model': model_name,
+      'response': response.model_dump(),
+    })
+    tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with self._lock:
+      self._load_index()
+    with open(tmp_path, 'w') as f:
+      f.write(payload)
+    with self._lock:
+      os.replace(tmp_path, self._path(key))
+      if key in self._entries:
+        self._total_bytes -= self._entries.pop(key)
+      self._entries[key] = len(payload)
+      self._total_bytes += len(payload)
+      self._evict()
+
+  def _remove(self, key):
+    self._total_bytes -= self._entries.pop(key, 0)
+    try:
+      os.remove(self._path(key))
+    except OSError:
+      pass
+
+  def _evict(self):
+    # drop least recently used entries until we are back under the size budget
+    while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+      oldest_key = next(iter(self._entries))
+      self._remove(oldest_key)
+      self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._load_index()
+      for key in list(self._entries):
+        self._remove(key)
+
+  def stats(self):
+    with self._lock:
+      self._load_index()
+      return {
+        'enabled': self.enabled,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'entries': len(self._entries),
+        'bytes': self._total_bytes,
+      }
+
+
+llm_cache = LLMCache()
+
+
+class CachedStructuredLLM:
+  """Wraps `llm.with_structured_output(schema)` and answers repeated prompts from the cache."""
+
+  def __init__(self, llm, schema, cache=None):
+    self.runnable = llm.with_structured_output(schema=schema)
+    self.schema = schema
+    self.model_name = get_model_name(llm)
+    self.cache = cache or llm_cache
+
+  def invoke(self, prompt):
+    key = self.cache.make_key(prompt, self.schema, self.model_name)
+    response = self.cache.get(key, self.schema)
+    if response is None:
+      response = self.runnable.invoke(prompt)
+      self.cache.put(key, response, self.model_name)
+    return response
+
+  async def ainvoke(self, prompt):
+    # cache IO runs in a thread, so the event loop keeps serving the other concurrent calls meanwhile
+    key = self.cache.make_key(prompt, self.schema, self.model_name)
+    response = await asyncio.to_thread(self.cache.get, key, self.schema)
+    if response is None:
+      response = await self.runnable.ainvoke(prompt)
+      await asyncio.to_thread(self.cache.put, key, response, self.model_name)
+    return response
+
+
+def cached_structured_output(llm, schema, cache=None):
+  return CachedStructuredLLM(llm, schema, cache)
@@ -0,0 +1,143 @@
+# This file contains the Part 3 manifest: per data file content and Part 3 config, what Part 3 made of it
+# (selected columns and their profiles, the rename mapping it applied, its aggregated per-entity frame and the code used).
+# A rerun with an unchanged file and config replays these instead of reading and aggregating again; only the rename
+# step is replayed against the frames collected before the file, so adding or reordering other files keeps the reuse.
+import os
+import threading
+import time
+
+import pandas as pd
+
+from utils.cache_utils import CACHE_FOLDER, cached_file_hash, read_json, stable_hash, write_json_atomic
+from utils.part3_workers import RENAME_SAFE_SHAPES, PreparedFile
+
+PART_3_CACHE_FOLDER = os.getenv("PART_3_CACHE_FOLDER") or os.path.join(CACHE_FOLDER, 'part3')
+PART_3_INCREMENTAL = (os.getenv("PART_3_INCREMENTAL") or 'true').lower() == 'true'
+PART_3_CACHE_MAX_ENTRIES = int(os.getenv("PART_3_CACHE_MAX_ENTRIES") or 1000)  # least recently used entries are evicted beyond this
+
+
+class Part3Manifest:
+  """ {(content hash, config hash): entry} persisted as JSON, with the aggregated frames (and column profiles) pickled
+  next to it. Pickle (not CSV/Parquet) so cached frames come back with exactly the dtypes they were stored with.
+  Entries are shared by every bundle and job, evicted least recently used first, and guarded by a lock. """
+
+  def __init__(self, folder=PART_3_CACHE_FOLDER, enabled=PART_3_INCREMENTAL, max_entries=PART_3_CACHE_MAX_ENTRIES):
+    self.folder = folder
+    self.enabled = enabled
+    self.max_entries = max(1, max_entries)
+    self.manifest_path = os.path.join(folder, 'manifest.json')
+    stored = read_json(self.manifest_path, {}) if enabled else {}
+    self.entries = stored.get('entries', {})  # entries of the older per-path layout are not reused
+    self.files = stored.get('files', {})  # abs path -> {'size', 'mtime_ns', 'content_hash'}, to skip hashing
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def _key(self, content_hash, config_hash):
+    return stable_hash(content_hash, config_hash)
+
+  def _data_path(self, data_id):
+    return os.path.join(self.folder, 'frames', f"{data_id}.pkl")
+
+  def _save(self):
+    # called with the lock held
+    write_json_atomic(self.manifest_path, {'entries': self.entries, 'files': self.files})
+
+  def _stored_hash(self, file_path):
+    stat = os.stat(file_path)
+    known = self.files.get(os.path.abspath(file_path))
+    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+      return known['content_hash']
+    return None
+
+  def content_hash(self, file_path):
+    """File content hash; reuses the stored one while size and mtime are unchanged."""
+    return self._stored_hash(file_path) or cached_file_hash(file_path)
+
+  def expects_hit(self, file_path, config_hash):
+    """Cheap guess (no hashing) whether lookup will find this file: same size and mtime as when recorded, same config."""
+    if not self.enabled:
+      return False
+    content_hash = self._stored_hash(file_path)
+    return content_hash is not None and self._key(content_hash, config_hash) in self.entries
+
+  def lookup(self, content_hash, config_hash):
+    """The entry for this file content under this Part 3 config, or None (counted as a miss)."""
+    if not self.enabled:
+      return None
+    with self._lock:
+      entry = self.entries.get(self._key(content_hash, config_hash))
+    if entry is None or not os.path.exists(self._data_path(entry['data_id'])):
+      self.misses += 1
+      return None
+    return entry
+
+  def load(self, entry):
+    """{'frame': the aggregated frame or None, 'column_profiles': the profiles of the columns as read}."""
+    return pd.read_pickle(self._data_path(entry['data_id']))
+
+  def stand_in(self, entry, column_profiles):
+    """What the rename step needs of the file: its columns and their profiles, without reading it."""
+    return PreparedFile(None, pd.Index(entry['filtered_columns']), column_profiles)
+
+  def reuse(self, entry, frame, mapping):
+    """ (True, the cached `frame` under `mapping`) if the entry can be replayed with the rename mapping computed for this
+    run, else (False, None), counted as a miss. With the mapping it was stored under, the frame is reused as is; with
+    another one only if its columns are the renamed input columns, as after rule-based aggregation of those shapes. """
+    if frame is not None and (mapping or None) != (entry['mappings'] or None):
+      if entry['table_shape'] not in RENAME_SAFE_SHAPES:
+        self.misses += 1
+        return False, None
+      stored, current = entry['mappings'] or {}, mapping or {}
+      frame = frame.rename(columns={stored.get(col, col): current.get(col, col) for col in entry['filtered_columns']})
+    self.hits += 1
+    with self._lock:
+      entry['used_at'] = time.time()
+      self._save()
+    return True, frame
+
+  def record(self, file_path, content_hash, config_hash, reference_columns, filtered_columns, mappings,
+             frame=None, table_shape=None, code=None, column_profiles=None):
+    """ Store the outcome for one file. `frame` is None for files that did not make it into the merge;
+    their rename mapping is still recorded because it was applied to the frames collected before them. """
+    if not self.enabled:
+      return
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    key = self._key(content_hash, config_hash)
+    data_id = stable_hash(key, mappings)
+    path = self._data_path(data_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pd.to_pickle({'frame': frame, 'column_profiles': column_profiles}, tmp_path)
+    os.replace(tmp_path, path)
+    with self._lock:
+      previous = self.entries.pop(key, None)
+      self.entries[key] = {
+        'content_hash': content_hash, 'config_hash': config_hash, 'reference_columns': list(reference_columns),
+        'filtered_columns': list(filtered_columns), 'mappings': mappings, 'data_id': data_id,
+        'table_shape': table_shape, 'code': code, 'used_at': time.time(),
+      }
+      self.files.pop(file_path, None)
+      self.files[file_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'content_hash': content_hash}
+      dropped = [previous] if previous and previous['data_id'] != data_id else []
+      dropped += self._evict()
+      self._save()
+    for entry in dropped:
+      try:
+        os.remove(self._data_path(entry['data_id']))
+      except OSError:
+        pass
+
+  def _evict(self):
+    # called with the lock held; returns the evicted entries, whose data files are removed outside the lock
+    evicted = []
+    if len(self.entries) > self.max_entries:
+      by_use = sorted(self.entries, key=lambda key: self.entries[key]['used_at'])
+      evicted = [self.entries.pop(key) for key in by_use[:len(self.entries) - self.max_entries]]
+    while len(self.files) > 4 * self.max_entries:
+      self.files.pop(next(iter(self.files)))
+    return evicted
+
+
+part_3_manifest = Part3Manifest()
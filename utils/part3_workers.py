@@ -0,0 +1,136 @@
+# This file contains the per-file preparation step of Part 3 and its parallel mode (PART_3_WORKERS > 1).
+# Preparing a file (reading the selected columns, normalizing key aliases, compact dtypes, column profiles for the
+# schema matcher, and rule-based aggregation where renaming afterwards gives the same result) depends on nothing but
+# the file, so it can run ahead in a pool of worker processes. Renaming against the earlier files, LLM aggregation and
+# the merge stay in the calling process, in file order, so the result does not depend on the number of workers.
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.schema_matcher import profile_column
+from utils.transform_utils import classify_table_shape, optimize_dtypes, read_selected_columns, rule_based_aggregate, write_frame
+
+PART_3_WORKERS = int(os.getenv("PART_3_WORKERS") or os.cpu_count() or 1)  # 1 prepares every file in the calling process
+PART_3_START_METHOD = os.getenv("PART_3_START_METHOD") or 'spawn'
+PART_3_PREFETCH_PER_WORKER = 2  # prepared files waiting to be consumed, per worker; bounds the frames held
+# shapes whose aggregation keeps the column names (pivoted 'long' tables name their columns after the values), so
+# these can be aggregated before the file's columns are renamed
+RENAME_SAFE_SHAPES = ('per_entity', 'repeated_numeric')
+
+
+class PreparedFile:
+  """ One data file, ready for renaming: `frame` (already aggregated if `table_shape` is set), the `columns` that were
+  read, and their schema-matcher profiles (of the values as read), which is all SchemaMatcher.match needs of it. """
+
+  def __init__(self, frame, columns, column_profiles=None, table_shape=None):
+    self.frame = frame
+    self.columns = columns
+    self.column_profiles = column_profiles
+    self.table_shape = table_shape
+
+
+def prepare_file(data_file_path, columns_to_keep, alias_keys, entity_key, chunksize=None, compact_dtypes=True,
+                 rule_based=True, numeric_agg='sum', profile_columns=True, intermediate_folder=None, intermediate_format='csv'):
+  """The part of Part 3 that only depends on the file itself; runs in a worker process in parallel mode."""
+  filtered_df = read_selected_columns(data_file_path, columns_to_keep, alias_keys, entity_key, chunksize)
+  if compact_dtypes:
+    filtered_df = optimize_dtypes(filtered_df, entity_key)
+  if filtered_df.columns.empty:
+    return PreparedFile(filtered_df, filtered_df.columns)
+
+  # the generated code gets the frame in memory; the intermediate file is only for inspection
+  if intermediate_folder:
+    write_frame(filtered_df, os.path.join(intermediate_folder, os.path.splitext(os.path.basename(data_file_path))[0]), intermediate_format)
+
+  column_profiles = None
+  if profile_columns:
+    column_profiles = {col: profile_column(filtered_df[col]) for col in filtered_df.columns if col != entity_key}
+  if rule_based and classify_table_shape(filtered_df, entity_key)[0] in RENAME_SAFE_SHAPES:
+    aggregated_df, table_shape = rule_based_aggregate(filtered_df, entity_key, numeric_agg)
+    return PreparedFile(aggregated_df, filtered_df.columns, column_profiles, table_shape)
+  return PreparedFile(filtered_df, filtered_df.columns, column_profiles)
+
+
+######## ------ WORKER POOL ------- #########
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+  # started on first use and kept for later runs: spawned workers re-import the app, which takes seconds
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(PART_3_START_METHOD))
+    return _pool
+
+
+def _reset_pool(pool):
+  global _pool
+  with _pool_lock:
+    if _pool is pool:
+      _pool = None
+  pool.shutdown(wait=False, cancel_futures=True)
+
+
+class FilePreparer:
+  """ Hands out prepare_file results in file order. With more than one worker, the `prefetch` files are prepared ahead
+  in the worker pool, with at most 1 + PART_3_PREFETCH_PER_WORKER files per worker in flight, so memory stays bounded
+  while the caller waits on the LLM. Other files (e.g. ones the manifest should replay) are prepared inline if they
+  are asked for. Errors are raised from get() for the file that caused them.
+  `file_settings` ({path: {setting: value}}) override `settings` for single files, e.g. their key aliases. """
+
+  def __init__(self, prefetch, workers=PART_3_WORKERS, file_settings=None, **settings):
+    self.settings = settings
+    self.file_settings = file_settings or {}
+    self.queue = list(prefetch)
+    self.futures = {}
+    self.pool = _get_pool(workers) if workers > 1 and len(self.queue) > 1 else None
+    self.window = workers * (1 + PART_3_PREFETCH_PER_WORKER)
+    self._fill()
+
+  def _fill(self):
+    while self.pool is not None and self.queue and len(self.futures) < self.window:
+      path = self.queue.pop(0)
+      self.futures[path] = self.pool.submit(prepare_file, path, **self._settings(path))
+
+  def _settings(self, path):
+    return {**self.settings, **self.file_settings.get(path, {})}
+
+  def get(self, path):
+    """The PreparedFile for `path`, from its worker or prepared now."""
+    future = self.futures.pop(path, None)
+    if path in self.queue:
+      self.queue.remove(path)
+    try:
+      if future is None:
+        return prepare_file(path, **self._settings(path))
+      try:
+        return future.result()
+      except BrokenProcessPool:
+        # a worker died, most likely the OOM killer: the pool is replaced for later runs, this one continues inline
+        print("⚠️ A Part 3 worker died (most likely out of memory); preparing the remaining files in this process.")
+        _reset_pool(self.pool)
+        self.close()
+        return prepare_file(path, **self._settings(path))
+    finally:
+      self._fill()
+
+  def discard(self, path):
+    """`path` is not needed after all (the manifest replayed it)."""
+    future = self.futures.pop(path, None)
+    if future is not None:
+      future.cancel()
+    if path in self.queue:
+      self.queue.remove(path)
+    self._fill()
+
+  def close(self):
+    """Cancel what was not consumed; the pool itself stays up for the next run."""
+    for future in self.futures.values():
+      future.cancel()
+    self.futures.clear()
+    self.pool = None
@@ -0,0 +1,111 @@
+# This file contains a page-text store for metadata PDFs.
+# Each PDF is identified by the hash of its content, parsed lazily one page at a time, and the
+# extracted text is kept on disk so categories and later runs never re-parse it, and in memory for the most
+# recently used files only, so a long-running app does not hold every uploaded PDF.
+import os
+import threading
+from collections import OrderedDict
+
+from pypdf import PdfReader
+
+from utils.cache_utils import CACHE_FOLDER, file_hash, read_json, write_json_atomic
+
+PDF_CACHE_FOLDER = os.getenv("PDF_CACHE_FOLDER") or os.path.join(CACHE_FOLDER, 'pdf_pages')
+PDF_STORE_MAX_FILES = int(os.getenv("PDF_STORE_MAX_FILES") or 8)  # PDFs whose pages (and open reader) stay in memory
+
+
+class PdfPageStore:
+  """Serve the text of single PDF pages, extracting each page at most once per file content."""
+
+  def __init__(self, folder=PDF_CACHE_FOLDER, max_files=PDF_STORE_MAX_FILES):
+    self.folder = folder
+    self.max_files = max(1, max_files)
+    self._lock = threading.Lock()
+    self._file_locks = {}  # content hash -> lock guarding its reader and page dict
+    self._hashes = OrderedDict()  # (path, size, mtime) -> content hash
+    self._hashing = {}  # (path, size, mtime) -> lock held while that file is hashed, so it is hashed once
+    self._pages = OrderedDict()  # content hash -> {'num_pages': int, 'pages': {index: text}}, least recently used first
+    self._readers = OrderedDict()  # content hash -> open PdfReader, only while some of its pages are not extracted yet
+
+  def content_hash(self, file_path):
+    stat = os.stat(file_path)
+    stat_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with self._lock:
+      digest = self._hashes.get(stat_key)
+      if digest is not None:
+        self._hashes.move_to_end(stat_key)
+        return digest
+      hashing = self._hashing.setdefault(stat_key, threading.Lock())
+    with hashing:
+      with self._lock:
+        digest = self._hashes.get(stat_key)
+      if digest is None:
+        digest = file_hash(file_path)
+        self._remember(self._hashes, stat_key, digest, 16 * self.max_files)
+    with self._lock:
+      self._hashing.pop(stat_key, None)
+    return digest
+
+  def _remember(self, cache, key, value, limit):
+    # keep `key` as the most recently used entry of `cache` and evict the oldest beyond `limit`
+    with self._lock:
+      cache[key] = value
+      cache.move_to_end(key)
+      while len(cache) > limit:
+        cache.popitem(last=False)
+
+  def _cache_file(self, digest):
+    return os.path.join(self.folder, f"{digest}.json")
+
+  def _entry(self, file_path, digest):
+    # called with the file lock held
+    entry = self._pages.get(digest)
+    if entry is None:
+      entry = read_json(self._cache_file(digest))
+      if entry is not None:
+        entry['pages'] = {int(i): text for i, text in entry['pages'].items()}
+      else:
+        entry = {'num_pages': len(self._reader(file_path, digest).pages), 'pages': {}}
+    self._remember(self._pages, digest, entry, self.max_files)
+    return entry
+
+  def _reader(self, file_path, digest):
+    reader = self._readers.get(digest)
+    if reader is None:
+      reader = PdfReader(file_path)
+      self._remember(self._readers, digest, reader, self.max_files)
+    return reader
+
+  def _file_lock(self, digest):
+    with self._lock:
+      return self._file_locks.setdefault(digest, threading.Lock())
+
+  def page_count(self, file_path):
+    digest = self.content_hash(file_path)
+    with self._file_lock(digest):
+      return self._entry(file_path, digest)['num_pages']
+
+  def get_pages(self, file_path, page_indices):
+    """Return the text of the requested pages, extracting only the ones not seen before."""
+    digest = self.content_hash(file_path)
+    with self._file_lock(digest):
+      entry = self._entry(file_path, digest)
+      missing = [i for i in page_indices if i not in entry['pages']]
+      for i in missing:
+        entry['pages'][i] = self._reader(file_path, digest).pages[i].extract_text()
+      if missing:
+        write_json_atomic(self._cache_file(digest), entry)
+      if len(entry['pages']) >= entry['num_pages']:
+        # every page is on disk now, so the reader (and the parsed PDF it holds) is not needed anymore
+        with self._lock:
+          self._readers.pop(digest, None)
+      return [entry['pages'][i] for i in page_indices]
+
+  def get_page(self, file_path, page_index):
+    return self.get_pages(file_path, [page_index])[0]
+
+  def all_pages(self, file_path):
+    return self.get_pages(file_path, range(self.page_count(file_path)))
+
+
+pdf_page_store = PdfPageStore()
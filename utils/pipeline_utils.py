@@ -1,20 +1,27 @@
 # AUXILIARY UTILS
 from re import S
-from openpyxl import *
+from contextlib import contextmanager
+import openpyxl
 import os
 import xlrd
-from langchain_community.document_loaders import PyPDFLoader
-import io
-import contextlib
+from langchain_core.documents import Document
 import google.generativeai as genai
 from google.generativeai.types import content_types
 import pandas as pd
+from utils.pdf_store import pdf_page_store
+from utils.code_executor import run_code
+from utils.section_mapper import map_sections_from_text
+from utils.cache_utils import cache_path, read_json, write_json_atomic
+from utils.instrumentation import span
 
 UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER') or 'uploads'
+SECTION_MAP_MIN_COVERAGE = float(os.getenv('SECTION_MAP_MIN_COVERAGE') or 0.6)
+SPREADSHEET_CHUNK_ROWS = int(os.getenv('SPREADSHEET_CHUNK_ROWS') or 1000)  # rows per text chunk from iter_sheet_text
 
 ######## ------ GENERAL UTILS -------- #########
-def parquet_viewer(filepath):
-  df = pd.read_parquet(filepath)
+def parquet_viewer(filepath, columns=None):
+  # columnar: only the requested columns are read from disk
+  df = pd.read_parquet(filepath, columns=columns)
   return df
 
 # def construct_path_dict():
@@ -27,38 +34,117 @@ def parquet_viewer(filepath):
 ######## ------ PART 2: RELEVANT FIELD SELECTION ------- #########
 
 def load_pdf(file_name, page_indices=[0]):
-  loader = PyPDFLoader(file_name)
-  documents = loader.load()
-  return [documents[i] for i in page_indices]
+  # pages come from the shared page store, so each PDF is only parsed once (and only the pages we ask for)
+  with span('pdf.load', file=os.path.basename(file_name), pages=len(page_indices)):
+    page_texts = pdf_page_store.get_pages(file_name, page_indices)
+  return [Document(page_content=text, metadata={'source': file_name, 'page': i}) for i, text in zip(page_indices, page_texts)]
+
+def estimate_tokens(text):
+  # ~4 characters per token for English text and JSON; only used to pack requests, so a rough bound is enough
+  return len(text) // 4 + 1
+
+def pack_by_token_budget(items, token_counts, budget, overhead=0):
+  """ Greedily group items, in order, so each group's tokens plus `overhead` (the per-request boilerplate)
+  stay within `budget`. An item that does not fit on its own gets a group of its own. """
+  groups, group, group_tokens = [], [], overhead
+  for item, tokens in zip(items, token_counts):
+    if group and group_tokens + tokens > budget:
+      groups.append(group)
+      group, group_tokens = [], overhead
+    group.append(item)
+    group_tokens += tokens
+  if group:
+    groups.append(group)
+  return groups
+
+def read_task_description(file_path):
+  """Plain text of the task description (.pdf or .txt next to `file_path`), or '' if there is none."""
+  base_file_path = os.path.splitext(file_path)[0]
+  if os.path.exists(base_file_path + ".pdf"):
+    return '\n'.join(pdf_page_store.all_pages(base_file_path + ".pdf"))
+  if os.path.exists(base_file_path + ".txt"):
+    with open(base_file_path + ".txt", errors='replace') as f:
+      return f.read()
+  return ''
 
 def extract_all_sections(category, prefix):
   all_files = os.listdir(category)
   # extract section number and sort alphabetically
   return sorted([file_name[len(prefix):].replace(".csv", "") for file_name in all_files])
 
-def load_xls(file_name, sheet_name=None):
-  output = ""
-  workbook = xlrd.open_workbook(file_name)
-  sheet = workbook.sheet_by_index(0)
-  if sheet_name:
-    sheet = workbook.sheet_by_name(sheet_name)
-  for r in range(sheet.nrows):
-    output += '\n'
-    for c in range(sheet.ncols):
-      output += str(sheet.cell_value(r, c))
-
-  return output
+@contextmanager
+def open_sheet(file_name, sheet_name=None):
+  """The named (default: first) sheet of an .xls workbook (xlrd) or an .xlsx/.xlsm one (openpyxl, read-only: rows are streamed)."""
+  if file_name.lower().endswith(('.xlsx', '.xlsm')):
+    workbook = openpyxl.load_workbook(file_name, read_only=True, data_only=True)
+    try:
+      yield workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+    finally:
+      workbook.close()
+  else:
+    workbook = xlrd.open_workbook(file_name, on_demand=True)
+    try:
+      yield workbook.sheet_by_name(sheet_name) if sheet_name else workbook.sheet_by_index(0)
+    finally:
+      workbook.release_resources()
+
+def iter_sheet_rows(sheet, max_rows=None, max_cols=None):
+  """ Cells of an xlrd sheet or openpyxl worksheet as strings, row by row, up to `max_rows` x `max_cols`.
+  Empty cells are '' (xlrd's own empty value), everything else str(value). """
+  if hasattr(sheet, 'iter_rows'):
+    for row in sheet.iter_rows(max_row=max_rows, max_col=max_cols, values_only=True):
+      yield ['' if value is None else str(value) for value in row]
+  else:
+    for r in range(sheet.nrows if max_rows is None else min(sheet.nrows, max_rows)):
+      yield [str(value) for value in sheet.row_values(r, 0, max_cols)]
+
+def iter_sheet_text(sheet, max_rows=None, max_cols=None, chunk_rows=SPREADSHEET_CHUNK_ROWS):
+  """ Text of a sheet (every row is a newline followed by its cells) in chunks of `chunk_rows` rows.
+  Joined once per chunk instead of appended cell by cell, so big sheets convert in linear time. """
+  chunk = []
+  for cells in iter_sheet_rows(sheet, max_rows, max_cols):
+    chunk.append('\n' + ''.join(cells))
+    if len(chunk) >= chunk_rows:
+      yield ''.join(chunk)
+      chunk = []
+  if chunk:
+    yield ''.join(chunk)
+
+def iter_xls_text(file_name, sheet_name=None, max_rows=None, max_cols=None, chunk_rows=SPREADSHEET_CHUNK_ROWS):
+  """Stream the text of a workbook's sheet (see open_sheet and iter_sheet_text)."""
+  with open_sheet(file_name, sheet_name) as sheet:
+    yield from iter_sheet_text(sheet, max_rows, max_cols, chunk_rows)
+
+def load_xls(file_name, sheet_name=None, max_rows=None, max_cols=None):
+  return ''.join(iter_xls_text(file_name, sheet_name, max_rows, max_cols))
+
+def sheet_to_text(sheet, max_rows=None, max_cols=None):
+  return ''.join(iter_sheet_text(sheet, max_rows, max_cols))
 
-def sheet_to_text(sheet):
-  output = ""
-  for r in range(sheet.nrows):
-    output += '\n'
-    for c in range(sheet.ncols):
-      output += str(sheet.cell_value(r, c))
+def map_section_to_page_number(file_path):
+  """ Map each section of a metadata PDF to its (zero-indexed) pages, e.g. {'1': [0], '2a': [1, 2]}.
+  Tries the local heading/TOC scan first and only uploads to Gemini if it covers too few pages.
+  Results are memoized by the file's content hash. """
+  digest = pdf_page_store.content_hash(file_path)
+  memo_path = cache_path('section_maps', f"{digest}.json")
+  section_map = read_json(memo_path)
+  if section_map is not None:
+    return section_map
+
+  section_map, coverage = map_sections_from_text(pdf_page_store.all_pages(file_path))
+  print(f"Local section scan of {file_path} found {len(section_map)} sections covering {coverage:.0%} of pages")
+  if coverage < SECTION_MAP_MIN_COVERAGE:
+    try:
+      section_map = map_section_to_page_number_gemini(file_path)
+    except Exception as e:
+      if not section_map:
+        raise
+      print(f"⚠️ Gemini section mapping failed ({e!r}); keeping the local map")
 
-  return output
+  write_json_atomic(memo_path, section_map)
+  return section_map
 
-def map_section_to_page_number(file_path):
+def map_section_to_page_number_gemini(file_path):
   genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
   model = genai.GenerativeModel('gemini-1.5-flash')
   sample_file = genai.upload_file(path=file_path, display_name="Agriculture Questionnaire")
@@ -82,15 +168,9 @@ def map_section_to_page_number(file_path):
 
 ######## ------ PART 3: DATASET TRANSFORMATION (AGGREGATION) ------- #########
 
-def run_code_and_capture_df(code_str, df_name="df"):
-    local_vars = {}
-    output_buffer = io.StringIO()
-
-    try:
-        with contextlib.redirect_stdout(output_buffer):
-            exec(code_str, {}, local_vars)
-        output = output_buffer.getvalue()
-        df = local_vars.get(df_name, None)
-        return {"output": output, "dataframe": df}
-    except Exception as e:
-        return {"error": str(e), "output": output_buffer.getvalue()}
+def run_code_and_capture_df(code_str, df_name="df", mode=None, inputs=None):
+  """ Run generated code and return {"output": stdout, "dataframe": df_name} or {"error": ..., "output": ...}.
+  By default the code runs in an isolated worker process with time and memory limits (see utils/code_executor.py);
+  pass mode='inline' (or set CODE_EXECUTION_MODE=inline) to exec it in this process.
+  `inputs` ({name: object}) are made available to the code, e.g. {'df': filtered_df}. """
+  return run_code(code_str, df_name, mode, inputs)
@@ -0,0 +1,206 @@
+# This file contains a local schema matcher for Part 3 column renaming.
+# Each new column is scored against the reference columns (the frames collected so far) on name similarity
+# (tokens and edit distance, ignoring unit suffixes like _seconds/_minutes) and value-distribution similarity.
+# Both sides are profiled on the values as read, before aggregation. Clear matches and clear non-matches are decided
+# locally; only ambiguous columns go to the renaming LLM, and its verdicts are cached per pair of (column, profile).
+import os
+import re
+import threading
+from difflib import SequenceMatcher
+
+import numpy as np
+import pandas as pd
+
+from utils.cache_utils import CACHE_FOLDER, read_json, stable_hash, write_json_atomic
+
+SCHEMA_MATCHER_ENABLED = (os.getenv("SCHEMA_MATCHER_ENABLED") or 'true').lower() == 'true'
+SCHEMA_MATCH_ACCEPT = float(os.getenv("SCHEMA_MATCH_ACCEPT") or 0.8)  # rename without asking at or above this score...
+SCHEMA_MATCH_MARGIN = float(os.getenv("SCHEMA_MATCH_MARGIN") or 0.1)  # ...if the runner-up is at least this far behind
+SCHEMA_MATCH_REJECT = float(os.getenv("SCHEMA_MATCH_REJECT") or 0.45)  # below this, no reference column is a candidate
+SCHEMA_MATCH_CACHE_PATH = os.getenv("SCHEMA_MATCH_CACHE_PATH") or os.path.join(CACHE_FOLDER, 'schema_matches.json')
+PROFILE_SAMPLE_ROWS = 10000
+PROFILE_QUANTILES = np.linspace(0.05, 0.95, 19)
+
+# unit and quantity words carry no meaning for "is this the same concept" (clicks_total ~ num_clicks)
+IGNORED_NAME_TOKENS = frozenset("""
+s sec secs second seconds ms millis milliseconds min mins minute minutes h hr hrs hour hours day days
+pct percent percentage usd eur num number count cnt total tot n of
+""".split())
+
+
+def name_tokens(column):
+  text = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(column)).lower()
+  tokens = [t for t in re.split(r'[^a-z0-9]+', text) if t]
+  return [t for t in tokens if t not in IGNORED_NAME_TOKENS] or tokens
+
+
+def name_similarity(a, b):
+  """Mean of token Jaccard and edit-distance ratio of the normalized names, in [0, 1]."""
+  tokens_a, tokens_b = name_tokens(a), name_tokens(b)
+  jaccard = len(set(tokens_a) & set(tokens_b)) / max(1, len(set(tokens_a) | set(tokens_b)))
+  ratio = SequenceMatcher(None, '_'.join(tokens_a), '_'.join(tokens_b)).ratio()
+  return (jaccard + ratio) / 2
+
+
+def profile_column(series):
+  """Scale-free summary of a column: standardized quantiles for numbers, the most frequent values otherwise."""
+  series = series.dropna()
+  if len(series) > PROFILE_SAMPLE_ROWS:
+    series = series.sample(PROFILE_SAMPLE_ROWS, random_state=0)
+  if pd.api.types.is_bool_dtype(series) or not pd.api.types.is_numeric_dtype(series):
+    return {'kind': 'categorical', 'values': set(series.astype(str).value_counts().index[:50])}
+  values = series.to_numpy(dtype=float)
+  if len(values) == 0:
+    return {'kind': 'numeric', 'quantiles': None}
+  quantiles = np.quantile(values, PROFILE_QUANTILES)
+  spread = quantiles[-1] - quantiles[0]
+  # centred and scaled, so the same measure in seconds and in minutes has the same profile
+  return {'kind': 'numeric', 'quantiles': (quantiles - np.median(values)) / spread if spread > 0 else np.zeros_like(quantiles)}
+
+
+def rename_profiles(profiles, mapping):
+  """Apply an {old: new} column mapping in place to {column: profile} dicts, as rename_columns does to frames."""
+  for old, new in (mapping or {}).items():
+    for column_profiles in profiles:
+      if old in column_profiles:
+        column_profiles[new] = column_profiles.pop(old)
+
+
+def profile_digest(profile):
+  """A coarse, JSON-able form of a profile: columns whose values look alike share it."""
+  if profile is None:
+    return None
+  if profile['kind'] == 'categorical':
+    return ['categorical', sorted(profile['values'])]
+  return ['numeric', None if profile['quantiles'] is None else np.round(profile['quantiles'], 1).tolist()]
+
+
+def value_similarity(profile_a, profile_b):
+  if profile_a is None or profile_b is None:
+    return 0.5  # nothing to compare the values with, e.g. a column computed by the aggregation
+  if profile_a['kind'] != profile_b['kind']:
+    return 0.0
+  if profile_a['kind'] == 'categorical':
+    union = profile_a['values'] | profile_b['values']
+    return len(profile_a['values'] & profile_b['values']) / len(union) if union else 0.5
+  if profile_a['quantiles'] is None or profile_b['quantiles'] is None:
+    return 0.5
+  return float(np.exp(-np.abs(profile_a['quantiles'] - profile_b['quantiles']).mean() * 2))
+
+
+class SchemaMatcher:
+  """Decide column renames locally where the evidence is clear; ask `ask_llm` about the rest."""
+
+  def __init__(self, accept=SCHEMA_MATCH_ACCEPT, margin=SCHEMA_MATCH_MARGIN, reject=SCHEMA_MATCH_REJECT,
+               name_weight=0.7, cache_path=SCHEMA_MATCH_CACHE_PATH):
+    self.accept = accept
+    self.margin = margin
+    self.reject = reject
+    self.name_weight = name_weight
+    self.cache_path = cache_path
+    self._decisions = None
+    self._lock = threading.Lock()
+    self.local_matches = 0
+    self.cached_decisions = 0
+    self.llm_columns = 0
+
+  def settings(self):
+    return {'accept': self.accept, 'margin': self.margin, 'reject': self.reject, 'name_weight': self.name_weight}
+
+  ######## ------ PAIR DECISION CACHE ------- #########
+
+  def _pair_key(self, column, profile, reference_column, reference_profile):
+    # a verdict holds for these two columns as they look now, not for every later bundle with the same names
+    return stable_hash(str(column), str(reference_column), profile_digest(profile), profile_digest(reference_profile))
+
+  def _load_decisions(self):
+    if self._decisions is None:
+      self._decisions = read_json(self.cache_path, {}) if self.cache_path else {}
+    return self._decisions
+
+  def _cached(self, column, profile, reference_column, reference_profile):
+    with self._lock:
+      return self._load_decisions().get(self._pair_key(column, profile, reference_column, reference_profile))
+
+  def _remember(self, decisions):
+    """`decisions`: [(column, profile, reference column, reference profile, same)]."""
+    with self._lock:
+      stored = self._load_decisions()
+      for column, profile, reference_column, reference_profile, same in decisions:
+        stored[self._pair_key(column, profile, reference_column, reference_profile)] = same
+      if self.cache_path:
+        write_json_atomic(self.cache_path, stored)
+
+  ######## ------ MATCHING ------- #########
+
+  def score(self, column, profile, reference_column, reference_profile):
+    return (self.name_weight * name_similarity(column, reference_column)
+            + (1 - self.name_weight) * value_similarity(profile, reference_profile))
+
+  def match(self, df, reference_frames, entity_key, ask_llm, reference_profiles=None):
+    """ Return an {old: new} rename mapping for `df` against the columns of `reference_frames`.
+    `ask_llm(columns, reference_columns)` returns the LLM's mapping (or None) for the ambiguous columns.
+    `reference_profiles` (one {column: profile} per frame) are the profiles of the frames' columns as read, before
+    they were aggregated, so they compare with those of `df`; columns without one are compared on their names.
+    Without them, the frames' current values are profiled. """
+    profiled = {}
+    for i, frame in enumerate(reference_frames):
+      for col in frame.columns:
+        if col != entity_key and col not in profiled:
+          profiled[col] = reference_profiles[i].get(col) if reference_profiles is not None else profile_column(frame[col])
+    reference_profiles = profiled
+    # columns that already exist in the reference keep their name, and their reference column is taken
+    new_columns = [col for col in df.columns if col != entity_key and col not in reference_profiles]
+    targets = [col for col in reference_profiles if col not in df.columns]
+    if not new_columns or not targets:
+      return {}
+
+    ranked, candidates, column_profiles = {}, {}, {}
+    profiles = getattr(df, 'column_profiles', None)  # prepared in a Part 3 worker (utils/part3_workers.py)
+    for col in new_columns:
+      profile = column_profiles[col] = profiles[col] if profiles is not None else profile_column(df[col])
+      ranked[col] = sorted(((self.score(col, profile, ref, reference_profiles[ref]), ref) for ref in targets), reverse=True)
+      candidates[col] = [ref for score, ref in ranked[col] if score >= self.reject]
+
+    mapping, ambiguous = {}, []
+    for col in new_columns:
+      if not candidates[col]:
+        continue  # nothing in the reference looks like this column
+      (best_score, best_ref), runner_up = ranked[col][0], (ranked[col][1][0] if len(ranked[col]) > 1 else 0.0)
+      if best_score >= self.accept and best_score - runner_up >= self.margin:
+        mapping[col] = best_ref
+        self.local_matches += 1
+        continue
+      # earlier LLM verdicts on these exact pairs decide without a new call
+      verdicts = {ref: self._cached(col, column_profiles[col], ref, reference_profiles[ref]) for ref in candidates[col]}
+      if all(verdict is not None for verdict in verdicts.values()):
+        self.cached_decisions += 1
+        matches = [ref for ref in candidates[col] if verdicts[ref]]
+        if matches:
+          mapping[col] = matches[0]
+        continue
+      ambiguous.append(col)
+
+    if ambiguous:
+      self.llm_columns += len(ambiguous)
+      reference_columns = list(dict.fromkeys(ref for col in ambiguous for ref in candidates[col]))
+      llm_mapping = ask_llm(ambiguous, reference_columns) or {}
+      self._remember([(col, column_profiles[col], ref, reference_profiles[ref], llm_mapping.get(col) == ref)
+                      for col in ambiguous for ref in candidates[col]])
+      for col in ambiguous:
+        if llm_mapping.get(col) in candidates[col]:
+          mapping[col] = llm_mapping[col]
+
+    # one column per reference column: the best-scoring claim wins
+    claims = {}
+    for col, ref in mapping.items():
+      score = dict((r, score) for score, r in ranked[col])[ref]
+      if ref not in claims or score > claims[ref][0]:
+        claims[ref] = (score, col)
+    return {col: ref for ref, (score, col) in claims.items()}
+
+  def stats(self):
+    return {'local_matches': self.local_matches, 'cached_decisions': self.cached_decisions, 'llm_columns': self.llm_columns}
+
+
+schema_matcher = SchemaMatcher()
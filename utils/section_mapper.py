@@ -0,0 +1,84 @@
+# This file contains an offline section -> page mapper for metadata PDFs (questionnaires).
+# It scans the page text for section headings ("SECTION 2A", "Module 3: ...") and, failing that,
+# for table-of-contents lines ("2A Household roster ........ 5"). The output has the same shape as
+# the Gemini-based map: {section_name: [zero-indexed pages]}.
+import re
+from collections import Counter
+
+HEADING_PATTERN = re.compile(
+  r'^\s*(?:SECTION|Section|MODULE|Module|SEC\.?)\s*[:#\-]?\s*([0-9]{1,3}[A-Za-z]?(?:[._][0-9A-Za-z]{1,3})?)\b',
+  re.MULTILINE)
+TOC_LINE_PATTERN = re.compile(
+  r'^\s*(?:SECTION|Section|MODULE|Module)?\s*([0-9]{1,3}[A-Za-z]?)\b[^\n]*?(?:\.{2,}|\s{2,}|\t)\s*(\d{1,4})\s*$',
+  re.MULTILINE)
+MIN_TOC_LINES = 3  # a page with at least this many TOC-looking lines is treated as a table of contents
+
+
+def normalize_section_name(name):
+  return name.strip().lower()
+
+
+def find_toc_pages(page_texts):
+  return {i for i, text in enumerate(page_texts) if len(TOC_LINE_PATTERN.findall(text or '')) >= MIN_TOC_LINES}
+
+
+def map_sections_from_headings(page_texts, skip_pages=()):
+  """Assign each page to the section heading(s) on it, or to the last heading seen before it."""
+  section_map = {}
+  current_section = None
+  for i, text in enumerate(page_texts):
+    if i in skip_pages:
+      continue
+    headings = [normalize_section_name(h) for h in HEADING_PATTERN.findall(text or '')]
+    for heading in dict.fromkeys(headings):  # dedupe, keep order
+      section_map.setdefault(heading, [])
+      if i not in section_map[heading]:
+        section_map[heading].append(i)
+    if headings:
+      current_section = headings[-1]
+    elif current_section is not None:  # continuation page of the previous section
+      section_map[current_section].append(i)
+  return section_map
+
+
+def map_sections_from_toc(page_texts, toc_pages, heading_map=None):
+  """Turn table-of-contents entries (section, printed page) into zero-indexed page ranges."""
+  entries = {}
+  for i in sorted(toc_pages):
+    for section, printed_page in TOC_LINE_PATTERN.findall(page_texts[i]):
+      entries.setdefault(normalize_section_name(section), int(printed_page))
+  if not entries:
+    return {}
+
+  # printed page numbers rarely match PDF indices (cover pages, roman numerals); calibrate the offset
+  # against any section whose heading we did find in the body
+  offsets = Counter(heading_map[s][0] - (p - 1) for s, p in entries.items() if heading_map and s in heading_map)
+  offset = offsets.most_common(1)[0][0] if offsets else 0
+
+  starts = sorted((p - 1 + offset, s) for s, p in entries.items() if 0 <= p - 1 + offset < len(page_texts))
+  section_map = {}
+  for (start, section), next_entry in zip(starts, starts[1:] + [(len(page_texts), None)]):
+    section_map[section] = list(range(start, max(start + 1, next_entry[0])))
+  return section_map
+
+
+def page_coverage(section_map, num_pages):
+  if not num_pages:
+    return 0.0
+  covered = {page for pages in section_map.values() for page in pages}
+  return len(covered) / num_pages
+
+
+def map_sections_from_text(page_texts):
+  """Return ({section: [pages]}, fraction of pages covered) using headings first, then the TOC."""
+  toc_pages = find_toc_pages(page_texts)
+  section_map = map_sections_from_headings(page_texts, skip_pages=toc_pages)
+  coverage = page_coverage(section_map, len(page_texts) - len(toc_pages))
+
+  if toc_pages:
+    toc_map = map_sections_from_toc(page_texts, toc_pages, section_map)
+    toc_coverage = page_coverage(toc_map, len(page_texts) - len(toc_pages))
+    if toc_coverage > coverage:
+      section_map, coverage = toc_map, toc_coverage
+
+  return section_map, coverage
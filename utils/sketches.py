@@ -0,0 +1,92 @@
+# This file contains small mergeable sketches over 64-bit value hashes: HyperLogLog (distinct counts) and a
+# one-permutation (bottom-k) MinHash (Jaccard similarity / containment between value sets).
+# Both are built chunk by chunk, so million-row columns are summarized without keeping their values.
+import numpy as np
+import pandas as pd
+
+
+def hash_values(series):
+  """64-bit hashes of a column's non-null values, normalized (stripped, lowercased) so 'User_1 ' == 'user_1'."""
+  values = series.dropna().astype(str).str.strip().str.lower()
+  return pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+
+
+class HyperLogLog:
+  """Distinct-count estimate with 2**p registers (p=12: ~1.6% standard error, 4 KB)."""
+
+  def __init__(self, p=12, registers=None):
+    self.p = p
+    self.registers = np.zeros(1 << p, dtype=np.uint8) if registers is None else np.asarray(registers, dtype=np.uint8)
+
+  def add_hashes(self, hashes):
+    if len(hashes) == 0:
+      return
+    index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - self.p)) - 1)
+    # rank = 1 + number of trailing zeros of the remaining bits (rest & -rest isolates the lowest set bit)
+    lowest_bit = rest & (~rest + np.uint64(1))
+    rank = np.where(rest == 0, 64 - self.p + 1, np.log2(np.maximum(lowest_bit, 1).astype(np.float64)).astype(np.int64) + 1)
+    np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+  def merge(self, other):
+    self.registers = np.maximum(self.registers, other.registers)
+    return self
+
+  def count(self):
+    m = len(self.registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+    zeros = int(np.count_nonzero(self.registers == 0))
+    if estimate <= 2.5 * m and zeros:
+      estimate = m * np.log(m / zeros)  # linear counting for small sets
+    return float(estimate)
+
+  def to_dict(self):
+    return {'p': self.p, 'registers': self.registers.tolist()}
+
+  @classmethod
+  def from_dict(cls, data):
+    return cls(data['p'], data['registers'])
+
+
+class MinHash:
+  """ Bottom-k MinHash: the k smallest distinct hashes of a set. Two sketches estimate the Jaccard similarity
+  of their sets from the k smallest hashes of the union (Broder's one-permutation estimator). """
+
+  def __init__(self, k=256, mins=None):
+    self.k = k
+    self.mins = np.array([], dtype=np.uint64) if mins is None else np.asarray(mins, dtype=np.uint64)
+
+  def add_hashes(self, hashes):
+    if len(hashes) == 0:
+      return
+    candidates = np.unique(np.concatenate([self.mins, hashes[hashes < self.mins.max()] if len(self.mins) >= self.k else hashes]))
+    self.mins = candidates[:self.k]
+
+  def merge(self, other):
+    self.add_hashes(other.mins)
+    return self
+
+  def jaccard(self, other):
+    if len(self.mins) == 0 or len(other.mins) == 0:
+      return 0.0
+    union = np.union1d(self.mins, other.mins)[:min(self.k, other.k)]
+    shared = np.intersect1d(np.intersect1d(union, self.mins, assume_unique=True), other.mins, assume_unique=True)
+    return len(shared) / len(union)
+
+  def to_dict(self):
+    # hex strings: JSON numbers cannot hold all uint64 values exactly
+    return {'k': self.k, 'mins': [format(int(h), 'x') for h in self.mins]}
+
+  @classmethod
+  def from_dict(cls, data):
+    return cls(data['k'], [int(h, 16) for h in data['mins']])
+
+
+def containment(minhash_a, count_a, minhash_b, count_b):
+  """Estimated share of the smaller set that is also in the larger one, from Jaccard and distinct counts."""
+  jaccard = minhash_a.jaccard(minhash_b)
+  if jaccard == 0 or min(count_a, count_b) == 0:
+    return 0.0
+  intersection = jaccard / (1 + jaccard) * (count_a + count_b)
+  return min(1.0, intersection / min(count_a, count_b))
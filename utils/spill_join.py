@@ -0,0 +1,192 @@
+# This file contains the out-of-core join for Part 3 (PART_3_SPILL), for inputs whose per-entity frames do not fit in memory.
+# Every frame is hash-partitioned on the entity key into a scratch folder as soon as it is produced, so equal keys of all
+# frames land in the same partition. The partitions are then joined and aggregated one at a time with the same code as
+# the in-memory path (merge_entity_frames + aggregate_by_key), and the sorted partition results are k-way merged into the
+# output file, which ends up with the same rows, in the same order, as the in-memory result.
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from utils.cache_utils import CACHE_FOLDER
+from utils.transform_utils import FrameWriter, aggregate_by_key, merge_entity_frames
+
+PART_3_SPILL = (os.getenv("PART_3_SPILL") or 'false').lower() == 'true'
+PART_3_SPILL_PARTITIONS = int(os.getenv("PART_3_SPILL_PARTITIONS") or 32)  # memory per partition ~ total frame size / partitions
+PART_3_SPILL_CHUNK_ROWS = int(os.getenv("PART_3_SPILL_CHUNK_ROWS") or 20000)  # rows per sorted run file; the output merge holds one per partition
+PART_3_SPILL_FOLDER = os.getenv("PART_3_SPILL_FOLDER") or os.path.join(CACHE_FOLDER, 'part3_spill')
+
+
+def partition_ids(keys, num_partitions):
+  """Partition of every key; equal keys get the same partition whatever their dtype (1 and 1.0, categorical or not)."""
+  if isinstance(keys.dtype, pd.CategoricalDtype):
+    keys = keys.astype(keys.cat.categories.dtype)
+  if pd.api.types.is_numeric_dtype(keys) and not pd.api.types.is_bool_dtype(keys):
+    values = keys.to_numpy(dtype=np.float64)
+  else:
+    values = keys.astype(str).to_numpy(dtype=object)
+  return (pd.util.hash_array(values) % np.uint64(num_partitions)).astype(np.intp)
+
+
+def decode_categorical(series):
+  return series.astype(series.cat.categories.dtype) if isinstance(series.dtype, pd.CategoricalDtype) else series
+
+
+class SpilledFrame:
+  """ A per-entity frame on disk, one file per partition. Its column names stay in memory and follow renames like a
+  DataFrame's (rename_columns works on both); they are applied when a partition is loaded. """
+
+  def __init__(self, folder, columns, unique):
+    self.folder = folder
+    self.names = {col: col for col in columns}  # spilled name -> current name
+    self.unique = unique  # whether the key of the whole frame is unique, which decides how it is merged
+
+  @property
+  def columns(self):
+    return pd.Index(list(self.names.values()))
+
+  def rename(self, columns, inplace=True):
+    for old, new in columns.items():
+      self.names = {col: new if current == old else current for col, current in self.names.items()}
+
+  def load(self, partition):
+    return pd.read_pickle(os.path.join(self.folder, f"{partition}.pkl")).rename(columns=self.names)
+
+  def load_keys(self, partition):
+    return pd.read_pickle(os.path.join(self.folder, f"{partition}.keys.pkl"))
+
+  def load_all(self, num_partitions):
+    """The whole frame again, in its original row order (rows without a key only if its key repeats)."""
+    return pd.concat([self.load(partition) for partition in range(num_partitions)]).sort_index(kind='stable')
+
+
+class SpillJoin:
+  """ Hash-partitions per-entity frames on `entity_key` into a scratch folder (removed on close) and joins them
+  partition by partition. Peak memory is about one partition of every frame, plus one run file per partition
+  while the output is written. """
+
+  def __init__(self, entity_key, num_partitions=PART_3_SPILL_PARTITIONS, chunk_rows=PART_3_SPILL_CHUNK_ROWS,
+               folder=PART_3_SPILL_FOLDER):
+    os.makedirs(folder, exist_ok=True)
+    self.folder = tempfile.mkdtemp(dir=folder)
+    self._cleanup = weakref.finalize(self, shutil.rmtree, self.folder, True)  # also after a failed run
+    self.entity_key = entity_key
+    self.num_partitions = max(1, num_partitions)
+    self.chunk_rows = max(1, chunk_rows)
+    self.bytes_spilled = 0
+    self.frames_spilled = 0
+
+  def close(self):
+    self._cleanup()
+
+  def _write(self, obj, path):
+    obj.to_pickle(path)
+    self.bytes_spilled += os.path.getsize(path)
+
+  ######## ------ PARTITIONING ------- #########
+
+  def spill(self, frame):
+    """ Write `frame` to disk in partitions and return its SpilledFrame stand-in. Empty partitions are written too,
+    so every partition sees every frame's columns. Rows without a key never reach the output; they are dropped, except
+    in frames with a repeated key, where the outer merge keeps them (and fills the other frames' columns, which changes
+    their dtypes) until the final groupby. Those go to partition 0, so one partition reproduces that. """
+    key = self.entity_key
+    unique = bool(frame[key].is_unique)
+
+    if unique:
+      frame = frame[frame[key].notna()]
+    partitions = np.zeros(len(frame), dtype=np.intp)
+    has_key = frame[key].notna().to_numpy()
+    partitions[has_key] = partition_ids(frame[key][has_key], self.num_partitions)
+    order = np.argsort(partitions, kind='stable')
+    bounds = np.searchsorted(partitions[order], np.arange(self.num_partitions + 1))
+
+    folder = os.path.join(self.folder, str(self.frames_spilled))
+    os.makedirs(folder)
+    self.frames_spilled += 1
+    for partition in range(self.num_partitions):
+      part = frame.iloc[order[bounds[partition]:bounds[partition + 1]]]
+      # categories unused in this partition are dropped, or every partition would carry all of them
+      categorical = [col for col in part.columns if isinstance(part[col].dtype, pd.CategoricalDtype)]
+      if categorical:
+        part = part.assign(**{col: part[col].cat.remove_unused_categories() for col in categorical})
+      self._write(part, os.path.join(folder, f"{partition}.pkl"))
+      self._write(part[key], os.path.join(folder, f"{partition}.keys.pkl"))
+    return SpilledFrame(folder, frame.columns, unique)
+
+  def fill_flags(self, frames):
+    """ For every frame, whether the in-memory join would fill missing values into it: a frame with a unique key
+    needs filling if any other unique-keyed frame has a key it lacks, in any partition. """
+    fill = [False] * len(frames)
+    aligned = [i for i, frame in enumerate(frames) if frame.unique]
+    if len(aligned) < 2:
+      return fill
+    for partition in range(self.num_partitions):
+      keys = {i: frames[i].load_keys(partition) for i in aligned}
+      union = pd.concat(list(keys.values()), ignore_index=True).nunique()
+      for i in aligned:
+        fill[i] |= len(keys[i]) < union
+    return fill
+
+  ######## ------ JOIN + OUTPUT ------- #########
+
+  def _write_runs(self, partition, result):
+    paths = []
+    for start in range(0, len(result), self.chunk_rows):
+      path = os.path.join(self.folder, f"result_{partition}_{start // self.chunk_rows}.pkl")
+      self._write(result.iloc[start:start + self.chunk_rows], path)
+      paths.append(path)
+    return paths
+
+  def write_joined(self, frames, names, merge_keys, path_without_extension, file_format='csv', compression=None):
+    """ Join the spilled `frames`, aggregate them like the in-memory path and write the result to one file.
+    Returns the path written, or None when the group key is not the entity key: partitions then do not hold whole
+    groups, and the caller joins in memory instead (SpilledFrame.load_all). """
+    unique = [frame.unique for frame in frames]
+    fill = self.fill_flags(frames)
+    key = self.entity_key
+    columns, dtypes, non_empty, runs = None, {}, set(), []
+    for partition in range(self.num_partitions):
+      merged = merge_entity_frames([frame.load(partition) for frame in frames], key, names, unique, fill)
+      result, group_key = aggregate_by_key(merged, merge_keys)
+      if group_key != key:
+        return None
+      result[key] = decode_categorical(result[key])
+      columns = list(result.columns)
+      non_empty.update(col for col in columns if result[col].notna().any())
+      for col in columns:
+        dtypes.setdefault(col, set()).add(result[col].dtype)
+      runs.append(self._write_runs(partition, result))
+
+    # the same columns as dropna(axis=1, how='all') on the whole result, and the dtypes the whole result would have
+    # (a column summed to int64 in one partition and float64 in another, where it had gaps, is float64 overall;
+    # integer keys are float64 overall if one frame had float keys, even where its partition was empty)
+    keep = [col for col in columns if col in non_empty]
+    common = {col: np.result_type(*types) for col, types in dtypes.items()
+              if len(types) > 1 and all(isinstance(t, np.dtype) for t in types)}
+
+    writer = FrameWriter(path_without_extension, file_format, compression)
+    # k-way merge: every partition result is sorted by key and each key is in exactly one partition, so rows up to
+    # the smallest last key of the loaded runs can be sorted and written out
+    pending = [list(paths) for paths in runs]
+    heads = [pd.read_pickle(paths.pop(0)) if paths else None for paths in pending]
+    while any(head is not None for head in heads):
+      bound = min(head[key].iloc[-1] for head in heads if head is not None)
+      batch = []
+      for i, head in enumerate(heads):
+        if head is None:
+          continue
+        taken = int(head[key].searchsorted(bound, side='right'))
+        batch.append(head.iloc[:taken])
+        head = head.iloc[taken:]
+        if head.empty:
+          head = pd.read_pickle(pending[i].pop(0)) if pending[i] else None
+        heads[i] = head
+      batch = pd.concat(batch, ignore_index=True).sort_values(key, kind='stable')
+      writer.write(batch.astype(common)[keep])
+    if writer.rows == 0:
+      writer.write(pd.DataFrame(columns=keep))
+    return writer.close()
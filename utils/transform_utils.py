@@ -0,0 +1,320 @@
+# This file contains helpers for PART 3: DATASET TRANSFORMATION (reading, filtering, merging).
+import re
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+CATEGORY_MAX_RATIO = 0.5  # string columns with at most this share of distinct values become categoricals
+# integer columns named like a position in a sequence; aggregated with max, since their sum means nothing
+ORDINAL_NAME_PATTERN = re.compile(r'(^|_)(day|week|month|year|index|idx|level|rank|step|round|period|seq|sequence|position|order)($|_)', re.IGNORECASE)
+
+
+######## ------ READING ------- #########
+
+def read_header(data_file_path):
+  """Read only the header row of a CSV."""
+  return list(pd.read_csv(data_file_path, nrows=0).columns)
+
+
+def resolve_columns(header, columns_to_keep, alias_keys, entity_key):
+  """ Decide which raw columns to read and how to rename them, from the header alone.
+  Returns (usecols in file order, {raw name: canonical name}) where aliases of the entity key are normalized. """
+  rename_map = {col: alias_keys[col] for col in header if col in alias_keys}
+  wanted = set(columns_to_keep) | {entity_key}
+  usecols = [col for col in header if rename_map.get(col, col) in wanted]
+  return usecols, rename_map
+
+
+def read_selected_columns(data_file_path, columns_to_keep, alias_keys, entity_key, chunksize=None):
+  """ Read only the columns we keep (plus the entity key and its aliases), optionally in chunks,
+  so peak memory scales with the selected columns instead of the raw file width. """
+  usecols, rename_map = resolve_columns(read_header(data_file_path), columns_to_keep, alias_keys, entity_key)
+  if not usecols:
+    return pd.DataFrame()
+  if chunksize:
+    chunks = pd.read_csv(data_file_path, usecols=usecols, chunksize=chunksize)
+    df = pd.concat(chunks, ignore_index=True)
+  else:
+    df = pd.read_csv(data_file_path, usecols=usecols)
+  return df.rename(columns={col: new for col, new in rename_map.items() if col in usecols})
+
+
+def rename_columns(frames, mapping):
+  """Apply an {old: new} column mapping in place to every frame that has the old column."""
+  for old, new in (mapping or {}).items():
+    for frame in frames:
+      if old in frame.columns:
+        frame.rename(columns={old: new}, inplace=True)
+
+
+######## ------ DTYPES ------- #########
+
+def optimize_dtypes(df, entity_key=None, floats=False, max_category_ratio=CATEGORY_MAX_RATIO):
+  """ Return `df` with compact dtypes and the same values: integers downcast to the smallest type that holds them,
+  low-cardinality strings (and an entity key that repeats, as in long tables) as categoricals, and with `floats`,
+  floats as float32 where that is exact. Floats are left alone before aggregation, where float32 sums would round. """
+  columns = {}
+  for col in df.columns:
+    series = df[col]
+    if pd.api.types.is_bool_dtype(series) or isinstance(series.dtype, pd.CategoricalDtype):
+      pass
+    elif pd.api.types.is_integer_dtype(series):
+      series = pd.to_numeric(series, downcast='integer')
+    elif pd.api.types.is_float_dtype(series):
+      if floats and series.dtype != np.float32:
+        compact = series.astype(np.float32)
+        if np.array_equal(compact.to_numpy(dtype=np.float64), series.to_numpy(dtype=np.float64), equal_nan=True):
+          series = compact
+    elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+      present = series.count()
+      distinct = series.nunique()
+      if present and (distinct <= max_category_ratio * present or (col == entity_key and distinct < present)):
+        series = series.astype('category')
+    columns[col] = series
+  return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def widen_dtypes(df):
+  """Plain dtypes again (int64, float64, decoded categoricals), for code that was not written with compact dtypes in mind."""
+  columns = {}
+  for col in df.columns:
+    series = df[col]
+    if isinstance(series.dtype, pd.CategoricalDtype):
+      series = series.astype(series.cat.categories.dtype)
+    elif pd.api.types.is_bool_dtype(series):
+      pass
+    elif pd.api.types.is_integer_dtype(series) and series.dtype != np.int64:
+      series = series.astype(np.int64) if not series.hasnans else series.astype(np.float64)
+    elif pd.api.types.is_float_dtype(series) and series.dtype != np.float64:
+      series = series.astype(np.float64)
+    columns[col] = series
+  return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def frame_memory(frames):
+  """Deep memory use of some frames, in bytes."""
+  return int(sum(frame.memory_usage(deep=True).sum() for frame in frames))
+
+
+######## ------ MERGING ------- #########
+
+def merge_entity_frames(frames, entity_key, names=None, unique=None, fill=None):
+  """ Outer-join per-entity frames on `entity_key` in one pass instead of a cascade of pairwise merges.
+  All keys are factorized together and every frame is aligned onto the sorted union, so the data is copied once.
+  Columns that appear in more than one frame get a `_<name>` suffix (name defaults to the frame position).
+  Frames whose key is not unique cannot be index-aligned; they are merged pairwise afterwards.
+  `unique` and `fill` (one flag per frame) override the checks for a unique key and for keys missing from the frame,
+  so that partitions of the frames (utils/spill_join.py) are merged the way the whole frames would be. """
+  names = names or [str(i) for i in range(len(frames))]
+  unique = unique or [None] * len(frames)
+  fill = fill or [None] * len(frames)
+  frames = [(name, frame, is_unique, fill_flag) for name, frame, is_unique, fill_flag in zip(names, frames, unique, fill)
+            if entity_key in frame.columns]
+  if not frames:
+    return None
+
+  column_counts = {}
+  for _, frame, _, _ in frames:
+    for col in frame.columns:
+      if col != entity_key:
+        column_counts[col] = column_counts.get(col, 0) + 1
+
+  aligned, duplicated = [], []
+  for name, frame, is_unique, fill_flag in frames:
+    clashing = {col: f"{col}_{name}" for col in frame.columns if col != entity_key and column_counts[col] > 1}
+    frame = frame.rename(columns=clashing)
+    if frame[entity_key].is_unique if is_unique is None else is_unique:
+      aligned.append((frame, fill_flag))
+    else:
+      duplicated.append(frame)
+
+  result = None
+  if aligned:
+    # factorize every key once into the sorted union of keys, then place each frame's columns at their
+    # positions in that union; every column is copied exactly once
+    keys = [frame[entity_key] for frame, _ in aligned]
+    all_keys = None
+    if all(isinstance(key.dtype, pd.CategoricalDtype) for key in keys):
+      # categorical keys stay categorical: their categories are unioned instead of decoding every key to strings
+      try:
+        all_keys = pd.Series(union_categoricals([key.array for key in keys], sort_categories=True))
+      except TypeError:  # categories of different types
+        pass
+    if all_keys is None:
+      all_keys = pd.concat(keys, ignore_index=True)
+    codes, union_keys = pd.factorize(all_keys, sort=True)
+    columns = {entity_key: union_keys}
+    offset = 0
+    for frame, fill_flag in aligned:
+      positions = codes[offset:offset + len(frame)]
+      offset += len(frame)
+      indexer = np.full(len(union_keys), -1, dtype=np.intp)
+      indexer[positions[positions >= 0]] = np.flatnonzero(positions >= 0)  # rows with a missing key are dropped
+      needs_fill = bool((indexer < 0).any()) if fill_flag is None else fill_flag
+      for col in frame.columns:
+        if col != entity_key:
+          series = frame[col]
+          if needs_fill and series.dtype in (np.int8, np.int16, np.uint8, np.uint16):
+            series = series.astype(np.float32)  # filling needs floats; these hold every small int exactly, float64 would double them
+          values = series.array
+          columns[col] = values.take(indexer, allow_fill=needs_fill)
+    result = pd.DataFrame(columns, copy=False)  # the taken arrays are fresh; skip block consolidation
+  for frame in duplicated:
+    result = frame if result is None else result.merge(frame, on=entity_key, how='outer')
+  return result
+
+
+def aggregate_by_key(result, merge_keys):
+  """ Final aggregation of the merged table: numeric columns summed per group key (the first merge key present),
+  with the merge keys moved to the front. Returns (aggregated df, group key or None if no merge key is present). """
+  group_key = next((k for k in merge_keys if k in result.columns), None)
+  if group_key:
+    columns_to_agg = [col for col in result.select_dtypes(include='number').columns if col != group_key]
+    result = result.groupby(group_key, observed=True)[columns_to_agg].sum().reset_index()
+  for key in merge_keys:
+    if key in result.columns:
+      col = result.pop(key)
+      result.insert(0, key, col)
+  return result, group_key
+
+
+######## ------ AGGREGATION ------- #########
+
+def ordinal_columns(keyed, entity_key, columns):
+  """ The integer `columns` of a table with several rows per entity that count positions rather than amounts:
+  named like one (day, index, level, ...) or counting up by one within every entity, like a row number. """
+  integers = [col for col in columns if pd.api.types.is_integer_dtype(keyed[col])]
+  ordinals = [col for col in integers if ORDINAL_NAME_PATTERN.search(str(col))]
+  unnamed = [col for col in integers if col not in ordinals]
+  if unnamed:
+    steps = keyed.groupby(entity_key, sort=False, observed=True)[unnamed].diff()
+    ordinals += [col for col in unnamed if steps[col].notna().any() and (steps[col].dropna() == 1).all()]
+  return [col for col in columns if col in ordinals]
+
+
+def classify_table_shape(df, entity_key, max_pivot_categories=50):
+  """ Classify a table into one of the shapes the aggregation prompt describes, from dtypes and key cardinality:
+  - 'per_entity': already one row per entity
+  - 'long': entity + one category column + numeric value column(s), to be pivoted
+  - 'repeated_numeric': several rows per entity, numeric columns (plus per-entity attributes) to be summed
+  In the last two, ordinal integer columns (day, index, ...) are kept apart from the values; they are not summed.
+  Returns (shape, {'values': [...], 'ordinals': [...], 'attributes': [...], 'category': col or None}) or (None, None). """
+  if entity_key not in df.columns:
+    return None, None
+  keyed = df[df[entity_key].notna()]
+  if keyed[entity_key].is_unique:
+    return 'per_entity', {'values': [], 'ordinals': [], 'attributes': [], 'category': None}
+
+  other_columns = [col for col in keyed.columns if col != entity_key]
+  numeric = [col for col in other_columns if pd.api.types.is_numeric_dtype(keyed[col]) and not pd.api.types.is_bool_dtype(keyed[col])]
+  ordinals = ordinal_columns(keyed, entity_key, numeric)
+  values = [col for col in numeric if col not in ordinals]
+  non_numeric = [col for col in other_columns if col not in numeric]
+  if non_numeric:
+    # attributes hold a single value per entity (e.g. region); anything else is a category to pivot on
+    per_entity_nunique = keyed.groupby(entity_key, observed=True)[non_numeric].nunique(dropna=True).max()
+    attributes = [col for col in non_numeric if per_entity_nunique[col] <= 1]
+  else:
+    attributes = []
+  categories = [col for col in non_numeric if col not in attributes]
+
+  if not categories and (values or ordinals):
+    return 'repeated_numeric', {'values': values, 'ordinals': ordinals, 'attributes': attributes, 'category': None}
+  if len(categories) == 1 and values and keyed[categories[0]].nunique(dropna=True) <= max_pivot_categories:
+    return 'long', {'values': values, 'ordinals': ordinals, 'attributes': attributes, 'category': categories[0]}
+  return None, None
+
+
+def rule_based_aggregate(df, entity_key, numeric_agg='sum', max_pivot_categories=50):
+  """ Deterministic, vectorized aggregation to one row per entity for the common table shapes.
+  Returns (aggregated df, shape), or (None, None) when the table should go to LLM code generation. """
+  shape, columns = classify_table_shape(df, entity_key, max_pivot_categories)
+  if shape is None:
+    return None, None
+  if shape == 'per_entity':
+    return df, shape
+
+  keyed = df[df[entity_key].notna()]
+  grouped = keyed.groupby(entity_key, sort=True, observed=True)
+  parts = []
+  if columns['attributes']:
+    parts.append(grouped[columns['attributes']].first())
+  if columns['ordinals']:
+    parts.append(grouped[columns['ordinals']].max())  # the last day/level reached, not their sum
+
+  if shape == 'repeated_numeric':
+    if columns['values']:
+      parts.append(grouped[columns['values']].agg(numeric_agg))
+  else:
+    # long format: one column per (value, category) pair, e.g. quantity + asset_type=sword -> quantity_sword
+    category = columns['category']
+    pivoted = keyed.pivot_table(index=entity_key, columns=category, values=columns['values'], aggfunc=numeric_agg, observed=True)
+    pivoted.columns = [f"{value}_{level}" for value, level in pivoted.columns]
+    parts.append(pivoted)
+
+  result = pd.concat(parts, axis=1) if len(parts) > 1 else parts[0]
+  return result.reset_index(), shape
+
+
+######## ------ OUTPUT ------- #########
+
+OUTPUT_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def write_frame(df, path_without_extension, file_format='csv', compression=None):
+  """Write `df` as CSV, compressed Parquet or Arrow/Feather and return the path written."""
+  path = path_without_extension + OUTPUT_EXTENSIONS[file_format]
+  if file_format == 'parquet':
+    df.to_parquet(path, index=False, compression=compression)
+  elif file_format == 'feather':
+    df.reset_index(drop=True).to_feather(path, compression=compression)
+  else:
+    df.to_csv(path, index=False)
+  return path
+
+
+class FrameWriter:
+  """ Write a frame chunk by chunk into one CSV/Parquet/Feather file, for results too large to hold at once.
+  Chunks must have the same columns; Parquet/Feather chunks are cast to the schema of the first one. """
+
+  def __init__(self, path_without_extension, file_format='csv', compression=None):
+    self.path = path_without_extension + OUTPUT_EXTENSIONS[file_format]
+    self.file_format = file_format
+    self.compression = compression
+    self.rows = 0
+    self._writer = None
+    self._schema = None
+
+  def write(self, df):
+    if self.file_format == 'csv':
+      df.to_csv(self.path, index=False, mode='w' if self._schema is None else 'a', header=self._schema is None)
+      self._schema = list(df.columns)
+    else:
+      import pyarrow as pa
+      import pyarrow.parquet as pq
+
+      table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+      if self._writer is None:
+        self._schema = table.schema
+        if self.file_format == 'parquet':
+          self._writer = pq.ParquetWriter(self.path, self._schema, compression=self.compression or 'none')
+        else:
+          self._writer = pa.ipc.new_file(self.path, self._schema, options=pa.ipc.IpcWriteOptions(compression=self.compression))
+      self._writer.write_table(table.cast(self._schema))
+    self.rows += len(df)
+
+  def close(self):
+    if self._writer is not None:
+      self._writer.close()
+      self._writer = None
+    return self.path
+
+
+def read_frame(path, columns=None):
+  """Read a CSV/Parquet/Feather file, loading only `columns` when given (columnar formats skip the rest on disk)."""
+  if path.endswith('.parquet'):
+    return pd.read_parquet(path, columns=columns)
+  if path.endswith('.feather'):
+    return pd.read_feather(path, columns=columns)
+  return pd.read_csv(path, usecols=columns)